@@ -134,9 +134,12 @@ get_cosmos30band()
 #                        #
 ##########################
 
-def get_pdfs(fld,pzcode) :
+def get_pdfs(fld,pzcode,extract=True) :
+    #If extract is False, the release tarball is kept as <field>/<pzcode>.tar.xz
+    #and PDFMatch will stream the pdfs directly from it.
     predir=prd.predir_saving+fld.upper()+'/'+pzcode+'/'
-    if os.path.isfile(predir+'done') :
+    tarpath=prd.predir_saving+fld.upper()+'/'+pzcode+'.tar.xz'
+    if os.path.isfile(predir+'done') or os.path.isfile(tarpath) :
         print("Found pdfs - ("+fld+","+pzcode+")")
         return
 
@@ -144,10 +147,14 @@ def get_pdfs(fld,pzcode) :
     url='https://hsc-release.mtk.nao.ac.jp/archive/photoz/pdr1/pdf/'+pzcode
     url+='/'+tarfile
     os.system('wget '+url)
-    os.system('mkdir -p '+predir)
-    os.system('touch '+predir+'done')
-    os.system('tar -C '+predir+' -xf '+tarfile)
-    os.system('rm '+tarfile)
+    if extract :
+        os.system('mkdir -p '+predir)
+        os.system('touch '+predir+'done')
+        os.system('tar -C '+predir+' -xf '+tarfile)
+        os.system('rm '+tarfile)
+    else :
+        os.system('mkdir -p '+prd.predir_saving+fld.upper())
+        os.system('mv '+tarfile+' '+tarpath)
 
 for pc in ['nnpz','ephor','ephor_ab','demp','frankenz'] :
     for f in ['wide_aegis','wide_gama09h','wide_gama15h','wide_hectomap','wide_vvds',
@@ -2,8 +2,14 @@ from ceci import PipelineStage
 from .types import FitsFile,ASCIIFile
 import numpy as np
 from .flatmaps import read_flat_map
-from .map_utils import createCountsMap
+from .pdf_utils import stack_pdfs_task
+from .pool_utils import pool_map
+from .stats_utils import histogram_index
 from astropy.io import fits
+from scipy.sparse import csr_matrix
+
+pz_code_names={'ephor_ab':'eab','frankenz':'frz','nnpz':'nnz'}
+pz_marks=['best','mean','mode','mc']
 
 class CatMapper(PipelineStage) :
     name="CatMapper"
@@ -12,90 +18,167 @@ class CatMapper(PipelineStage) :
     outputs=[('ngal_maps',FitsFile)]
     config_options={'mask_type':'sirius','pz_code':'ephor_ab','pz_mark':'best',
                     'pz_bins':[0.15,0.50,0.75,1.00,1.50],'nz_bin_num':200,
-                    'nz_bin_max':3.0}
+                    'nz_bin_max':3.0,'pdf_chunk_size':100000,
+                    'nmaps_pz_codes':[],'nmaps_pz_marks':[],'n_workers':-1}
     
-    def get_nmaps(self,cat) :
+    def get_nmaps(self,cat,columns=None) :
         """
-        Get number counts map from catalog
+        Get number counts maps from catalog for a set of photo-z columns.
+        All columns are digitized once and counted with a single bincount over
+        (column, redshift bin, pixel).
+        :param cat: object catalog.
+        :param columns: list of photo-z columns to bin objects in (default: `self.column_mark`).
+        :return: array with shape [n_columns,n_bins,n_pix] (or [n_bins,n_pix] if `columns` is None).
         """
-        maps=[]
+        single_column=columns is None
+        if single_column :
+            columns=[self.column_mark]
+        ncols=len(columns)
+        npix=self.fsk.get_size()
+        edges=np.array(self.config['pz_bins'])
 
-        for zi,zf in zip(self.zi_arr,self.zf_arr) :
-            msk_bin=(cat[self.column_mark]<=zf) & (cat[self.column_mark]>zi)
-            subcat=cat[msk_bin]
-            nmap=createCountsMap(subcat['ra'],subcat['dec'],self.fsk)
-            maps.append(nmap)
-        return np.array(maps)
+        ipix=self.fsk.pos2pix(cat['ra'],cat['dec'])
+        indices=[]
+        for ic,col in enumerate(columns) :
+            #Bin ib contains objects with edges[ib] < z <= edges[ib+1]
+            ibin=np.searchsorted(edges,cat[col],side='left')-1
+            good=(ibin>=0) & (ibin<self.nbins) & (ipix>=0)
+            indices.append((ic*self.nbins+ibin[good])*npix+ipix[good])
+        maps=np.bincount(np.concatenate(indices),minlength=ncols*self.nbins*npix)
+        maps=maps.reshape([ncols,self.nbins,npix]).astype(float)
+        if single_column :
+            return maps[0]
+        return maps
+
+    def write_nmaps(self,fname,maps,descr) :
+        """
+        Write a set of number counts maps (one HDU per redshift bin).
+        """
+        header=self.fsk.wcs.to_header()
+        hdus=[]
+        for im,m in enumerate(maps) :
+            head=header.copy()
+            head['DESCR']=('Ngal, bin %d, '%(im+1)+descr,'Description')
+            if im==0 :
+                hdu=fits.PrimaryHDU(data=m.reshape([self.fsk.ny,self.fsk.nx]),header=head)
+            else :
+                hdu=fits.ImageHDU(data=m.reshape([self.fsk.ny,self.fsk.nx]),header=head)
+            hdus.append(hdu)
+        fits.HDUList(hdus).writeto(fname,overwrite=True)
 
     def get_nz_cosmos(self) :
         """
-        Get N(z) from weighted COSMOS-30band data
+        Get N(z) from weighted COSMOS-30band data.
+        If the weights file contains weights for resampled realizations of the COSMOS
+        sample (see COSMOSWeight), the covariance of the normalized N(z) of each bin is
+        estimated from them, and the N(z) uncertainties are the square root of its diagonal.
+        Otherwise, the covariance is returned as None and the uncertainties are Poisson
+        errors on the (unnormalized) weighted histogram.
+        :return: array of [z_i,z_f,N(z),sigma(N(z))] for each bin, and list of covariances.
         """
-        weights_file=fits.open(self.get_input('cosmos_weights'))[1].data
+        hdul=fits.open(self.get_input('cosmos_weights'))
+        weights_file=hdul[1].data
+        weights_resampled=None
+        if len(hdul)>2 :
+            weights_resampled=hdul[2].data
+            print("Estimating N(z) covariances from %d %s realizations"%
+                  (len(weights_resampled),hdul[2].header['RESAMPLE']))
 
+        nz=self.config['nz_bin_num']
         pzs=[]
+        covs=[]
         for zi,zf in zip(self.zi_arr,self.zf_arr) :
             msk_cosmos=(weights_file[self.column_mark]<=zf) & (weights_file[self.column_mark]>zi)
             hz,bz=np.histogram(weights_file[msk_cosmos]['PHOTOZ'],
-                               bins=self.config['nz_bin_num'],
+                               bins=nz,
                                range=[0.,self.config['nz_bin_max']],
                                weights=weights_file[msk_cosmos]['weight'])
             hnz,bnz=np.histogram(weights_file[msk_cosmos]['PHOTOZ'],
-                                 bins=self.config['nz_bin_num'],
+                                 bins=nz,
                                  range=[0.,self.config['nz_bin_max']])
             ehz=np.zeros(len(hnz)); ehz[hnz>0]=(hz[hnz>0]+0.)/np.sqrt(hnz[hnz>0]+0.)
-            pzs.append([bz[:-1],bz[1:],(hz+0.)/np.sum(hz+0.),ehz])
-        return np.array(pzs)
+            nz_norm=np.sum(hz+0.)
+            if weights_resampled is None :
+                covs.append(None)
+            else :
+                #Histogram all realizations at once, with the same bins as `hz`
+                iz=histogram_index(weights_file[msk_cosmos]['PHOTOZ'],bz)
+                good=iz>=0
+                onehot=csr_matrix((np.ones(np.sum(good)),(np.where(good)[0],iz[good])),
+                                  shape=(len(iz),nz))
+                hz_r=np.transpose(onehot.transpose().dot(np.transpose(weights_resampled[:,msk_cosmos])))
+                hz_r/=np.sum(hz_r,axis=1)[:,None]
+                cov=np.atleast_2d(np.cov(hz_r,rowvar=False))
+                covs.append(cov)
+                ehz=np.sqrt(np.diag(cov))
+            pzs.append([bz[:-1],bz[1:],(hz+0.)/nz_norm,ehz])
+        return np.array(pzs),covs
 
-    def get_nz_stack(self,cat,codename) :
+    def get_nz_stacks(self,cat) :
         """
-        Get N(z) from pdf stacks.
-        :param cat: object catalog
-        :param codename: photoz code name (demp, ephor, ephor_ab, frankenz or nnpz).
+        Get N(z)s from pdf stacks for all photo-z codes. Pdfs are read in chunks of
+        `pdf_chunk_size` objects, and all codes are processed in parallel.
+        :param cat: object catalog (after removing masked objects)
+        :return: dictionary of N(z) arrays for each photoz code name.
         """
         from scipy.interpolate import interp1d
 
-        f=fits.open(self.pdf_files[codename])
-        p=f[1].data['pdf'][self.msk]
-        z=f[2].data['bins']
+        #Redshift bin of each object in the full (unmasked) catalog
+        ibin_cat=np.searchsorted(np.array(self.config['pz_bins']),cat[self.column_mark],side='left')-1
+        ibin_cat[ibin_cat>=self.nbins]=-1
+        ibin=-np.ones(len(self.msk),dtype=int)
+        ibin[self.msk]=ibin_cat
+
+        #Stack pdfs
+        codes=list(self.pdf_files.keys())
+        tasks=[(self.pdf_files[n],ibin,self.nbins,self.config['pdf_chunk_size']) for n in codes]
+        stacks=pool_map(stack_pdfs_task,tasks,n_workers=self.config['n_workers'])
 
         z_all=np.linspace(0.,self.config['nz_bin_max'],self.config['nz_bin_num']+1)
         z0=z_all[:-1]; z1=z_all[1:]; zm=0.5*(z0+z1)
-        pzs=[]
-        for zi,zf in zip(self.zi_arr,self.zf_arr) :
-            msk_bin=(cat[self.column_mark]<=zf) & (cat[self.column_mark]>zi)
-            hz_orig=np.sum(p[msk_bin],axis=0)
-            hz_orig/=np.sum(hz_orig)
-            hzf=interp1d(z,hz_orig,bounds_error=False,fill_value=0.)
-            hzm=hzf(zm);
+        pzs_stack={}
+        for n,(z,hz_all) in zip(codes,stacks) :
+            pzs=[]
+            for hz_orig in hz_all :
+                hz_orig/=np.sum(hz_orig)
+                hzf=interp1d(z,hz_orig,bounds_error=False,fill_value=0.)
+                hzm=hzf(zm);
             
-            pzs.append([z0,z1,hzm/np.sum(hzm)])
-        return np.array(pzs)
+                pzs.append([z0,z1,hzm/np.sum(hzm)])
+            pzs_stack[n]=np.array(pzs)
+        return pzs_stack
             
     def parse_input(self) :
         """
         Check config parameters for consistency
         """
         #Parse input params
-        if self.config['pz_code']=='ephor_ab' :
-            self.pz_code='eab'
-        elif self.config['pz_code']=='frankenz' :
-            self.pz_code='frz'
-        elif self.config['pz_code']=='nnpz' :
-            self.pz_code='nnz'
-        else :
+        if self.config['pz_code'] not in pz_code_names :
             raise KeyError("Photo-z method "+self.config['pz_code']+
                            " unavailable. Choose ephor_ab, frankenz or nnpz")
+        self.pz_code=pz_code_names[self.config['pz_code']]
 
-        if self.config['pz_mark']  not in ['best','mean','mode','mc'] :
+        if self.config['pz_mark']  not in pz_marks :
             raise KeyError("Photo-z mark "+self.config['pz_mark']+
                            " unavailable. Choose between best, mean, mode and mc")
         self.column_mark='pz_'+self.config['pz_mark']+'_'+self.pz_code
 
+        #Additional (code,mark) combinations to map
+        for c in self.config['nmaps_pz_codes'] :
+            if c not in pz_code_names :
+                raise KeyError("Photo-z method "+c+" unavailable. Choose ephor_ab, frankenz or nnpz")
+        for m in self.config['nmaps_pz_marks'] :
+            if m not in pz_marks :
+                raise KeyError("Photo-z mark "+m+" unavailable. Choose between best, mean, mode and mc")
+        self.extra_maps=[(c,m) for c in self.config['nmaps_pz_codes']
+                         for m in self.config['nmaps_pz_marks']]
+
     def run(self) :
         """
         Main routine. This stage:
         - Creates number density maps from the reduced catalog for a set of redshift bins.
+          Maps for all combinations of `nmaps_pz_codes` and `nmaps_pz_marks` are also
+          written to separate files (ngal_maps_<code>_<mark>.fits).
         - Calculates the associated N(z)s for each bin using different methods.
         - Stores the above into a single FITS file
         """
@@ -128,15 +211,15 @@ class CatMapper(PipelineStage) :
         self.nbins=len(self.zi_arr)
 
         print("Getting COSMOS N(z)s")
-        pzs_cosmos=self.get_nz_cosmos()
+        pzs_cosmos,covs_cosmos=self.get_nz_cosmos()
 
         print("Getting pdf stacks")
-        pzs_stack={}
-        for n in self.pdf_files.keys() :
-            pzs_stack[n]=self.get_nz_stack(cat,n)
+        pzs_stack=self.get_nz_stacks(cat)
 
         print("Getting number count maps")
-        n_maps=self.get_nmaps(cat)
+        columns=[self.column_mark]+['pz_'+m+'_'+pz_code_names[c] for c,m in self.extra_maps]
+        n_maps_all=self.get_nmaps(cat,columns)
+        n_maps=n_maps_all[0]
 
         print("Writing output")
         header=self.fsk.wcs.to_header()
@@ -156,11 +239,21 @@ class CatMapper(PipelineStage) :
                   fits.Column(name='z_f',array=pzs_cosmos[im,1,:],format='E'),
                   fits.Column(name='nz_cosmos',array=pzs_cosmos[im,2,:],format='E'),
                   fits.Column(name='enz_cosmos',array=pzs_cosmos[im,3,:],format='E')]
+            if covs_cosmos[im] is not None :
+                #Row i of the N(z) covariance matrix
+                cols.append(fits.Column(name='cov_nz_cosmos',array=covs_cosmos[im],
+                                        format='%dE'%len(covs_cosmos[im])))
             for n in self.pdf_files.keys() :
                 cols.append(fits.Column(name='nz_'+n,array=pzs_stack[n][im,2,:],format='E'))
             hdus.append(fits.BinTableHDU.from_columns(cols))
         hdulist=fits.HDUList(hdus)
         hdulist.writeto(self.get_output('ngal_maps'),overwrite=True)
 
+        #Additional map sets, written next to the main output
+        for (c,m),maps in zip(self.extra_maps,n_maps_all[1:]) :
+            fname=self.get_output('ngal_maps')[:-5]+'_'+c+'_'+m+'.fits'
+            print("Writing "+fname)
+            self.write_nmaps(fname,maps,c+' '+m)
+
 if __name__ == '__main__':
     cls = PipelineStage.main()
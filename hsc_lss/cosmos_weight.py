@@ -1,29 +1,82 @@
 from ceci import PipelineStage
 from .types import FitsFile
-from astropy.table import Table,hstack
+from astropy.table import Table
 import numpy as np
-from astropy.coordinates import SkyCoord
-import astropy.units as u
 from astropy.io import fits
-import pandas as pd
-from sklearn.neighbors import NearestNeighbors
-from sklearn.neighbors import KDTree
-import scipy.spatial as spatial
+from .density_ratio import DensityRatio
+from .sky_match import SkyMatcher
+
+def get_resampled_weights(neighbors,num_photoz,n_photoz,n_resamples,kind='bootstrap',
+                          seed=1234,batch_size=100) :
+    """
+    Computes colour-space weights for resampled versions of the training sample.
+    The neighbor radius of each training object is kept fixed, so each realization only
+    requires recounting the (resampled) training neighbors within it, which is done for
+    a batch of realizations at once with a sparse matrix product.
+    :param neighbors: sparse matrix with shape [n_train,n_train], with A_ij=1 if training
+        object j lies within the neighbor radius of training object i.
+    :param num_photoz: number of photometric objects within the neighbor radius of each
+        training object.
+    :param n_photoz: total number of photometric objects.
+    :param n_resamples: number of realizations.
+    :param kind: 'bootstrap' (multinomial resampling) or 'poisson' (Poisson(1) multiplicities).
+    :param seed: seed for the random number generator.
+    :param batch_size: number of realizations generated at a time.
+    :return: array with shape [n_resamples,n_train] containing the weights of each
+        training object in each realization (zero for objects not drawn).
+    """
+    rng=np.random.default_rng(seed)
+    n_train=neighbors.shape[0]
+    weights=np.zeros([n_resamples,n_train],dtype=np.float32)
+    for i0 in range(0,n_resamples,batch_size) :
+        nb=min(batch_size,n_resamples-i0)
+        if kind=='bootstrap' :
+            counts=rng.multinomial(n_train,np.ones(n_train)/n_train,size=nb).astype(float)
+        elif kind=='poisson' :
+            counts=rng.poisson(1.,size=[nb,n_train]).astype(float)
+        else :
+            raise ValueError("Unknown resampling "+kind+". Choose bootstrap or poisson")
+        #Number of resampled training objects within the radius of each object
+        num_train=np.transpose(neighbors.dot(np.transpose(counts)))
+        good=counts>0
+        w=np.zeros([nb,n_train])
+        w[good]=(counts*num_photoz[None,:])[good]/num_train[good]
+        weights[i0:i0+nb]=w*(np.sum(counts,axis=1)/n_photoz)[:,None]
+    return weights
 
 class COSMOSWeight(PipelineStage) :
     name="COSMOSWeight"
     inputs=[('cosmos_data',FitsFile),('cosmos_hsc',FitsFile)]
     outputs=[('cosmos_weights',FitsFile)]
-    config_options={'depth_cut':24.5,'band':'i','mask_type':'sirius','n_neighbors':10}
+    config_options={'depth_cut':24.5,'band':'i','mask_type':'sirius','n_neighbors':10,
+                    'weight_estimator':'radius_count','kernel_width':0.1,
+                    'n_workers':-1,'tree_cache_dir':None,'match_tol_arcsec':1.,
+                    'n_resamples':0,'resampling':'bootstrap','resampling_seed':1234}
     bands=['g','r','i','z','y']
 
+    def parse_input(self) :
+        """
+        Check config parameters for consistency
+        """
+        if self.config['weight_estimator'] not in DensityRatio.estimators :
+            raise ValueError("Unknown density estimator "+self.config['weight_estimator']+
+                             ". Choose between "+", ".join(DensityRatio.estimators))
+        if (self.config['n_resamples']>0) and (self.config['weight_estimator']!='radius_count') :
+            raise ValueError("Resampled weights are only available for the radius_count estimator")
+
     def run(self) :
         """
         Main function.
         This stage matches the COSMOS-30band data with the HSC COSMOS sample cut with the
         same criteria as our data and produces colour-space weights to match our sample
         so it can be used to estimate redshift distributions.
+        The weights are estimated as the ratio of the densities of both samples in colour
+        space, using the estimator given by `weight_estimator` (see `density_ratio.DensityRatio`).
+        If `n_resamples`>0, weights are also computed for `n_resamples` bootstrap or Poisson
+        realizations of the training sample, and stored as an extra image HDU (with shape
+        [n_resamples,n_train]) that CatMapper uses to estimate N(z) covariances.
         """
+        self.parse_input()
         band=self.config['band']
 
         #Read HSC COSMOS catalog
@@ -92,64 +145,72 @@ class COSMOSWeight(PipelineStage) :
                              (cat30['ZP_2']<0) & (cat30['MASS_BEST']>7.5) & 
                              (np.maximum(cat30['ZPDF_H68']-cat30['ZPDF'],cat30['ZPDF']-cat30['ZPDF_L68'])<0.05*(1+cat30['PHOTOZ'])) &
                              (cat30['CHI2_BEST']<cat30['CHIS']) & (cat30['CHI2_BEST']/cat30['NBFILT']<5.))
-        cat30=cat30[lim_indices]
+        lim_indices=lim_indices[0]
 
         ####
         # Match coordinates
         print("Matching coordinates")
-        cosmos_skycoord = SkyCoord(ra = np.array(cat30['ALPHA_J2000'])*u.deg, dec = np.array(cat30['DELTA_J2000'])*u.deg)
-        hsc_skycoord = SkyCoord(ra = np.array(cat['ra'])*u.deg, dec = np.array(cat['dec'])*u.deg)
-        # Nearest neighbors
-        cosmos_index, dist_2d, dist_3d = hsc_skycoord.match_to_catalog_sky(cosmos_skycoord) 
-        # Cut everything further than 1 arcsec
-        mask=dist_2d.degree*60*60<1 #        
-        cat_good=cat[mask]
-        cat30_good=cat30[cosmos_index[mask]]
-        cosmos_index_matched = cosmos_index[mask]
-
-        t1=Table.from_pandas(pd.DataFrame(cat30_good))
-        keys_t2=['gcmodel_mag','rcmodel_mag','icmodel_mag','zcmodel_mag',
-                 'ycmodel_mag','pz_mean_eab','pz_mode_eab','pz_best_eab',
-                 'pz_mc_eab','pz_mean_frz','pz_mode_frz','pz_best_frz',
-                 'pz_mc_frz','pz_mean_nnz','pz_mode_nnz','pz_best_nnz',
-                 'pz_mc_nnz']
-        t2=Table.from_pandas(pd.DataFrame(np.transpose([np.array(cat_good[k]) for k in keys_t2]),
-                                          index=range(len(cat_good)),columns=keys_t2))
-        cat_matched= hstack([t1, t2])
+        matcher=SkyMatcher(cat30['ALPHA_J2000'][lim_indices],cat30['DELTA_J2000'][lim_indices],
+                           workers=self.config['n_workers'],cache_dir=self.config['tree_cache_dir'])
+        # Nearest neighbors within 1 arcsec
+        cosmos_index,sep=matcher.match_nearest(cat['ra'],cat['dec'],
+                                               tol_arcsec=self.config['match_tol_arcsec'])
+        mask=cosmos_index>=0
+        cosmos_index_matched=cosmos_index[mask]
+        #Rows of the matched objects in the full COSMOS-30band file
+        cosmos_rows=lim_indices[cosmos_index_matched]
 
         ####
         # Get color-space weights
         print("Computing color-space weights")
-        train_sample=np.transpose(np.array([np.array(cat_matched['%scmodel_mag'%m]) for m in ['g','r','i','z','y']]))
-        train_z=np.array(cat_matched['PHOTOZ'])
-        photoz_sample=np.transpose(np.array([np.array(cat['%scmodel_mag'%m]) for m in ['g','r','i','z','y']]))
+        train_sample=np.transpose(np.array([np.array(cat['%scmodel_mag'%m])[mask] for m in self.bands]))
+        photoz_sample=np.transpose(np.array([np.array(cat['%scmodel_mag'%m]) for m in self.bands]))
 
-        #Find nearest neighbors in color space
-        n_nbrs=NearestNeighbors(n_neighbors=self.config['n_neighbors'],algorithm='kd_tree',
-                                metric='euclidean').fit(train_sample)
-        distances,_=n_nbrs.kneighbors(train_sample)
-        #Get maximum distance
-        distances=np.amax(distances,axis=1)
-        #Find all photo-z objects within this maximum distance for each COSMOS object
-        tree_NN_lookup = spatial.cKDTree(photoz_sample, leafsize=40)
-        num_photoz=np.array([len(tree_NN_lookup.query_ball_point(t,d+1E-6)) 
-                             for t,d in zip(train_sample,distances)])
-        #Weights are ratio of number of photo-z neighbors to COSMOS neighbors
-        #(normalized by the number of photo-z objects)
-        weights = np.true_divide(num_photoz*len(train_sample),self.config['n_neighbors']*len(photoz_sample))
+        #Estimate the photo-z/COSMOS density ratio in color space
+        dens=DensityRatio(train_sample,photoz_sample,workers=self.config['n_workers'],
+                          cache_dir=self.config['tree_cache_dir'])
+        if self.config['weight_estimator']=='radius_count' :
+            #Weights are ratio of number of photo-z neighbors to COSMOS neighbors
+            #(normalized by the number of photo-z objects)
+            weights,radius,num_photoz=dens.radius_count(self.config['n_neighbors'])
+        else :
+            weights=dens.get_weights(self.config['weight_estimator'],
+                                     n_neighbors=self.config['n_neighbors'],
+                                     kernel_width=self.config['kernel_width'])
         weights_tot=np.sum(weights)
         print(np.sum(weights))
 
+        if self.config['n_resamples']>0 :
+            print("Computing resampled weights")
+            #Training objects within the neighbor radius of each training object
+            neighbors=dens.get_train_neighbors(radius)
+            weights_resampled=get_resampled_weights(neighbors,num_photoz,len(photoz_sample),
+                                                    self.config['n_resamples'],
+                                                    kind=self.config['resampling'],
+                                                    seed=self.config['resampling_seed'])
+
         ####
         # Write output
-        keys_t1=['ALPHA_J2000','DELTA_J2000','gcmodel_mag','rcmodel_mag','icmodel_mag','zcmodel_mag','ycmodel_mag',
-              'pz_best_eab','pz_best_frz','pz_best_nnz','PHOTOZ', \
-              'MNUV', 'MU', 'MB', 'MV', 'MR', 'MI', 'MZ', 'MY', 'MJ', 'MH', 'MK']
-        t1=Table.from_pandas(pd.DataFrame(np.transpose([cat_matched[k] for k in keys_t1]),columns=keys_t1))
-        t2=Table.from_pandas(pd.DataFrame(np.transpose(weights), columns= ['weight']))
-        t3=Table.from_pandas(pd.DataFrame(np.transpose(cosmos_index_matched), columns= ['cosmos_index_matched']))
-        cat_weights=hstack([t1, t2, t3])
-        cat_weights.write(self.get_output('cosmos_weights'),overwrite=True)
+        #Matched columns are gathered one by one into a structured array, keeping
+        #their types, instead of copying the full matched catalogs
+        keys_cosmos=['ALPHA_J2000','DELTA_J2000']
+        keys_hsc=['%scmodel_mag'%m for m in self.bands]+['pz_best_eab','pz_best_frz','pz_best_nnz']
+        keys_cosmos_z=['PHOTOZ','MNUV','MU','MB','MV','MR','MI','MZ','MY','MJ','MH','MK']
+        columns=[(k,cat30[k][cosmos_rows]) for k in keys_cosmos]
+        columns+=[(k,np.asarray(cat[k])[mask]) for k in keys_hsc]
+        columns+=[(k,cat30[k][cosmos_rows]) for k in keys_cosmos_z]
+        columns+=[('weight',weights),('cosmos_index_matched',cosmos_index_matched.astype(np.int64))]
+        out=np.zeros(len(cosmos_index_matched),
+                     dtype=[(k,c.dtype) for k,c in columns])
+        for k,c in columns :
+            out[k]=c
+        hdus=[fits.PrimaryHDU(),fits.BinTableHDU(data=out)]
+        if self.config['n_resamples']>0 :
+            hdr=fits.Header()
+            hdr['RESAMPLE']=(self.config['resampling'],'Resampling method')
+            hdr['SEED']=(self.config['resampling_seed'],'Resampling seed')
+            hdus.append(fits.ImageHDU(data=weights_resampled,header=hdr))
+        fits.HDUList(hdus).writeto(self.get_output('cosmos_weights'),overwrite=True)
 
 if __name__ == '__main__':
     cls = PipelineStage.main()
@@ -0,0 +1,96 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from .tree_utils import get_tree
+
+class DensityRatio(object) :
+    estimators=['radius_count','knn_distance','gaussian']
+
+    def __init__(self,train,photo,workers=-1,cache_dir=None) :
+        """
+        Estimates the ratio between the densities of a photometric sample and a
+        training sample in colour (magnitude) space at the positions of the training objects.
+        These are the weights that make the training sample resemble the photometric one.
+        :param train: array with shape [n_train,n_dim] containing the training sample.
+        :param photo: array with shape [n_photo,n_dim] containing the photometric sample.
+        :param workers: number of threads used in tree queries (-1 for all cores).
+        :param cache_dir: directory where trees are cached (see `get_tree`).
+        """
+        self.train=np.ascontiguousarray(train,dtype=float)
+        self.photo=np.ascontiguousarray(photo,dtype=float)
+        self.n_train,self.n_dim=self.train.shape
+        self.n_photo=len(self.photo)
+        self.workers=workers
+        self.tree_train=get_tree(self.train,cache_dir=cache_dir)
+        self.tree_photo=get_tree(self.photo,cache_dir=cache_dir)
+
+    def get_knn_radius(self,n_neighbors) :
+        """
+        Distance from each training object to its `n_neighbors`-th nearest training
+        object (counting itself).
+        """
+        d,_=self.tree_train.query(self.train,k=n_neighbors,workers=self.workers)
+        return np.atleast_2d(d.T).T[:,-1]
+
+    def radius_count(self,n_neighbors=10) :
+        """
+        Counts photometric objects within the radius that contains the `n_neighbors`
+        nearest training neighbors of each training object.
+        :return: weights, neighbor radii and photometric counts within them.
+        """
+        radius=self.get_knn_radius(n_neighbors)+1E-6
+        num_photo=self.tree_photo.query_ball_point(self.train,radius,return_length=True,
+                                                   workers=self.workers)
+        weights=num_photo*self.n_train/(n_neighbors*float(self.n_photo))
+        return weights,radius,num_photo
+
+    def knn_distance(self,n_neighbors=10) :
+        """
+        Ratio of k-nearest-neighbor density estimates: (n_train/n_photo)*(r_train/r_photo)^D,
+        where r_train and r_photo are the distances to the `n_neighbors`-th nearest training
+        (excluding the object itself) and photometric objects.
+        """
+        r_train=self.get_knn_radius(n_neighbors+1)
+        d,_=self.tree_photo.query(self.train,k=n_neighbors,workers=self.workers)
+        r_photo=np.atleast_2d(d.T).T[:,-1]
+        return (self.n_train/float(self.n_photo))*(r_train/r_photo)**self.n_dim
+
+    def gaussian(self,kernel_width=0.1,n_sigma=4.) :
+        """
+        Ratio of Gaussian kernel density estimates with width `kernel_width`,
+        truncated at `n_sigma` times the width.
+        """
+        r_max=n_sigma*kernel_width
+        def kernel_sum(tree) :
+            d=self.tree_train.sparse_distance_matrix(tree,r_max,output_type='coo_matrix')
+            return np.bincount(d.row,weights=np.exp(-0.5*(d.data/kernel_width)**2),
+                               minlength=self.n_train)
+        #The training sum includes each object itself, so it is always >=1
+        return kernel_sum(self.tree_photo)*self.n_train/(kernel_sum(self.tree_train)*self.n_photo)
+
+    def get_weights(self,estimator='radius_count',n_neighbors=10,kernel_width=0.1) :
+        """
+        Computes the density ratio at the position of each training object.
+        :param estimator: 'radius_count', 'knn_distance' or 'gaussian'.
+        :param n_neighbors: number of neighbors (for 'radius_count' and 'knn_distance').
+        :param kernel_width: kernel width (for 'gaussian').
+        """
+        if estimator=='radius_count' :
+            return self.radius_count(n_neighbors)[0]
+        elif estimator=='knn_distance' :
+            return self.knn_distance(n_neighbors)
+        elif estimator=='gaussian' :
+            return self.gaussian(kernel_width)
+        else :
+            raise ValueError("Unknown density estimator "+estimator+
+                             ". Choose between "+", ".join(self.estimators))
+
+    def get_train_neighbors(self,radius) :
+        """
+        Returns a sparse matrix with A_ij=1 if training object j lies within
+        `radius[i]` of training object i.
+        """
+        nbr_lists=self.tree_train.query_ball_point(self.train,radius,workers=self.workers)
+        n_nbr=np.array([len(l) for l in nbr_lists])
+        indices=np.concatenate([np.array(l,dtype=int) for l in nbr_lists]+[np.zeros(0,dtype=int)])
+        return csr_matrix((np.ones(len(indices)),indices,np.concatenate([[0],np.cumsum(n_nbr)])),
+                          shape=(self.n_train,self.n_train))
@@ -1,5 +1,6 @@
 import numpy as np
 from .map_utils import createMeanStdMaps, createCountsMap
+from .stats_utils import get_groups, segment_median
 
 #############################################
 # code from Javier: /global/projecta/projectdirs/lsst/groups/LSS/DC1/scripts/map_utils.py
@@ -18,45 +19,40 @@ def binned_statistic(x, values, func, nbins, range):
     S = csr_matrix((values, [digitized, np.arange(N)]), shape=(nbins, N))
     return np.array([func(group) for group in np.split(S.data, S.indptr[1:-1])])
 
-def depth_map_snr_nonHP(ra, dec, mags, snr, snrthreshold, flatSkyGrid):
+def depth_map_snr_nonHP(ra, dec, mags, snr, snrthreshold, flatSkyGrid, nbins=30, mag_range=(22,28)):
     # not based on healpix, original version modified to use flatmaps
     # also added the functionality to add snr_threshold
-    good = np.logical_or(np.logical_not(np.isnan(ra)),np.logical_not(np.isnan(dec)))
     pix_nums = np.array(flatSkyGrid.pos2pix(ra, dec))
-    
-    map_out = np.zeros(flatSkyGrid.get_size())
-    map_var_out = np.zeros(flatSkyGrid.get_size())
-    mask_nans=np.zeros(flatSkyGrid.get_size());
-
-    #Binned statistic 2d is awfully slow (because it doesn't use the fact that all bins are equal width
-    #median_snr, xed, _, _ = binned_statistic_2d(mags,pix_nums,snr,statistic='median',bins=(50,12*nside**2),
-    #                                           range=[(20,30),(0,12*nside**2)])
-    #bin_centers = 0.5*xed[1:]+0.5*xed[:-1]
-    #depth = bin_centers[np.argmin(np.fabs(median_snr-5),axis=0)]
-    
-    bin_centers = np.linspace(22+6/30.,28-6/30.,30.)
-    for px in np.unique(pix_nums):
-        mask_nans[px]=1
-        mask = px==pix_nums
-        if np.count_nonzero(mask)>0:
-            median_snr = binned_statistic(mags[mask],snr[mask],np.nanmedian, nbins=30, range=(22,28))
-            std_snr = binned_statistic(mags[mask],snr[mask],np.nanstd, nbins=30, range=(22,28))
-            
-            mask2 = np.isnan(median_snr)==False
-            if np.count_nonzero(mask2)>0:
-                depth = bin_centers[mask2][np.argmin(np.fabs(median_snr[mask2]-snrthreshold))]
-                std = std_snr[np.argmin(np.fabs(median_snr[mask2]-snrthreshold))]
-                map_out[px]=depth
-                map_var_out[px]= std
-            else:
-                map_out[px]=0
-                map_var_out[px]= 0
-        else:
-            map_out[px]=0.
-            map_var_out[px]= 0
-
-    map_out[mask_nans<1]=0
-    map_var_out[mask_nans<1]=0
+    npix = flatSkyGrid.get_size()
+    r0, r1 = mag_range
+
+    map_out = np.zeros(npix)
+    map_var_out = np.zeros(npix)
+
+    #Group objects by (pixel, magnitude bin) and compute all S/N medians with a single sort
+    good = (mags > r0) & (mags < r1) & (~np.isnan(snr)) & (pix_nums >= 0)
+    digitized = (float(nbins) / (r1-r0) * (mags[good]-r0)).astype(int)
+    order, indptr, keys = get_groups(pix_nums[good]*nbins+digitized)
+    snr_good = snr[good][order]
+    median_snr = np.full(npix*nbins, np.nan)
+    median_snr[keys] = segment_median(snr_good, indptr)
+    median_snr = median_snr.reshape([npix, nbins])
+    group = np.repeat(np.arange(len(keys)), np.diff(indptr))
+    ncounts = np.diff(indptr)
+    snr_mean = np.bincount(group, weights=snr_good)/ncounts
+    snr_var = np.bincount(group, weights=snr_good**2)/ncounts-snr_mean**2
+    std_snr = np.full(npix*nbins, np.nan)
+    std_snr[keys] = np.sqrt(np.maximum(snr_var, 0))
+    std_snr = std_snr.reshape([npix, nbins])
+
+    #Magnitude bin whose median S/N is closest to the threshold
+    bin_centers = np.linspace(r0+(r1-r0)/nbins, r1-(r1-r0)/nbins, nbins)
+    diff = np.fabs(median_snr-snrthreshold)
+    diff[np.isnan(diff)] = np.inf
+    ibest = np.argmin(diff, axis=1)
+    has_bins = np.any(~np.isnan(median_snr), axis=1)
+    map_out[has_bins] = bin_centers[ibest[has_bins]]
+    map_var_out[has_bins] = std_snr[has_bins, ibest[has_bins]]
 
     return map_out, map_var_out
 
@@ -0,0 +1,188 @@
+import numpy as np
+import os
+from astropy.io import fits
+
+corner_names=[('llcra','llcdecl'),('ulcra','ulcdecl'),('urcra','urcdecl'),('lrcra','lrcdecl')]
+corner_columns=[c for cs in corner_names for c in cs]
+
+def get_corner_bounds(ras,decs) :
+    """
+    Computes the R.A./dec. bounding boxes of a set of frames given the coordinates of their corners.
+    Boxes crossing R.A.=0 are returned with ra_lo<0.
+    :param ras: array with shape [4,nframes] containing the R.A. of all frame corners.
+    :param decs: array with shape [4,nframes] containing the dec. of all frame corners.
+    :return: ra_lo,ra_hi,dec_lo,dec_hi
+    """
+    ras=np.mod(np.asarray(ras,dtype=float),360.)
+    decs=np.asarray(decs,dtype=float)
+    ra_lo=np.amin(ras,axis=0); ra_hi=np.amax(ras,axis=0)
+    #Unwrap boxes that cross R.A.=0
+    wrap=ra_hi-ra_lo>180.
+    if np.any(wrap) :
+        ras_w=ras[:,wrap]
+        ras_w[ras_w>180.]-=360.
+        ra_lo[wrap]=np.amin(ras_w,axis=0)
+        ra_hi[wrap]=np.amax(ras_w,axis=0)
+    return ra_lo,ra_hi,np.amin(decs,axis=0),np.amax(decs,axis=0)
+
+def get_field_bounds(fsk,npoints=128) :
+    """
+    Returns the R.A. and dec. ranges covered by a flat-sky map.
+    The ranges are padded by one pixel on each side.
+    :param fsk: flatmaps.FlatMapInfo object describing the map geometry.
+    :param npoints: number of points used to sample each edge of the map.
+    :return: [ra_lo,ra_hi],[dec_lo,dec_hi]
+    """
+    tx=np.linspace(0,fsk.nx,npoints); ty=np.linspace(0,fsk.ny,npoints)
+    ix=np.concatenate([tx,tx,np.zeros(npoints),fsk.nx*np.ones(npoints)])-0.5
+    iy=np.concatenate([np.zeros(npoints),fsk.ny*np.ones(npoints),ty,ty])-0.5
+    ra,dec=np.transpose(fsk.wcs.wcs_pix2world(np.transpose(np.array([ix,iy])),0))
+    ra_lo,ra_hi,dec_lo,dec_hi=get_corner_bounds(ra[:,None],dec[:,None])
+    pad=max(np.fabs(fsk.dx),np.fabs(fsk.dy))
+    return [ra_lo[0]-pad,ra_hi[0]+pad],[max(dec_lo[0]-pad,-90.),min(dec_hi[0]+pad,90.)]
+
+class FramesIndex(object) :
+    def __init__(self,ra_lo,ra_hi,dec_lo,dec_hi,cell_size=1.,signature=None) :
+        """
+        Spatial index of a frames metadata table.
+        Frames are described by the R.A./dec. bounding box of their corners, and are
+        sorted into declination strips of width `cell_size` so that only the frames in
+        the strips overlapping a given region need to be checked.
+        :param ra_lo,ra_hi,dec_lo,dec_hi: bounding boxes of all frames (in table order).
+        :param cell_size: width of the declination strips (in degrees).
+        :param signature: [size,mtime] of the frames file this index was built from.
+        """
+        self.ra_lo=np.asarray(ra_lo,dtype=float)
+        self.ra_hi=np.asarray(ra_hi,dtype=float)
+        self.dec_lo=np.asarray(dec_lo,dtype=float)
+        self.dec_hi=np.asarray(dec_hi,dtype=float)
+        self.nrows=len(self.ra_lo)
+        self.cell_size=cell_size
+        self.signature=signature
+
+        #Declination strips (each frame goes into all the strips it touches)
+        self.ncells=int(np.ceil(180./cell_size))
+        c_lo=self.get_cell(self.dec_lo)
+        c_hi=self.get_cell(self.dec_hi)
+        nc=c_hi-c_lo+1
+        rows=np.repeat(np.arange(self.nrows),nc)
+        offsets=np.arange(len(rows))-np.repeat(np.cumsum(nc)-nc,nc)
+        cells=np.repeat(c_lo,nc)+offsets
+        order=np.argsort(cells,kind='stable')
+        self.rows=rows[order]
+        self.indptr=np.concatenate([[0],np.cumsum(np.bincount(cells,minlength=self.ncells))])
+
+    def get_cell(self,dec) :
+        return np.clip(((np.asarray(dec)+90.)/self.cell_size).astype(int),0,self.ncells-1)
+
+    def query(self,ra_range,dec_range) :
+        """
+        Returns the (sorted) rows of all frames whose bounding box overlaps a given region.
+        :param ra_range: R.A. range [ra_lo,ra_hi] (ra_lo may be negative if the region crosses R.A.=0).
+        :param dec_range: dec. range [dec_lo,dec_hi].
+        """
+        c_lo,c_hi=self.get_cell(dec_range)
+        rows=np.unique(self.rows[self.indptr[c_lo]:self.indptr[c_hi+1]])
+        is_in=(self.dec_lo[rows]<=dec_range[1]) & (self.dec_hi[rows]>=dec_range[0])
+        in_ra=np.zeros(len(rows),dtype=bool)
+        for shift in [-360.,0.,360.] :
+            in_ra|=(self.ra_lo[rows]+shift<=ra_range[1]) & (self.ra_hi[rows]+shift>=ra_range[0])
+        return rows[is_in & in_ra]
+
+    def write(self,fname) :
+        """
+        Saves the index to a numpy file.
+        """
+        np.savez(fname,ra_lo=self.ra_lo,ra_hi=self.ra_hi,dec_lo=self.dec_lo,dec_hi=self.dec_hi,
+                 cell_size=self.cell_size,signature=self.signature)
+
+    @classmethod
+    def from_file(FramesIndex,fname) :
+        """
+        Reads an index written with `write`.
+        """
+        d=np.load(fname)
+        return FramesIndex(d['ra_lo'],d['ra_hi'],d['dec_lo'],d['dec_hi'],
+                           cell_size=float(d['cell_size']),signature=list(d['signature']))
+
+    @classmethod
+    def from_frames(FramesIndex,fname,cell_size=1.) :
+        """
+        Builds the index from a frames FITS file.
+        """
+        data=fits.open(fname,memmap=True)[1].data
+        ras=np.array([data[cra] for cra,_ in corner_names])
+        decs=np.array([data[cdec] for _,cdec in corner_names])
+        ra_lo,ra_hi,dec_lo,dec_hi=get_corner_bounds(ras,decs)
+        return FramesIndex(ra_lo,ra_hi,dec_lo,dec_hi,cell_size=cell_size,
+                           signature=get_file_signature(fname))
+
+def get_file_signature(fname) :
+    st=os.stat(fname)
+    return [st.st_size,st.st_mtime]
+
+def get_frames_index(fname_frames,fname_index=None,cell_size=1.) :
+    """
+    Returns the spatial index of a frames file, reading it from its sidecar file if available
+    and up to date, or building (and storing) it otherwise.
+    :param fname_frames: path to the frames FITS file.
+    :param fname_index: path to the index sidecar. If None, `fname_frames`+'.index.npz' will be used.
+    :param cell_size: width of the index declination strips (in degrees).
+    """
+    if fname_index is None :
+        fname_index=fname_frames+'.index.npz'
+
+    if os.path.isfile(fname_index) :
+        idx=FramesIndex.from_file(fname_index)
+        if (idx.signature==get_file_signature(fname_frames)) and (idx.cell_size==cell_size) :
+            return idx
+        print("Frames index is out of date")
+
+    print("Building frames index")
+    idx=FramesIndex.from_frames(fname_frames,cell_size=cell_size)
+    try :
+        #Write to a temporary file first, in case several fields are being run at the same time
+        fname_tmp=fname_index+'.%d.npz'%os.getpid()
+        idx.write(fname_tmp)
+        os.replace(fname_tmp,fname_index)
+    except OSError :
+        print("Could not save frames index to "+fname_index)
+    return idx
+
+def read_frames(fname,columns,rows=None,selection=None,chunk_size=100000) :
+    """
+    Reads a subset of the columns of a frames FITS file in chunks, keeping only
+    the frames that pass a given selection, so that the full table is never
+    loaded into memory.
+    :param fname: path to the frames FITS file.
+    :param columns: list of columns to read.
+    :param rows: rows to read (all rows if None).
+    :param selection: function taking a chunk of frames (a structured array) and returning
+        a boolean mask of the frames to keep. If None, all frames are kept.
+    :param chunk_size: number of rows read at a time.
+    :return: structured array containing the selected frames.
+    """
+    hdul=fits.open(fname,memmap=True)
+    data=hdul[1].data
+    if rows is None :
+        nrows=len(data)
+    else :
+        rows=np.asarray(rows,dtype=int)
+        nrows=len(rows)
+
+    chunks=[]
+    for i0 in range(0,max(nrows,1),chunk_size) :
+        i1=min(i0+chunk_size,nrows)
+        if rows is None :
+            sl=slice(i0,i1)
+        else :
+            sl=rows[i0:i1]
+        cols=[np.array(data.field(c)[sl]) for c in columns]
+        chunk=np.zeros(len(cols[0]),dtype=[(c,col.dtype) for c,col in zip(columns,cols)])
+        for c,col in zip(columns,cols) :
+            chunk[c]=col
+        if selection is not None :
+            chunk=chunk[selection(chunk)]
+        chunks.append(chunk)
+    hdul.close()
+    return np.concatenate(chunks)
@@ -2,7 +2,7 @@ from ceci import PipelineStage
 from .types import FitsFile,ASCIIFile,DirFile
 import numpy as np
 from .flatmaps import read_flat_map, compare_infos
-from scipy.stats import binned_statistic
+from .stats_utils import segment_median
 from astropy.io import fits
 import matplotlib.pyplot as plt
 import os
@@ -15,11 +15,32 @@ class MapDiagnoser(PipelineStage) :
             ('skylevel_maps',FitsFile),('sigma_sky_maps',FitsFile),('seeing_maps',FitsFile),
             ('ellipt_maps',FitsFile),('nvisit_maps',FitsFile)]
     outputs=[('systmap_plots',DirFile)]
-    config_options={'nbins_syst':10, 'n_jk':50}
+    config_options={'nbins_syst':10, 'n_jk':50, 'syst_statistic':'mean'}
+
+    def binned_stat(self,ibin,vals,keep=None):
+        """
+        Computes the mean or median (depending on `syst_statistic`) of a set of values in bins.
+        :param ibin: bin index of each value. For medians, values must be sorted by bin and value.
+        :param vals: values.
+        :param keep: mask selecting the values to use (all values if None).
+        """
+        nbins=self.config['nbins_syst']
+        if keep is not None:
+            ibin=ibin[keep]; vals=vals[keep]
+        counts=np.bincount(ibin,minlength=nbins)
+        if self.config['syst_statistic']=='median':
+            indptr=np.concatenate([[0],np.cumsum(counts)])
+            return segment_median(vals,indptr,sorted_values=True)
+        stat=np.full(nbins,np.nan)
+        good=counts>0
+        stat[good]=np.bincount(ibin,weights=vals,minlength=nbins)[good]/counts[good]
+        return stat
 
     def compute_stats(self,ng_map,sys_map):
         mask=self.mskfrac*self.msk_bi
         binmask=mask>0
+        nbins=self.config['nbins_syst']
+        n_jk=self.config['n_jk']
 
         # N_g/<N_g>
         ng_mean=np.sum(ng_map[binmask])/np.sum(mask[binmask])
@@ -28,23 +49,42 @@ class MapDiagnoser(PipelineStage) :
         sys_mean=np.mean(sys_map[binmask])
         sys_use=sys_map[binmask]/sys_mean
 
-        # Compute mean number density as a function of systematic
-        mean, bin_edges, _  = binned_statistic(sys_use, ng_use, statistic='mean',
-                                               bins=self.config['nbins_syst'])
+        # Equal-width bins spanning the range of the systematic
+        s_min=np.amin(sys_use); s_max=np.amax(sys_use)
+        if s_min==s_max:
+            s_min-=0.5; s_max+=0.5
+        bin_edges=np.linspace(s_min,s_max,nbins+1)
         bin_centers = 0.5*(bin_edges[1:]+bin_edges[:-1])
+        ibin=np.minimum(((sys_use-s_min)*nbins/(s_max-s_min)).astype(int),nbins-1)
+        # Jackknife chunk of each pixel (leftover pixels are never removed)
+        djk = len(sys_use) // n_jk
+        if djk>0:
+            ijk=np.arange(len(sys_use))//djk
+        else:
+            ijk=np.full(len(sys_use),n_jk)
+        if self.config['syst_statistic']=='median':
+            # Sort once: removing pixels keeps the values sorted within each bin
+            order=np.lexsort((ng_use,ibin))
+            ibin=ibin[order]; ng_use=ng_use[order]; ijk=ijk[order]
+
+        # Compute number density as a function of systematic
+        mean=self.binned_stat(ibin,ng_use)
 
         # Compute uncertainties through jackknife
-        means = np.zeros([self.config['n_jk'], self.config['nbins_syst']])
-        djk = len(sys_use) // self.config['n_jk']
-        for j in range(self.config['n_jk']):
-            jk_mask = np.ones(len(sys_use), dtype=bool)
-            # Remove chunk
-            jk_mask[j*djk:(j+1)*djk] = False
-            means[j,:], _, _ = binned_statistic(sys_use[jk_mask],
-                                                ng_use[jk_mask],
-                                                statistic='mean',
-                                                bins=bin_edges)
-        err = np.std(means, axis=0) * np.sqrt(self.config['n_jk']-1.)
+        if self.config['syst_statistic']=='median':
+            means=np.array([self.binned_stat(ibin,ng_use,keep=ijk!=j) for j in range(n_jk)])
+        else:
+            # Remove each chunk's contribution from the totals
+            in_jk=ijk<n_jk
+            ig=ijk[in_jk]*nbins+ibin[in_jk]
+            n_tot=np.bincount(ibin,minlength=nbins)
+            s_tot=np.bincount(ibin,weights=ng_use,minlength=nbins)
+            n_jkb=n_tot[None,:]-np.bincount(ig,minlength=n_jk*nbins).reshape([n_jk,nbins])
+            s_jkb=s_tot[None,:]-np.bincount(ig,weights=ng_use[in_jk],
+                                            minlength=n_jk*nbins).reshape([n_jk,nbins])
+            means=np.full([n_jk,nbins],np.nan)
+            means[n_jkb>0]=s_jkb[n_jkb>0]/n_jkb[n_jkb>0]
+        err = np.std(means, axis=0) * np.sqrt(n_jk-1.)
 
         return bin_centers, bin_centers*sys_mean, mean, err
 
@@ -58,6 +98,8 @@ class MapDiagnoser(PipelineStage) :
             self.sys_map_offset=2
         else:
             raise ValueError('Systematic map flattening mode %s unknown. Use \'average\' or \'median\''%(self.config['sys_collapse_type']))
+        if self.config['syst_statistic'] not in ['mean','median']:
+            raise ValueError('Binned statistic %s unknown. Use \'mean\' or \'median\''%(self.config['syst_statistic']))
         self.xlabels = {'airmass' : 'Airmass',
                         'ccdtemp' : r'CCD Temperature [$^{\circ}$C]',
                         'ellipt' : 'PSF Ellipticity',
@@ -0,0 +1,81 @@
+import os
+import hashlib
+import numpy as np
+
+def get_nmt_version() :
+    """
+    Returns the version of the installed NaMaster package.
+    """
+    try :
+        from importlib.metadata import version
+        return version('pymaster')
+    except Exception :
+        import pymaster as nmt
+        return getattr(nmt,'__version__','unknown')
+
+def get_hash(*items) :
+    """
+    Returns a hash of a set of items (numpy arrays, strings or numbers).
+    Arrays are hashed through their type, shape and contents.
+    """
+    h=hashlib.sha1()
+    for it in items :
+        if isinstance(it,np.ndarray) :
+            arr=np.ascontiguousarray(it)
+            h.update(str((arr.dtype.str,arr.shape)).encode())
+            h.update(arr.tobytes())
+        else :
+            h.update(repr(it).encode())
+        h.update(b'|')
+    return h.hexdigest()
+
+class ProductCache(object) :
+    def __init__(self,cache_dir) :
+        """
+        Content-addressed cache of expensive products (e.g. mode-coupling matrices).
+        Each product is stored in a file whose name contains a hash of all the inputs
+        it depends on, so that products are only reused if these inputs are identical,
+        and the same cache can be shared by different runs.
+        :param cache_dir: directory where products are stored.
+        """
+        self.cache_dir=cache_dir
+        os.makedirs(cache_dir,exist_ok=True)
+
+    def get_fname(self,name,key,ext) :
+        return os.path.join(self.cache_dir,name+'_'+key+'.'+ext)
+
+    def contains(self,name,key,ext) :
+        return os.path.isfile(self.get_fname(name,key,ext))
+
+    def put(self,name,key,ext,product,write) :
+        """
+        Stores a product.
+        :param write: function that writes the product (first argument) into a file name.
+        """
+        fname=self.get_fname(name,key,ext)
+        #Write to a temporary file first, so that concurrent runs never read partial files
+        fname_tmp=fname[:-len(ext)-1]+'.tmp%d.'%os.getpid()+ext
+        write(product,fname_tmp)
+        os.replace(fname_tmp,fname)
+
+    def get(self,name,key,ext,compute,read,write,descr=None) :
+        """
+        Returns a cached product, computing and storing it if not present.
+        :param name: product name.
+        :param key: hash of the inputs of this product (see `get_hash`).
+        :param ext: file extension.
+        :param compute: function with no arguments that computes the product.
+        :param read: function that reads the product from a file name.
+        :param write: function that writes the product (first argument) into a file name.
+        :param descr: description of the product printed when computing or reading it.
+        """
+        if descr is None :
+            descr=name
+        if self.contains(name,key,ext) :
+            print("Reading "+descr)
+            return read(self.get_fname(name,key,ext))
+
+        print("Computing "+descr)
+        product=compute()
+        self.put(name,key,ext,product,write)
+        return product
@@ -1,66 +1,116 @@
 import numpy as np
+from .stats_utils import segment_percentile
 
 class ObsCond(object):
-    def __init__(self,name,nx,ny,cutoff=-9999.) :
+    def __init__(self,name,nx,ny,cutoff=-9999.,nthreads=1) :
         """
         Observing condition object.
         :param name: name of the OC.
-        :param data: list of OC values
         :param nx,ny: dimensionality of the output map
         :param cutoff: remove all data below the cutoff.
+        :param nthreads: number of threads used to compute percentiles.
         """
         self.name=name
         self.cutoff=cutoff
+        self.nthreads=nthreads
         self.npix=nx*ny
 
-        #Extra space at the end
-        self.vmap=[[] for i in range(nx*ny)]
-        self.wmap=[[] for i in range(nx*ny)]
+        self.ipix=[]
+        self.vals=[]
+        self.wgts=[]
         self.completed=False
 
     def add_frame(self,ipixs,val,weights):
+        """
+        Adds a single frame.
+        :param ipixs: indices of the pixels touched by the frame.
+        :param val: value of the OC for this frame.
+        :param weights: weight of the frame in each pixel.
+        """
+        self.add_frames(ipixs,np.full(len(ipixs),val),weights)
+
+    def add_frames(self,ipixs,vals,weights):
+        """
+        Adds a set of frame-pixel overlaps.
+        :param ipixs: pixel index of each overlap.
+        :param vals: value of the OC for the frame in each overlap.
+        :param weights: weight of each overlap.
+        """
         if self.completed:
             raise ValueError("I thought I was done!")
 
-        if val>self.cutoff:
-            for ip,w in zip(ipixs,weights):
-                self.vmap[ip].append(val)
-                self.wmap[ip].append(w)
+        ipixs=np.asarray(ipixs,dtype=int)
+        vals=np.asarray(vals,dtype=float)
+        weights=np.asarray(weights,dtype=float)
+        keep=(vals>self.cutoff) & (weights>0)
+        self.ipix.append(ipixs[keep])
+        self.vals.append(vals[keep])
+        self.wgts.append(weights[keep])
 
     def complete_map(self):
-        for ip,(v,w) in enumerate(zip(self.vmap,self.wmap)):
-            self.vmap[ip]=np.array(v)
-            self.wmap[ip]=np.array(w)
+        """
+        Sorts all overlaps by pixel and value and computes the per-pixel sums
+        used by all the map statistics.
+        """
+        ipix=np.concatenate(self.ipix+[np.zeros(0,dtype=int)])
+        vals=np.concatenate(self.vals+[np.zeros(0)])
+        wgts=np.concatenate(self.wgts+[np.zeros(0)])
+        order=np.lexsort((vals,ipix))
+        self.pmap=ipix[order]
+        self.vmap=vals[order]
+        self.wmap=wgts[order]
+        self.ipix=None; self.vals=None; self.wgts=None
 
-    def collapse_map_mean(self):
-        map_out=np.zeros(self.npix)
+        self.indptr=np.concatenate([[0],np.cumsum(np.bincount(self.pmap,minlength=self.npix))])
+        self.w_sum=np.bincount(self.pmap,weights=self.wmap,minlength=self.npix)
+        self.wv_sum=np.bincount(self.pmap,weights=self.wmap*self.vmap,minlength=self.npix)
+        self.wv2_sum=np.bincount(self.pmap,weights=self.wmap*self.vmap**2,minlength=self.npix)
+        self.goodpix=self.w_sum>0
+        self.completed=True
 
-        for ip,(v,w) in enumerate(zip(self.vmap,self.wmap)):
-            wt=np.sum(w)
-            if wt>0:
-                map_out[ip]=np.sum(v*w)/wt
-            else:
-                map_out[ip]=-9999.
+    def collapse_map_mean(self):
+        map_out=-9999.*np.ones(self.npix)
+        map_out[self.goodpix]=self.wv_sum[self.goodpix]/self.w_sum[self.goodpix]
         return map_out
 
     def collapse_map_std(self):
-        map_out=np.zeros(self.npix)
-
-        for ip,(v,w) in enumerate(zip(self.vmap,self.wmap)):
-            wt=np.sum(w)
-            if wt>0:
-                map_out[ip]=np.sum(v**2*w)/wt-(np.sum(v*w)/wt)**2
-            else:
-                map_out[ip]=-9999.
+        map_out=-9999.*np.ones(self.npix)
+        mean=self.wv_sum[self.goodpix]/self.w_sum[self.goodpix]
+        var=self.wv2_sum[self.goodpix]/self.w_sum[self.goodpix]-mean**2
+        map_out[self.goodpix]=np.sqrt(np.maximum(var,0))
         return map_out
 
     def collapse_map_median(self):
-        map_out=np.zeros(self.npix)
+        return self.collapse_map_percentile(50.)
 
-        for ip,(v,w) in enumerate(zip(self.vmap,self.wmap)):
-            wt=np.sum(w)
-            if wt>0:
-                map_out[ip]=np.median(v)
-            else:
-                map_out[ip]=-9999.
+    def collapse_map_percentile(self,q):
+        """
+        Weighted percentile of the OC in each pixel.
+        :param q: percentile (between 0 and 100).
+        """
+        map_out=segment_percentile(self.vmap,self.indptr,q,weights=self.wmap,
+                                   sorted_values=True,nthreads=self.nthreads)
+        map_out[~self.goodpix]=-9999.
         return map_out
+
+    def collapse_map_min(self):
+        map_out=-9999.*np.ones(self.npix)
+        map_out[self.goodpix]=self.vmap[self.indptr[:-1][self.goodpix]]
+        return map_out
+
+    def collapse_map_max(self):
+        map_out=-9999.*np.ones(self.npix)
+        map_out[self.goodpix]=self.vmap[self.indptr[1:][self.goodpix]-1]
+        return map_out
+
+    def collapse_map(self,stat):
+        """
+        Computes a map of a given statistic of the OC.
+        :param stat: 'mean', 'std', 'median', 'min', 'max' or 'pXX' (XX-th percentile).
+        """
+        if stat in ['mean','std','median','min','max']:
+            return getattr(self,'collapse_map_'+stat)()
+        elif stat.startswith('p'):
+            return self.collapse_map_percentile(float(stat[1:]))
+        else:
+            raise KeyError("Unknown statistic "+stat)
@@ -0,0 +1,197 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+import pymaster as nmt
+from .template_basis import TemplateBasis
+from .pool_utils import limit_omp_threads
+
+class SharedArrays(object) :
+    def __init__(self,arrays,use_files=True) :
+        """
+        Stores a set of arrays as files in a temporary directory (in /dev/shm if available)
+        that worker processes can memory-map, so that large maps are shared instead of
+        being pickled into each task. Use as a context manager to remove the files.
+        :param arrays: dictionary of numpy arrays.
+        :param use_files: if False (e.g. when all tasks run in this process), the arrays
+            are not copied, and `sources` contains the arrays themselves.
+        """
+        self.tmpdir=None
+        if not use_files :
+            self.sources=dict(arrays)
+            return
+        shm_dir='/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.tmpdir=tempfile.mkdtemp(prefix='hsc_lss_',dir=shm_dir)
+        self.sources={}
+        for name,arr in arrays.items() :
+            self.sources[name]=os.path.join(self.tmpdir,name+'.npy')
+            np.save(self.sources[name],np.ascontiguousarray(arr))
+
+    def close(self) :
+        if self.tmpdir is not None :
+            shutil.rmtree(self.tmpdir,ignore_errors=True)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self,*args) :
+        self.close()
+
+#Shared arrays and fields available in each worker process
+_worker={}
+
+def init_pair_worker(sources,fsk,lini,lend,workspaces=None,n_threads=None) :
+    """
+    Worker initializer for pair tasks.
+    :param sources: file names of the shared arrays, or the arrays themselves (see
+        `SharedArrays`). These should contain the overdensity maps ('delta', with shape
+        [nbins,npix]), the mask ('mask') and, if contaminants are deprojected, the masked
+        templates ('temp_masked') and the inverse of their Gram matrix ('matrix_M').
+    :param fsk: flatmaps.FlatSkyInfo object defining the geometry of the maps.
+    :param lini,lend: bandpower edges.
+    :param workspaces: optional paths to the mode-coupling and covariance mode-coupling
+        workspace files, read the first time they are needed.
+    :param n_threads: maximum number of OpenMP threads used by NaMaster in this worker
+        (see `pool_utils.get_worker_threads`). None to leave it unchanged.
+    """
+    if n_threads is not None :
+        limit_omp_threads(n_threads)
+    _worker.clear()
+    _worker['arrays']={n:np.load(f,mmap_mode='r') if isinstance(f,str) else f
+                       for n,f in sources.items()}
+    _worker['fsk']=fsk
+    _worker['bpws']=nmt.NmtBinFlat(lini,lend)
+    _worker['fields']={}
+    _worker['basis']=None
+    _worker['workspace_fnames']=workspaces
+    _worker['workspaces']=None
+
+def get_worker_workspaces() :
+    if _worker['workspaces'] is None :
+        fname_mcm,fname_cov_mcm=_worker['workspace_fnames']
+        wsp=nmt.NmtWorkspaceFlat()
+        wsp.read_from(fname_mcm)
+        cwsp=nmt.NmtCovarianceWorkspaceFlat()
+        cwsp.read_from(fname_cov_mcm)
+        _worker['workspaces']=(wsp,cwsp)
+    return _worker['workspaces']
+
+def get_worker_basis() :
+    if _worker['basis'] is None :
+        a=_worker['arrays']
+        _worker['basis']=TemplateBasis.from_arrays(_worker['fsk'],np.array(a['mask']),
+                                                   np.array(a['temp_masked']),
+                                                   np.array(a['matrix_M']))
+    return _worker['basis']
+
+def get_worker_field(i_bin,deproject) :
+    """
+    Returns the NaMaster field of the `i_bin`-th map (with or without contaminant
+    deprojection), building it the first time it is needed in this worker.
+    """
+    key=(i_bin,deproject)
+    if key not in _worker['fields'] :
+        fsk=_worker['fsk']
+        delta=np.array(_worker['arrays']['delta'][i_bin])
+        if deproject :
+            field=get_worker_basis().get_field(delta)
+        else :
+            field=nmt.NmtFieldFlat(np.radians(fsk.lx),np.radians(fsk.ly),
+                                   np.array(_worker['arrays']['mask']).reshape([fsk.ny,fsk.nx]),
+                                   [delta.reshape([fsk.ny,fsk.nx])])
+        _worker['fields'][key]=field
+    return _worker['fields'][key]
+
+def coupled_cell_task(task) :
+    """
+    Computes the coupled power spectrum of a pair of maps.
+    :param task: tuple (i,j,deproject).
+    """
+    i,j,deproject=task
+    return nmt.compute_coupled_cell_flat(get_worker_field(i,deproject),
+                                         get_worker_field(j,deproject),
+                                         _worker['bpws'])[0]
+
+def dpj_bias_task(task) :
+    """
+    Computes the deprojection bias of a pair of maps.
+    :param task: tuple (lth,clth) containing the guess power spectrum of this pair.
+    """
+    lth,clth=task
+    tf=get_worker_basis().template_field
+    return nmt.deprojection_bias_flat(tf,tf,_worker['bpws'],lth,[clth])[0]
+
+def gaussian_sim_task(task) :
+    """
+    Generates a batch of Gaussian simulations and computes the coupled power spectra
+    of all pairs of maps in each of them. The guess power spectra used to generate them
+    should be stored in the shared array 'clth'.
+    :param task: tuple (isim_start,isim_end,nbins,deproject). Simulation `isim` uses
+        seed 1000+isim, so results do not depend on how simulations are split.
+    :return: array with shape [n_sims,n_pairs,n_bandpowers].
+    """
+    isim_start,isim_end,nbins,deproject=task
+    fsk=_worker['fsk']
+    clth=np.array(_worker['arrays']['clth'])
+    mask=np.array(_worker['arrays']['mask']).reshape([fsk.ny,fsk.nx])
+    cls=[]
+    for isim in range(isim_start,isim_end) :
+        mps=nmt.synfast_flat(fsk.nx,fsk.ny,np.radians(fsk.lx),np.radians(fsk.ly),
+                             clth,np.zeros(nbins),seed=1000+isim)
+        if deproject :
+            flds=[get_worker_basis().get_field(m) for m in mps]
+        else :
+            flds=[nmt.NmtFieldFlat(np.radians(fsk.lx),np.radians(fsk.ly),mask,[m]) for m in mps]
+        cls.append([nmt.compute_coupled_cell_flat(flds[i],flds[j],_worker['bpws'])[0]
+                    for i in range(nbins) for j in range(i,nbins)])
+    return np.array(cls)
+
+def noise_sim_task(task) :
+    """
+    Generates a batch of Poisson-noise realizations of a galaxy number counts map and
+    computes their coupled power spectra. Each realization distributes all galaxies over
+    the unmasked pixels with a single multinomial draw (with probabilities proportional
+    to the mask), and the overdensity maps of the whole batch are computed at once.
+    The mask, binary mask and masked fraction should be stored in the shared arrays 'mask',
+    'mask_binary' and 'masked_fraction'.
+    :param task: tuple (seeds,ngal) with the seed of each realization and the number of galaxies.
+    :return: array with shape [n_sims,n_bandpowers].
+    """
+    seeds,ngal=task
+    fsk=_worker['fsk']
+    a=_worker['arrays']
+    mask=np.array(a['mask'])
+    mask_binary=np.array(a['mask_binary'])
+    masked_fraction=np.array(a['masked_fraction'])
+    ipix=np.where(mask!=0)[0]
+    p=mask[ipix]/np.sum(mask[ipix])
+    goodpix=np.where(mask_binary>0.1)[0]
+
+    #Number counts of all realizations
+    nmaps=np.zeros([len(seeds),len(mask)])
+    for i_s,seed in enumerate(seeds) :
+        nmaps[i_s,ipix]=np.random.default_rng(seed).multinomial(ngal,p)
+    ndens=np.dot(nmaps,mask_binary)/np.sum(mask)
+    deltas=np.zeros_like(nmaps)
+    deltas[:,goodpix]=nmaps[:,goodpix]/(ndens[:,None]*masked_fraction[None,goodpix])-1
+
+    cls=[]
+    for d in deltas :
+        f0=nmt.NmtFieldFlat(np.radians(fsk.lx),np.radians(fsk.ly),mask.reshape([fsk.ny,fsk.nx]),
+                            [d.reshape([fsk.ny,fsk.nx])])
+        cls.append(nmt.compute_coupled_cell_flat(f0,f0,_worker['bpws'])[0])
+    return np.array(cls)
+
+def covar_block_task(task) :
+    """
+    Computes one block of the analytic Gaussian covariance. The multipoles and guess
+    power spectra should be stored in the shared arrays 'lth' and 'clth'.
+    :param task: tuple with the indices of the spectra (a1b1,a2b2,a1b2,a2b1) in 'clth'.
+    """
+    i_a1b1,i_a2b2,i_a1b2,i_a2b1=task
+    wsp,cwsp=get_worker_workspaces()
+    lth=np.array(_worker['arrays']['lth'])
+    clth=_worker['arrays']['clth']
+    return nmt.gaussian_covariance_flat(cwsp,0,0,0,0,lth,
+                                        [np.array(clth[i_a1b1])],[np.array(clth[i_a1b2])],
+                                        [np.array(clth[i_a2b1])],[np.array(clth[i_a2b2])],wsp)
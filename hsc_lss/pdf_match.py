@@ -1,112 +1,325 @@
 from ceci import PipelineStage
 from .types import FitsFile,ASCIIFile
-from astropy.table import Table
 import numpy as np
 from astropy.io import fits
 import os
-import pandas as pd
+import io
+import hashlib
+from .pool_utils import pool_map
+from .pdf_utils import encode_pdfs, write_pdfs, check_pdf_encoding, pdf_encodings, pdf_qmax, PDFReader
+
+def match_ids(ids,ids_sorted) :
+    """
+    Finds the positions of a set of IDs in a sorted array of IDs.
+    :param ids: IDs to look for.
+    :param ids_sorted: sorted array of IDs.
+    :return: boolean array flagging the elements of `ids` that were found, and
+        positions of the found elements in `ids_sorted`.
+    """
+    ids=np.asarray(ids,dtype=np.int64)
+    pos=np.searchsorted(ids_sorted,ids,side='right')-1
+    found=pos>=0
+    found[found]=ids_sorted[pos[found]]==ids[found]
+    return found,pos[found]
+
+#Sorted catalog IDs, shared with the patch-reading processes
+_ids_cat_sorted=None
+
+def _init_patch_reader(ids_cat_sorted) :
+    global _ids_cat_sorted
+    _ids_cat_sorted=ids_cat_sorted
+
+def match_patch_pdfs(hdul,encoding) :
+    """
+    Matches the pdfs stored in an open patch file to the catalog.
+    :param hdul: patch file HDU list.
+    :param encoding: pdf encoding.
+    :return: redshift bins, positions of the matched objects in the sorted catalog IDs
+        (in ascending order), their encoded pdfs and per-object scales
+        (see `pdf_utils.encode_pdfs`) and number of pdfs read.
+    """
+    bins=np.array(hdul[2].data.field(0))
+    ids=hdul[1].data['ID']
+    found,pos=match_ids(ids,_ids_cat_sorted)
+    pdfs=np.array(hdul[1].data['PDF'][found],dtype=np.float32)
+    #Sort by ID, keeping the last entry of repeated objects
+    order=np.argsort(pos,kind='stable')
+    pos=pos[order]; pdfs=pdfs[order]
+    last=np.append(pos[1:]!=pos[:-1],True)
+    pdfs,scale=encode_pdfs(pdfs[last],encoding)
+    return bins,pos[last],pdfs,scale,len(ids)
+
+def get_checksum(source) :
+    """
+    Returns the SHA1 checksum of a file (if `source` is a path) or of a bytes object.
+    """
+    h=hashlib.sha1()
+    if isinstance(source,bytes) :
+        h.update(source)
+    else :
+        with open(source,'rb') as f :
+            for block in iter(lambda : f.read(1<<24),b'') :
+                h.update(block)
+    return h.hexdigest()
+
+def match_patch(source,encoding,cache_dir=None) :
+    """
+    Matches the pdfs in a patch file to the catalog, using cached results if available.
+    Cached results are keyed by the checksum of the patch file and a hash of the catalog
+    IDs found in it, so that the patch is only decoded again if either of them changes.
+    :param source: path to the patch file, or its contents as a bytes object.
+    :param encoding: pdf encoding.
+    :param cache_dir: cache directory (no caching if None).
+    :return: outputs of `match_patch_pdfs`.
+    """
+    def open_patch() :
+        if isinstance(source,bytes) :
+            return fits.open(io.BytesIO(source))
+        return fits.open(source)
+
+    if cache_dir is None :
+        hdul=open_patch()
+        result=match_patch_pdfs(hdul,encoding)
+        hdul.close()
+        return result
+
+    def get_match_fname(pos) :
+        key=hashlib.sha1(_ids_cat_sorted[pos].tobytes()).hexdigest()
+        return os.path.join(cache_dir,'%s_%s_%s.npz'%(checksum,key,encoding))
+
+    checksum=get_checksum(source)
+    fname_ids=os.path.join(cache_dir,checksum+'_ids.npy')
+    if os.path.isfile(fname_ids) :
+        found,pos=match_ids(np.load(fname_ids),_ids_cat_sorted)
+        fname_match=get_match_fname(np.unique(pos))
+        if os.path.isfile(fname_match) :
+            d=np.load(fname_match)
+            scale=d['scale'] if encoding in pdf_qmax else None
+            return d['bins'],np.unique(pos),d['pdfs'],scale,int(d['n_read'])
+
+    hdul=open_patch()
+    ids=np.array(hdul[1].data['ID'],dtype=np.int64)
+    bins,pos,pdfs,scale,n_read=match_patch_pdfs(hdul,encoding)
+    hdul.close()
+    #Write to temporary files first, in case the run is interrupted
+    fname_tmp=os.path.join(cache_dir,'tmp_%d_%s'%(os.getpid(),checksum))
+    np.save(fname_tmp+'.npy',ids)
+    os.replace(fname_tmp+'.npy',fname_ids)
+    np.savez(fname_tmp+'.npz',bins=bins,pdfs=pdfs,n_read=n_read,
+             scale=scale if scale is not None else np.zeros(0))
+    os.replace(fname_tmp+'.npz',get_match_fname(pos))
+    return bins,pos,pdfs,scale,n_read
+
+def read_patch_pdfs(task) :
+    """
+    Reads the pdfs stored in a patch file and matches them to the catalog.
+    :param task: tuple (photo-z code, path to patch file, pdf encoding, cache directory).
+    :return: photo-z code, path to patch file and the outputs of `match_patch_pdfs`.
+    """
+    alg,fname,encoding,cache_dir=task
+    bins,pos,pdfs,scale,n_read=match_patch(fname,encoding,cache_dir)
+    return alg,fname,bins,pos,pdfs,scale,n_read
+
+def read_tar_pdfs(task) :
+    """
+    Reads the pdfs stored in all the patch files contained in a tar archive (as
+    distributed in the HSC data release) and matches them to the catalog.
+    The archive is read sequentially, holding one patch file in memory at a time.
+    :param task: tuple (photo-z code, path to archive, pdf encoding, cache directory).
+    :return: same as `read_patch_pdfs`, merging all patches (later patches
+        take precedence for repeated objects).
+    """
+    import tarfile
+    alg,fname,encoding,cache_dir=task
+    bins=None
+    partials=[]
+    n_read=0
+    with tarfile.open(fname,'r|*') as tf :
+        for member in tf :
+            if not (member.isfile() and member.name.__contains__('.fits')) :
+                continue
+            print("Reading %s:%s"%(fname,member.name))
+            bins_,pos,pdfs,scale,nr=match_patch(tf.extractfile(member).read(),encoding,cache_dir)
+            if bins is None :
+                bins=bins_
+            elif (len(bins)!=len(bins_)) or np.any(bins!=bins_) :
+                raise ValueError('Bins dont match: %s vs. %s %s'%(len(bins),len(bins_),member.name))
+            partials.append((pos,pdfs,scale))
+            n_read+=nr
+    if bins is None :
+        raise ValueError('No PDF files found in '+fname)
+
+    #Merge patches
+    pos=np.concatenate([pt[0] for pt in partials])
+    pdfs=np.concatenate([pt[1] for pt in partials])
+    order=np.argsort(pos,kind='stable')
+    pos=pos[order]
+    last=np.append(pos[1:]!=pos[:-1],True)
+    pdfs=pdfs[order][last]
+    if partials[0][2] is None :
+        scale=None
+    else :
+        scale=np.concatenate([pt[2] for pt in partials])[order][last]
+    return alg,fname,bins,pos[last],pdfs,scale,n_read
+
+def read_patch_bins(source) :
+    """
+    Returns the redshift bins of a patch file (path or contents as a bytes object).
+    """
+    if isinstance(source,bytes) :
+        source=io.BytesIO(source)
+    with fits.open(source) as hdul :
+        return np.array(hdul[2].data.field(0))
+
+def read_tar_bins(fname) :
+    """
+    Returns the redshift bins of the first patch file in a tar archive.
+    """
+    import tarfile
+    with tarfile.open(fname,'r|*') as tf :
+        for member in tf :
+            if member.isfile() and member.name.__contains__('.fits') :
+                return read_patch_bins(tf.extractfile(member).read())
+    raise ValueError('No PDF files found in '+fname)
+
+def run_pdf_task(task) :
+    i_task,func,args=task
+    return (i_task,)+func(args)
 
 class PDFMatch(PipelineStage) :
     name="PDFMatch"
     inputs=[('clean_catalog',FitsFile),('pdf_dir',None)]
     outputs=[('pdf_matched',ASCIIFile)]
-    config_options={}
+    config_options={'n_workers':-1,'pdf_encoding':'float32','pdf_cache':True}
 
     def run(self) :
         """
         Main function.
         This stage matches each object in the reduced catalog with its photo-z pdf for different
         photo-z codes. Then stores the matched pdfs with the same ordering as the reduced catalog
-        into a separate FITS file.
+        into a separate FITS file. Objects without a pdf are assigned a null pdf.
+        Patch files for all codes are read concurrently by a pool of `n_workers` processes.
+        For each code, pdfs are read from the patch files in `pdf_dir`/<code>/ or, if that
+        directory does not exist, streamed from the release archive `pdf_dir`/<code>.tar.xz.
+        Pdfs are stored with the encoding given by `pdf_encoding` (see `pdf_utils.encode_pdfs`).
+        If `pdf_cache` is True, per-patch matches are cached, so that only patches that
+        changed (or whose objects in the catalog changed) are decoded again.
         """
         file_out=self.get_output('pdf_matched')
         prefix_out=file_out[:-4]
         pz_algs=['demp','ephor','ephor_ab','frankenz','nnpz']
+        encoding=self.config['pdf_encoding']
+        check_pdf_encoding(encoding)
 
         str_out=""
 
-        #Read catalog
-        cat=Table.read(self.get_input('clean_catalog'),format='fits')
-        hscdata=cat.to_pandas()
+        #Read catalog IDs and sort them once for all codes
+        ids_cat=np.array(fits.open(self.get_input('clean_catalog'))[1].data['object_id'],dtype=np.int64)
+        ncat=len(ids_cat)
+        order_cat=np.argsort(ids_cat,kind='stable')
+        ids_cat_sorted=ids_cat[order_cat]
 
-        #Read pdfs from frames
+        #List patch files
+        tasks=[]
+        n_left={}
+        cache_dirs={}
         for alg in pz_algs :
             filename=prefix_out+"_"+alg+".fits"
             str_out+=alg+" "+filename+"\n"
+            pdfs_path=self.get_input('pdf_dir')+'/'+alg
+            tar_path=self.get_input('pdf_dir')+'/'+alg+'.tar.xz'
+            use_tar=(not os.path.isdir(pdfs_path)) and os.path.isfile(tar_path)
+            if not use_tar :
+                patch_files=sorted([f for f in os.listdir(pdfs_path) if f.__contains__('.fits')])
+                if len(patch_files)==0 :
+                    raise ValueError('No PDF files found in '+pdfs_path)
+
             if os.path.isfile(filename) :
-                print(alg+" found")
+                #Only reuse matched files built for this catalog, with the requested
+                #encoding and the same redshift bins as the input pdfs
+                reader=PDFReader(filename)
+                ids_found=reader.data['object_id']
+                same_cat=(len(ids_found)==ncat) and np.all(ids_found==ids_cat)
+                same_enc=reader.encoding==encoding
+                bins_found=reader.bins
+                reader.close()
+                if use_tar :
+                    bins_in=read_tar_bins(tar_path)
+                else :
+                    bins_in=read_patch_bins(pdfs_path+'/'+patch_files[0])
+                same_bins=(len(bins_found)==len(bins_in)) and np.allclose(bins_found,bins_in)
+                if same_cat and same_enc and same_bins :
+                    print(alg+" found")
+                    continue
+                if not same_cat :
+                    print(alg+" found, but for a different catalog")
+                elif not same_enc :
+                    print(alg+" found, but with encoding "+reader.encoding)
+                else :
+                    print(alg+" found, but with different redshift bins")
+
+            cache_dirs[alg]=None
+            if self.config['pdf_cache'] :
+                cache_dirs[alg]=prefix_out+"_cache/"+alg
+                os.makedirs(cache_dirs[alg],exist_ok=True)
+
+            if use_tar :
+                #Stream patch files from the release archive
+                tasks.append((read_tar_pdfs,(alg,tar_path,encoding,cache_dirs[alg])))
+                n_left[alg]=1
                 continue
+            tasks+=[(read_patch_pdfs,(alg,'%s/%s'%(pdfs_path,f),encoding,cache_dirs[alg]))
+                   for f in patch_files]
+            n_left[alg]=len(patch_files)
 
-            pdfs_path=self.get_input('pdf_dir')+'/'+alg
-            patch_files=[f for f in os.listdir(pdfs_path) if f.__contains__('.fits')]
-            for i,file in enumerate(patch_files) :
-                print("Reading %s/%s"%(pdfs_path,file))
-                hdul=fits.open('%s/%s'%(pdfs_path,file))
-                data_readin=np.array(hdul[1].data) # pdfs
-                bins_readin=np.array(hdul[2].data) # z_bins
-                # find the column numbers for ids, pdfs
-                id_ind = np.where(np.array(data_readin.dtype.names)=='ID')[0][0]
-                pdf_ind = np.where(np.array(data_readin.dtype.names)=='PDF')[0][0]
-                # now need to restructure the data
-                if (i==0):  # first patch
-                    bins = []
-                    pdfs = {}
-
-                bins_ = []
-                for j in range(len(bins_readin)):
-                    bins_.append(bins_readin[j][0])
-                if i==0:
-                    bins = bins_
-                else:
-                    if bins != bins_:
-                        raise ValueError('Bins dont match: %s vs. %s %d'%(len(bins), len(bins_),i))
-
-                for i in range(len(data_readin)):
-                    pdfs[data_readin[i][id_ind]] = data_readin[i][pdf_ind]
-
-            bins = np.array(bins)
-
-            # match using IDs
-            print('\nMatching IDs now ... ')
-            matched_ids, matched_pdfs_cat = [], []
-
-            for i, objID in enumerate(hscdata['object_id']):
-                if objID not in pdfs.keys():
-                    print('\n%s not in the chosen pdfs'%objID)
-                else:
-                    matched_ids.append(objID)
-                    matched_pdfs_cat.append(pdfs[objID])
-
-            # save data
-            # restructure the data
-            df = pd.DataFrame(matched_pdfs_cat)
-            matched_pdfs = df.values
-
-            if np.shape(matched_pdfs)[1]!=len(bins):
-                raise ValuerEror('Somethings wrong. Have %s columns in matched_pdfs and %s bins.'%(np.shape(matched_pdfs)[1],
-                                                                                                   len(bins)))
-            # set up the header
-            hdr = fits.Header()
-            primary_hdu = fits.PrimaryHDU(header=hdr)
-
-            # data to save
-            # one table for pdfs and object ids
-            col1 = fits.Column(name='object_id', format='K', array=np.array(matched_ids, dtype=int))
-            col2 = fits.Column(name='pdf', format='%iE'%len(bins), array=matched_pdfs)
-            cols = fits.ColDefs([col1, col2])
-            pdf_hdu = fits.BinTableHDU.from_columns(cols)
-
-            # a separate table for bins
-            bincol = fits.Column(name='bins', format='E', array=np.array(bins, dtype=float))
-            bincols = fits.ColDefs([bincol])
-            bin_hdu = fits.BinTableHDU.from_columns(bincols)
-
-            # save it
-            hdul = fits.HDUList([primary_hdu, pdf_hdu, bin_hdu])
-            filename=prefix_out+"_"+alg+".fits"
-            hdul.writeto(filename, overwrite=True)
-            
-            print('\nSaved %s'%filename)
+        #Read pdfs from patches and merge them per code
+        bins={}
+        matched_pdfs={}
+        scales={}
+        matched={}
+        n_read={}
+        last_task={}
+        #Patches are merged as soon as they are read, in any order. For objects found in
+        #several patches, the patch listed last (in sorted order) takes precedence, as in
+        #`read_tar_pdfs`, so that the output does not depend on scheduling.
+        tasks=[(i_task,)+t for i_task,t in enumerate(tasks)]
+        for i_task,alg,fname,bins_,pos,pdfs,scale,nr in pool_map(run_pdf_task,tasks,
+                                                   n_workers=self.config['n_workers'],
+                                                   initializer=_init_patch_reader,
+                                                   initargs=(ids_cat_sorted,),
+                                                   ordered=False) :
+            print("Read %s"%fname)
+            if alg not in bins : # first patch
+                bins[alg]=bins_
+                # PDFs are stored in catalog order. Unmatched objects get a null PDF
+                matched_pdfs[alg]=np.zeros([ncat,len(bins_)],dtype=pdf_encodings[encoding][0])
+                scales[alg]=np.zeros(ncat,dtype=np.float32)
+                matched[alg]=np.zeros(ncat,dtype=bool)
+                last_task[alg]=np.full(ncat,-1,dtype=np.int32)
+                n_read[alg]=0
+            elif (len(bins[alg])!=len(bins_)) or np.any(bins[alg]!=bins_) :
+                raise ValueError('Bins dont match: %s vs. %s %s'%(len(bins[alg]), len(bins_),fname))
+
+            rows=order_cat[pos]
+            newer=last_task[alg][rows]<i_task
+            rows=rows[newer]
+            last_task[alg][rows]=i_task
+            matched_pdfs[alg][rows]=pdfs[newer]
+            if scale is not None :
+                scales[alg][rows]=scale[newer]
+            matched[alg][rows]=True
+            n_read[alg]+=nr
+            n_left[alg]-=1
+
+            if n_left[alg]==0 :
+                n_matched=np.sum(matched[alg])
+                print('%d out of %d objects matched to %d %s PDFs (%d objects without a PDF)'%
+                      (n_matched,ncat,n_read[alg],alg,ncat-n_matched))
+                filename=prefix_out+"_"+alg+".fits"
+                write_pdfs(filename,ids_cat,matched_pdfs[alg],bins[alg],
+                           encoding=encoding,scale=scales[alg],encoded=True)
+                print('Saved %s'%filename)
+                del matched_pdfs[alg],scales[alg],last_task[alg]
 
         print("Printing summary file")
         f=open(file_out,"w")
@@ -0,0 +1,173 @@
+import numpy as np
+from astropy.io import fits
+from scipy.sparse import csr_matrix
+
+#Storage dtype and FITS format of each pdf encoding.
+#float16 and uint16 values are stored as the bits of 16-bit integers, so that
+#the files can be memory-mapped without any scaling being applied by astropy.
+pdf_encodings={'float32':(np.float32,'E'),
+               'float16':(np.int16,'I'),
+               'uint16':(np.int16,'I'),
+               'uint8':(np.uint8,'B')}
+pdf_qmax={'uint16':65535,'uint8':255}
+
+def check_pdf_encoding(encoding) :
+    if encoding not in pdf_encodings :
+        raise ValueError("Unknown pdf encoding "+encoding+
+                         ". Choose between "+", ".join(pdf_encodings.keys()))
+
+def encode_pdfs(pdfs,encoding='float32') :
+    """
+    Encodes a set of pdfs for compact storage.
+    - 'float32': no compression.
+    - 'float16': half-precision floats (~3 significant digits).
+    - 'uint16', 'uint8': pdfs are quantized in units of a per-object scale
+      (max(pdf)/65535 or max(pdf)/255 respectively).
+    N(z)s stacked from float16, uint16 and uint8 pdfs agree with those stacked from float32
+    pdfs to within 1E-3, 1E-5 and 5E-3 of their peak respectively (see `tests/test_pdf_utils.py`).
+    :param pdfs: 2D array with shape [n_objects,n_z].
+    :param encoding: one of the above.
+    :return: encoded pdfs and per-object scale (None for floating-point encodings).
+    """
+    check_pdf_encoding(encoding)
+    pdfs=np.asarray(pdfs,dtype=np.float32)
+    if encoding=='float32' :
+        return pdfs,None
+    elif encoding=='float16' :
+        return pdfs.astype(np.float16).view(np.int16),None
+
+    qmax=pdf_qmax[encoding]
+    pmax=np.amax(pdfs,axis=1) if pdfs.shape[1]>0 else np.zeros(len(pdfs))
+    scale=np.zeros(len(pdfs),dtype=np.float32)
+    good=pmax>0
+    scale[good]=pmax[good]/qmax
+    q=np.zeros(pdfs.shape)
+    q[good]=np.clip(np.round(pdfs[good]/scale[good,None]),0,qmax)
+    if encoding=='uint16' :
+        return q.astype(np.uint16).view(np.int16),scale
+    return q.astype(np.uint8),scale
+
+def decode_pdfs(data,scale=None,encoding='float32') :
+    """
+    Decodes pdfs encoded with `encode_pdfs`.
+    :param data: encoded pdfs.
+    :param scale: per-object scale (only used for quantized encodings).
+    :param encoding: pdf encoding.
+    :return: float32 array of pdfs.
+    """
+    check_pdf_encoding(encoding)
+    if encoding=='float32' :
+        return np.asarray(data,dtype=np.float32)
+    elif encoding=='float16' :
+        return np.asarray(data).astype(np.int16).view(np.float16).astype(np.float32)
+    elif encoding=='uint16' :
+        q=np.asarray(data).astype(np.int16).view(np.uint16)
+    else :
+        q=np.asarray(data)
+    return q.astype(np.float32)*np.asarray(scale,dtype=np.float32)[:,None]
+
+def write_pdfs(filename,ids,pdfs,bins,encoding='float32',scale=None,encoded=False) :
+    """
+    Writes a set of pdfs to file.
+    :param filename: output file name.
+    :param ids: object IDs.
+    :param pdfs: 2D array containing the pdf of each object.
+    :param bins: redshift bins.
+    :param encoding: pdf encoding (see `encode_pdfs`).
+    :param scale: per-object scale of already-encoded quantized pdfs.
+    :param encoded: if True, `pdfs` (and `scale`) have already been encoded with `encode_pdfs`.
+    """
+    check_pdf_encoding(encoding)
+    if not encoded :
+        pdfs,scale=encode_pdfs(pdfs,encoding)
+
+    # set up the header
+    hdr = fits.Header()
+    primary_hdu = fits.PrimaryHDU(header=hdr)
+
+    # data to save
+    # one table for pdfs and object ids
+    cols = [fits.Column(name='object_id', format='K', array=ids),
+            fits.Column(name='pdf', format='%i%s'%(len(bins),pdf_encodings[encoding][1]),
+                        array=pdfs)]
+    if encoding in pdf_qmax :
+        cols.append(fits.Column(name='pdf_scale', format='E', array=scale))
+    pdf_hdu = fits.BinTableHDU.from_columns(fits.ColDefs(cols))
+    pdf_hdu.header['PDFENC'] = (encoding, 'pdf encoding')
+
+    # a separate table for bins
+    bincol = fits.Column(name='bins', format='E', array=np.array(bins, dtype=float))
+    bincols = fits.ColDefs([bincol])
+    bin_hdu = fits.BinTableHDU.from_columns(bincols)
+
+    # save it
+    hdul = fits.HDUList([primary_hdu, pdf_hdu, bin_hdu])
+    hdul.writeto(filename, overwrite=True)
+
+class PDFReader(object) :
+    def __init__(self,filename) :
+        """
+        Memory-mapped reader of a file written by `write_pdfs`.
+        Files written before pdf encodings were introduced are read as 'float32'.
+        :param filename: path to the pdf file.
+        """
+        self.hdul=fits.open(filename,memmap=True)
+        self.encoding=self.hdul[1].header.get('PDFENC','float32')
+        check_pdf_encoding(self.encoding)
+        self.data=self.hdul[1].data
+        self.nobj=len(self.data)
+        self.bins=np.array(self.hdul[2].data['bins'])
+
+    def read(self,i0,i1,mask=None) :
+        """
+        Returns the decoded pdfs of objects i0 to i1.
+        :param mask: optional boolean mask (of length i1-i0) selecting objects.
+        """
+        data=self.data['pdf'][i0:i1]
+        scale=self.data['pdf_scale'][i0:i1] if self.encoding in pdf_qmax else None
+        if mask is not None :
+            data=data[mask]
+            if scale is not None :
+                scale=scale[mask]
+        return decode_pdfs(data,scale,self.encoding)
+
+    def iterate(self,chunk_size=100000) :
+        """
+        Iterates over the file in chunks of `chunk_size` objects, yielding the index of the
+        first object in the chunk and the decoded pdfs.
+        """
+        for i0 in range(0,self.nobj,chunk_size) :
+            i1=min(i0+chunk_size,self.nobj)
+            yield i0,self.read(i0,i1)
+
+    def close(self) :
+        self.hdul.close()
+
+def stack_pdfs(filename,labels,nlabels,chunk_size=100000) :
+    """
+    Stacks the pdfs stored in a file in groups, reading them in chunks so that
+    memory usage does not depend on the number of objects.
+    :param filename: path to a file written by `write_pdfs`.
+    :param labels: group of each object in the file (objects with labels <0 are ignored).
+    :param nlabels: number of groups.
+    :param chunk_size: number of objects read at a time.
+    :return: redshift bins and array with shape [nlabels,n_z] containing the stacked pdfs.
+    """
+    reader=PDFReader(filename)
+    nz=len(reader.bins)
+    #Pdfs are summed with a one-hot (group,object) matrix with the same dtype as the
+    #pdfs, so they are never copied. Objects without a group go to an extra row.
+    stacks=np.zeros([nlabels+1,nz])
+    for i0,p in reader.iterate(chunk_size=chunk_size) :
+        lab=labels[i0:i0+len(p)]
+        onehot=csr_matrix((np.ones(len(p),dtype=p.dtype),(np.where(lab>=0,lab,nlabels),np.arange(len(p)))),
+                          shape=(nlabels+1,len(p)))
+        stacks+=onehot.dot(p)
+    reader.close()
+    return reader.bins,stacks[:nlabels]
+
+def stack_pdfs_task(task) :
+    """
+    Wrapper around `stack_pdfs` taking a tuple of arguments, to be used with `pool_utils.pool_map`.
+    """
+    return stack_pdfs(*task)
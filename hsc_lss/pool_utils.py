@@ -0,0 +1,124 @@
+import os
+
+def get_nworkers(n_workers) :
+    """
+    Returns the number of worker processes to use.
+    :param n_workers: requested number of workers. Values <=0 or None
+        mean "use all available cores".
+    """
+    if (n_workers is None) or (n_workers<=0) :
+        try :
+            return len(os.sched_getaffinity(0))
+        except AttributeError :
+            return os.cpu_count() or 1
+    return int(n_workers)
+
+def get_worker_threads(n_workers) :
+    """
+    Returns the number of threads each of `n_workers` worker processes should use, so
+    that all workers together use as many threads as there are cores.
+    """
+    return max(1,get_nworkers(-1)//get_nworkers(n_workers))
+
+def _get_loaded_omp_libs() :
+    """
+    Returns the paths of the OpenMP runtimes loaded in this process (Linux only),
+    including those bundled and renamed in binary wheels (e.g. libgomp-<hash>.so).
+    """
+    try :
+        with open('/proc/self/maps') as f :
+            paths=set(line.split()[-1] for line in f if len(line.split())>=6)
+    except OSError :
+        return []
+    return sorted(p for p in paths
+                  if any(os.path.basename(p).startswith(n) for n in ['libgomp','libomp','libiomp']))
+
+def limit_omp_threads(n_threads) :
+    """
+    Limits the number of OpenMP threads used by this process (e.g. by NaMaster), so
+    that parallel worker processes do not oversubscribe the machine. Runtimes that are
+    already loaded are limited through threadpoolctl if it is installed, or by calling
+    `omp_set_num_threads` directly. OMP_NUM_THREADS is also set for those loaded later.
+    :param n_threads: maximum number of threads.
+    """
+    import ctypes
+    os.environ['OMP_NUM_THREADS']=str(n_threads)
+    try :
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n_threads,user_api='openmp')
+        return
+    except ImportError :
+        pass
+    for path in _get_loaded_omp_libs() :
+        try :
+            ctypes.CDLL(path).omp_set_num_threads(int(n_threads))
+        except (OSError,AttributeError) :
+            pass
+
+def get_mp_context(method=None) :
+    """
+    Returns the multiprocessing context used to start worker processes. By default,
+    workers are started by a fork server (or spawned, where fork servers are not
+    available) rather than forked, since forking a process after OpenMP (e.g. in
+    NaMaster) or other threads have been started is unsafe.
+    :param method: start method ('forkserver', 'spawn' or 'fork'). None for the default.
+    """
+    import multiprocessing as mp
+    if method is None :
+        method='forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn'
+    return mp.get_context(method)
+
+def pool_map(func,tasks,n_workers=1,initializer=None,initargs=(),ordered=True,
+             max_inflight=None,mp_context=None) :
+    """
+    Applies a function to a list of tasks using a pool of processes, and returns an
+    iterator over the results. At most `max_inflight` tasks are submitted and not yet
+    returned at any time, so that the results waiting to be consumed never take more
+    memory than those of `max_inflight` tasks.
+    :param func: function to apply. Must be picklable (i.e. defined at module level).
+    :param tasks: list of arguments to pass to `func`.
+    :param n_workers: number of processes (see `get_nworkers`). If 1, tasks are run serially.
+    :param initializer: function called once in each process before running any task.
+    :param initargs: arguments passed to `initializer`.
+    :param ordered: if True, results are returned in the same order as the tasks.
+        Otherwise they are returned as soon as they are ready.
+    :param max_inflight: maximum number of pending tasks (2*n_workers by default).
+    :param mp_context: process start method (see `get_mp_context`).
+    """
+    tasks=list(tasks)
+    n_workers=min(get_nworkers(n_workers),max(len(tasks),1))
+    if n_workers==1 :
+        if initializer is not None :
+            initializer(*initargs)
+        for t in tasks :
+            yield func(t)
+        return
+
+    if max_inflight is None :
+        max_inflight=2*n_workers
+    max_inflight=max(max_inflight,1)
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor,wait,FIRST_COMPLETED
+    with ProcessPoolExecutor(max_workers=n_workers,mp_context=get_mp_context(mp_context),
+                             initializer=initializer,initargs=initargs) as ex :
+        if ordered :
+            pending=deque()
+            for t in tasks :
+                if len(pending)>=max_inflight :
+                    yield pending.popleft().result()
+                pending.append(ex.submit(func,t))
+            while len(pending)>0 :
+                yield pending.popleft().result()
+        else :
+            pending=set()
+            for t in tasks :
+                if len(pending)>=max_inflight :
+                    done,pending=wait(pending,return_when=FIRST_COMPLETED)
+                    for f in done :
+                        yield f.result()
+                pending.add(ex.submit(func,t))
+            while len(pending)>0 :
+                done,pending=wait(pending,return_when=FIRST_COMPLETED)
+                for f in done :
+                    yield f.result()
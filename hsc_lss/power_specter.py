@@ -5,6 +5,13 @@ from .flatmaps import read_flat_map,compare_infos
 from astropy.io import fits
 import pymaster as nmt
 from .tracer import Tracer
+from .template_basis import TemplateBasis
+from .window_utils import get_bandpower_windows,check_bandpower_windows
+from .nmt_cache import ProductCache,get_hash,get_nmt_version
+from .pair_tasks import SharedArrays,init_pair_worker,coupled_cell_task,dpj_bias_task,gaussian_sim_task,noise_sim_task,\
+    covar_block_task
+from .stats_utils import MomentsCheckpoint
+from .pool_utils import pool_map,get_nworkers,get_worker_threads
 import os
 import sacc
 from scipy.interpolate import interp1d
@@ -28,7 +35,20 @@ class PowerSpecter(PipelineStage) :
                     'depth_cut':24.5,'band':'i','mask_thr':0.5,'guess_spectrum':'NONE',
                     'gaus_covar_type':'analytic','oc_all_bands':True,
                     'mask_systematics':False,'noise_bias_type':'analytic',
-                    'output_run_dir':None,'sys_collapse_type':'average'}
+                    'output_run_dir':None,'sys_collapse_type':'average',
+                    'check_windows':True,'nmt_cache_dir':None,
+                    'dpj_var_frac':None,'dpj_cond_max':None,'n_workers':-1,
+                    'gaucov_batch_size':10,'gaucov_checkpoint_every':100,
+                    'gaucov_save_sims':True,'noise_sims_batch_size':10,
+                    'cosmo_params':{'Omega_c':0.264,'Omega_b':0.0493,'h':0.6736,
+                                    'n_s':0.9649,'sigma8':0.8111},
+                    'add_ssc':False,'ssc_response_prefix':'NONE',
+                    'z_bias_nodes':[0.0,0.5,1.0,2.0,4.0],
+                    'b_bias_nodes':[0.82,1.10,1.44,1.66,2.61],
+                    'add_ng':False,
+                    'ng_hod_params':{'log10Mmin_0':11.88,'log10Mmin_p':-0.5,'siglnM_0':0.4,
+                                     'log10M0_0':11.88,'log10M0_p':-0.5,
+                                     'log10M1_0':13.08,'log10M1_p':0.9,'alpha_0':1.0}}
 
     def read_map_bands(self,fname,read_bands,bandname,offset=0) :
         """
@@ -52,25 +72,27 @@ class PowerSpecter(PipelineStage) :
 
         return temp
 
-    def get_sacc_windows(self,wsp) :
+    def get_sacc_windows(self,wsp,weight) :
         """
         Get window functions for each bandpower so they can be stored into the final SACC files.
+        :param wsp: NaMaster workspace.
+        :param weight: mask used to compute the workspace.
         """
         #Compute window functions
         nbands=wsp.wsp.bin.n_bands
         l_arr=np.arange(self.lmax+1)
-        if not os.path.isfile(self.get_output_fname('windows_l',ext='npz')) :
-            print("Computing window functions")
-            windows=np.zeros([nbands,self.lmax+1])
-            t_hat=np.zeros(self.lmax+1);
-            for il,l in enumerate(l_arr) :
-                t_hat[il]=1.;
-                windows[:,il]=wsp.decouple_cell(wsp.couple_cell(l_arr,[t_hat]))
-                t_hat[il]=0.;
-            np.savez(self.get_output_fname('windows_l'),windows=windows)
-        else :
-            print("Reading window functions")
-            windows=np.load(self.get_output_fname('windows_l',ext='npz'))['windows']
+        def compute() :
+            windows=get_bandpower_windows(wsp,self.fsk.nx,self.fsk.ny,
+                                          np.radians(self.fsk.lx),np.radians(self.fsk.ly),
+                                          self.lmax)
+            if self.config['check_windows'] :
+                #Compare with the brute-force calculation on a few multipoles
+                check_bandpower_windows(wsp,windows)
+            return windows
+        windows=self.cache.get('windows',self.get_cache_key(weight,self.lmax),'npz',compute,
+                               lambda fname : np.load(fname)['windows'],
+                               lambda windows,fname : np.savez(fname,windows=windows),
+                               descr='window functions')
 
         windows_sacc=[]
         #i_x=0
@@ -120,53 +142,29 @@ class PowerSpecter(PipelineStage) :
         :param bpws: NaMaster bandpowers.
         :param nsims: number of simulations to use (if using them).
         """
-        def randomize_deltag_map(tracer,seed) :
-            """
-            Creates a randomised version of the input map map by assigning the
-            galaxies in the surevy to random pixels in the map. Basically it rotates each
-            galaxy by a random angle but not rotating it out of the survey footprint.
-            :param map: masked galaxy overdensity map which needs to randomised
-            :param Ngal: number of galaxies used to create the map
-            :return randomised_map: a randomised version of the masked input map
-            """
-            
-            mask = tracer.weight.reshape([tracer.fsk.ny, tracer.fsk.nx])
-            Ngal = int(tracer.Ngal)
-
-            np.random.seed(seed=seed)
-            maskpixy,maskpixx=np.where(mask!=0.)
-            galpix_mask=np.random.choice(np.arange(maskpixx.shape[0]),size=Ngal,
-                                         p=mask[mask != 0.]/np.sum(mask[mask != 0.]))
-            galpixx=maskpixx[galpix_mask]
-            galpixy=maskpixy[galpix_mask]
-
-            maskshape=mask.shape
-            ny,nx=maskshape
-            ipix=galpixx+nx*galpixy
-
-            randomized_nmap=np.bincount(ipix,minlength=nx*ny)
-
-            randomized_deltamap=np.zeros_like(randomized_nmap,dtype='float')
-            ndens=np.sum(randomized_nmap*tracer.mask_binary)/np.sum(tracer.weight)
-            randomized_deltamap[tracer.goodpix]=randomized_nmap[tracer.goodpix]/(ndens*tracer.masked_fraction[tracer.goodpix])-1
-            randomized_deltamap=randomized_deltamap.reshape(maskshape)
-
-            return randomized_deltamap
+        #Realizations of all bins are run in parallel. The ii-th realization of the
+        #i-th bin uses seed ii+nsims*i.
+        batch=self.config['noise_sims_batch_size']
+        tasks=[]; task_bins=[]
+        for i in range(self.nbins) :
+            for i0 in range(0,nsims,batch) :
+                seeds=np.arange(i0,min(i0+batch,nsims))+nsims*i
+                tasks.append((seeds,int(tracers[i].Ngal)))
+                task_bins.append(i)
+        arrays={'mask':tracers[0].weight,'mask_binary':tracers[0].mask_binary,
+                'masked_fraction':tracers[0].masked_fraction}
+        ncl_sum=np.zeros([self.nbins,self.nell])
+        with self.share_arrays(arrays) as shared :
+            for i,cls_coupled in zip(task_bins,self.run_pair_tasks(shared,noise_sim_task,tasks)) :
+                for cl in cls_coupled :
+                    ncl_sum[i]+=wsp.decouple_cell([cl])[0]
 
         nls_all=np.zeros([self.ncross,self.nell])
         i_x=0
         for i in range(self.nbins) :
             for j in range(i,self.nbins) :
                 if i==j: #Add shot noise in the auto-correlation
-                    tracer=tracers[i]
-                    mask=tracer.weight.reshape([tracer.fsk.ny,tracer.fsk.nx])
-                    ncl_uncoupled=np.zeros((nsims,self.nell))
-                    for ii in range(nsims) :
-                        randomized_map=randomize_deltag_map(tracer,ii+nsims*i)
-                        f0=nmt.NmtFieldFlat(np.radians(self.fsk.lx),np.radians(self.fsk.ly),mask,
-                                            [randomized_map])
-                        ncl_uncoupled[ii,:]=wsp.decouple_cell(nmt.compute_coupled_cell_flat(f0,f0,bpws))
-                    nls_all[i_x]=np.mean(ncl_uncoupled,axis=0)
+                    nls_all[i_x]=ncl_sum[i]/nsims
                 i_x+=1
 
         return nls_all
@@ -181,23 +179,20 @@ class PowerSpecter(PipelineStage) :
         :param wsp: NaMaster workspace.
         :param bpws: NaMaster bandpowers.
         """
-        #Compute deprojection bias
-        if os.path.isfile(self.get_output_fname('dpj_bias',ext='sacc')) :
-            print("Reading deprojection bias")
-            s=sacc.SACC.loadFromHDF(self.get_output_fname('dpj_bias',ext='sacc'))
-            cls_deproj_all=s.mean.vector.reshape([self.ncross,self.nell])
-        else :
-            print("Computing deprojection bias")
-            cls_deproj_all=[]
-            i_x=0
-            for i in range(self.nbins) :
-                for j in range(i,self.nbins) :
-                    print(i,j)
-                    cl_deproj_bias=nmt.deprojection_bias_flat(trc[i].field,trc[j].field,bpws,
-                                                              lth,[clth[i_x]])[0]
-                    cls_deproj_all.append(cl_deproj_bias)
-                    i_x+=1
-            cls_deproj_all=np.array(cls_deproj_all)
+        #Compute deprojection bias. Each pair is cached separately, keyed on
+        #the mask, templates, bandpowers and guess power spectrum.
+        keys=[get_hash(trc[0].basis.get_hash(),np.array(self.config['ell_bpws'],dtype=float),
+                       lth,clth[i_x],get_nmt_version()) for i_x in range(self.ncross)]
+        missing=[i_x for i_x in range(self.ncross) if not self.cache.contains('dpj_bias',keys[i_x],'npy')]
+        print(" %d out of %d pairs need to be computed"%(len(missing),self.ncross))
+        if len(missing)>0 :
+            with self.share_tracers(trc) as shared :
+                tasks=[(lth,clth[i_x]) for i_x in missing]
+                #Results are stored as they arrive
+                for i_x,cl in zip(missing,self.run_pair_tasks(shared,dpj_bias_task,tasks)) :
+                    print(" pair %d"%i_x)
+                    self.cache.put('dpj_bias',keys[i_x],'npy',cl,lambda c,fname : np.save(fname,c))
+        cls_deproj_all=np.array([np.load(self.cache.get_fname('dpj_bias',k,'npy')) for k in keys])
 
         #Remove deprojection bias
         cls_all=[]
@@ -236,6 +231,39 @@ class PowerSpecter(PipelineStage) :
 
         return lth,clth
 
+    def share_tracers(self,trc) :
+        """
+        Stores the maps, mask and templates of a list of tracers as shared arrays
+        that pair tasks can access (see `pair_tasks.SharedArrays`).
+        """
+        arrays={'delta':np.array([t.delta for t in trc]),'mask':trc[0].weight}
+        if trc[0].basis is not None :
+            arrays['temp_masked']=trc[0].basis.temp_masked
+            arrays['matrix_M']=trc[0].basis.matrix_M
+        return self.share_arrays(arrays)
+
+    def share_arrays(self,arrays) :
+        """
+        Makes a set of arrays available to pair tasks (see `pair_tasks.SharedArrays`).
+        Arrays are only copied into shared files if tasks run in several processes.
+        """
+        return SharedArrays(arrays,use_files=get_nworkers(self.config['n_workers'])>1)
+
+    def run_pair_tasks(self,shared,func,tasks,workspaces=None) :
+        """
+        Runs a list of pair tasks (see `pair_tasks`) through a pool of processes.
+        Returns an iterator over the results, in the same order as the tasks.
+        :param workspaces: paths to the MCM and covariance MCM files, if needed by the tasks.
+        """
+        ell_bpws=np.array(self.config['ell_bpws'])
+        #Split the cores among workers, since NaMaster uses OpenMP within each of them
+        n_workers=min(get_nworkers(self.config['n_workers']),max(len(tasks),1))
+        n_threads=get_worker_threads(n_workers) if n_workers>1 else None
+        return pool_map(func,tasks,n_workers=n_workers,
+                        initializer=init_pair_worker,
+                        initargs=(shared.sources,self.fsk,ell_bpws[:-1],ell_bpws[1:],workspaces,
+                                  n_threads))
+
     def get_power_spectra(self,trc,wsp,bpws) :
         """
         Compute all possible power spectra between pairs of tracers
@@ -243,16 +271,14 @@ class PowerSpecter(PipelineStage) :
         :param wsp: NaMaster workspace.
         :param bpws: NaMaster bandpowers.
         """
-        cls_all=[]
-        cls_coupled=[]
-        for i in range(self.nbins) :
-            for j in range(i,self.nbins) :
-                cl_coupled=nmt.compute_coupled_cell_flat(trc[i].field,trc[j].field,bpws)
-                cls_all.append(wsp.decouple_cell(cl_coupled)[0])
-                cls_coupled.append(cl_coupled[0])
-        return np.array(cls_all),np.array(cls_coupled)
+        deproject=trc[0].basis is not None
+        tasks=[(i,j,deproject) for i in range(self.nbins) for j in range(i,self.nbins)]
+        with self.share_tracers(trc) as shared :
+            cls_coupled=np.array(list(self.run_pair_tasks(shared,coupled_cell_task,tasks)))
+        cls_all=np.array([wsp.decouple_cell([cl])[0] for cl in cls_coupled])
+        return cls_all,cls_coupled
 
-    def get_covar(self,lth,clth,bpws,tracers,wsp,temps,cl_dpj_all) :
+    def get_covar(self,lth,clth,bpws,tracers,wsp,basis,cl_dpj_all) :
         """
         Estimate the power spectrum covariance
         :param lth: list of multipoles.
@@ -260,105 +286,166 @@ class PowerSpecter(PipelineStage) :
         :param bpws: NaMaster bandpowers.
         :params tracers: tracers.
         :param wsp: NaMaster workspace.
-        :param temps: list of contaminant templates.
+        :param basis: TemplateBasis containing the contaminant templates (None for no deprojection).
         :params cl_dpj_all: list of deprojection biases for each bin pair combination.
         """
+        #Outputs of the covariances with and without deprojection are stored separately
+        tag='wodpj' if basis is None else 'wdpj'
         if self.config['gaus_covar_type']=='analytic' :
             print("Computing analytical Gaussian covariance")
-            cov=self.get_covar_analytic(lth,clth,bpws,tracers,wsp)
+            cov=self.get_covar_analytic(lth,clth,bpws,tracers,wsp,tag)
         elif self.config['gaus_covar_type']=='gaus_sim' :
             print("Computing simulated Gaussian covariance")
-            cov=self.get_covar_gaussim(lth,clth,bpws,wsp,temps,cl_dpj_all)
+            cov=self.get_covar_gaussim(lth,clth,bpws,wsp,basis,cl_dpj_all,tag)
 
         return cov
             
+    def get_nzs(self,tracers) :
+        """
+        Returns the (z,N(z)) pairs of a list of Tracers (the same ones stored in the SACC tracers).
+        """
+        return [(0.5*(t.nz_data['z_i']+t.nz_data['z_f']),t.nz_data['nz_cosmos']) for t in tracers]
+
+    def get_covar_ssc(self,tracers,ell_eff) :
+        """
+        Estimate the super-sample contribution to the covariance (see `theory_covar.get_covar_ssc`).
+        :param tracers: list of Tracers.
+        :param ell_eff: effective multipoles of all bandpowers.
+        """
+        #pyccl is only needed for the non-Gaussian covariance terms
+        from .theory_covar import get_cosmology,get_covar_ssc
+        fsky=self.area_patch/(4*np.pi)
+        return get_covar_ssc(get_cosmology(self.config['cosmo_params']),self.get_nzs(tracers),
+                             np.array(self.config['z_bias_nodes']),
+                             np.array(self.config['b_bias_nodes']),
+                             ell_eff,fsky,self.config['ssc_response_prefix'])
+
+    def get_covar_ng(self,tracers,ell_eff) :
+        """
+        Estimate the connected non-Gaussian contribution to the covariance
+        (see `theory_covar.get_covar_ng`).
+        :param tracers: list of Tracers.
+        :param ell_eff: effective multipoles of all bandpowers.
+        """
+        #pyccl is only needed for the non-Gaussian covariance terms
+        import pyccl as ccl
+        from .theory_covar import get_cosmology,get_covar_ng
+        nzs=self.get_nzs(tracers)
+        cosmo_params=self.config['cosmo_params']
+        hod_params=self.config['ng_hod_params']
+        #The full-sky covariance only depends on the cosmology, HOD and N(z)s, so it
+        #is shared by all masks and only rescaled by the sky fraction.
+        key=get_hash(sorted(cosmo_params.items()),sorted(hod_params.items()),
+                     np.array(ell_eff,dtype=float),ccl.__version__,
+                     *[np.array(x,dtype=float) for nz in nzs for x in nz])
+        cov_fullsky=self.cache.get('covar_ng',key,'npy',
+                                   lambda : get_covar_ng(get_cosmology(cosmo_params),nzs,
+                                                         hod_params,ell_eff),
+                                   np.load,lambda c,fname : np.save(fname,c),
+                                   descr="full-sky non-Gaussian covariance")
+        fsky=self.area_patch/(4*np.pi)
+        return cov_fullsky/fsky
+
+    def get_cache_key(self,weight,*extra) :
+        """
+        Hash of the inputs that mask-dependent NaMaster products depend on: the mask,
+        the map geometry, the bandpower edges and the NaMaster version.
+        :param weight: mask.
+        :param extra: any other inputs the product depends on.
+        """
+        return get_hash(np.asarray(weight,dtype=float),
+                        self.fsk.nx,self.fsk.ny,float(self.fsk.lx),float(self.fsk.ly),
+                        np.array(self.config['ell_bpws'],dtype=float),
+                        get_nmt_version(),*extra)
+
     def get_mcm(self,tracers,bpws) :
         """
         Get NmtWorkspaceFlat for our mask
         """
-        wsp=nmt.NmtWorkspaceFlat()
-        if not os.path.isfile(self.get_output_fname('mcm',ext='dat')) :
-            print("Computing MCM")
+        def compute() :
+            wsp=nmt.NmtWorkspaceFlat()
             wsp.compute_coupling_matrix(tracers[0].field,tracers[0].field,bpws)
-            wsp.write_to(self.get_output_fname('mcm',ext='dat'))
-        else :
-            print("Reading MCM")
-            wsp.read_from(self.get_output_fname('mcm',ext='dat'))
-        
-        return wsp
+            return wsp
+        def read(fname) :
+            wsp=nmt.NmtWorkspaceFlat()
+            wsp.read_from(fname)
+            return wsp
+        return self.cache.get('mcm',self.get_cache_key(tracers[0].weight),'dat',compute,read,
+                              lambda wsp,fname : wsp.write_to(fname),descr='MCM')
 
     def get_covar_mcm(self,tracers,bpws):
         """
         Get NmtCovarianceWorkspaceFlat for our mask
         """
-        cwsp=nmt.NmtCovarianceWorkspaceFlat()
-        if not os.path.isfile(self.get_output_fname('cov_mcm',ext='dat')) :
-            print("Computing covariance MCM")
+        def compute() :
+            cwsp=nmt.NmtCovarianceWorkspaceFlat()
             cwsp.compute_coupling_coefficients(tracers[0].field,
                                                tracers[0].field,bpws)
-            cwsp.write_to(self.get_output_fname('cov_mcm',ext='dat'))
-        else :
-            print("Reading covariance MCM")
-            cwsp.read_from(self.get_output_fname('cov_mcm',ext='dat'))
-        
-        return cwsp
+            return cwsp
+        def read(fname) :
+            cwsp=nmt.NmtCovarianceWorkspaceFlat()
+            cwsp.read_from(fname)
+            return cwsp
+        return self.cache.get('cov_mcm',self.get_cache_key(tracers[0].weight),'dat',compute,read,
+                              lambda cwsp,fname : cwsp.write_to(fname),
+                              descr='covariance MCM')
 
-    def get_covar_gaussim(self,lth,clth,bpws,wsp,temps,cl_dpj_all) :
+    def get_covar_gaussim(self,lth,clth,bpws,wsp,basis,cl_dpj_all,tag) :
         """
         Estimate the power spectrum covariance from Gaussian simulations
         :param lth: list of multipoles.
         :param clth: list of guess power spectra sampled at the multipoles stored in `lth`.
         :param bpws: NaMaster bandpowers.
         :param wsp: NaMaster workspace.
-        :param temps: list of contaminatn templates.
+        :param basis: TemplateBasis containing the contaminant templates (None for no deprojection).
         :params cl_dpj_all: list of deprojection biases for each bin pair combination.
+        :param tag: suffix of the checkpoint and simulation files ('wodpj' or 'wdpj').
         """
-        #Create a dummy file for the covariance MCM
-        f=open(self.get_output_fname('cov_mcm',ext='dat'),"w")
-        f.close()
-
         #Setup
         nsims=10*self.ncross*self.nell
         print("Computing covariance from %d Gaussian simulations"%nsims)
-        msk_binary=self.msk_bi.reshape([self.fsk.ny,self.fsk.nx])
-        weights=(self.msk_bi*self.mskfrac).reshape([self.fsk.ny,self.fsk.nx])
-        if temps is not None :
-            conts=[[t.reshape([self.fsk.ny,self.fsk.nx])] for t in temps]
+        weights=self.msk_bi*self.mskfrac
+        arrays={'mask':weights,'clth':clth}
+        if basis is not None :
             cl_dpj=[[c] for c in cl_dpj_all]
+            arrays['temp_masked']=basis.temp_masked
+            arrays['matrix_M']=basis.matrix_M
+            key=get_hash(basis.get_hash(),np.array(cl_dpj_all))
         else :
-            conts=None
             cl_dpj=[None for i in range(self.ncross)]
+            key=get_hash(weights)
+        key=get_hash(key,clth,np.array(self.config['ell_bpws'],dtype=float),get_nmt_version())
+        save_sims=self.config['gaucov_save_sims']
+
+        #Resume from checkpoint if it was computed for the same inputs
+        ckpt=MomentsCheckpoint(self.get_output_fname('gaucov_checkpoint_'+tag,ext='npz'),key,
+                               save_samples=save_sims)
+        if ckpt.n>0 :
+            print(" Resuming after %d simulations"%ckpt.n)
+
+        #Iterate over batches of simulations
+        batch=self.config['gaucov_batch_size']
+        tasks=[(i0,min(i0+batch,nsims),self.nbins,basis is not None)
+               for i0 in range(ckpt.n,nsims,batch)]
+        if len(tasks)>0 :
+            with self.share_arrays(arrays) as shared :
+                for task,cls_coupled in zip(tasks,self.run_pair_tasks(shared,gaussian_sim_task,tasks)) :
+                    #Decouple and accumulate the mean and co-moments of the bandpowers
+                    cells=np.array([np.array([wsp.decouple_cell([cl],cl_bias=cl_dpj[i_x])[0]
+                                              for i_x,cl in enumerate(cls)]).flatten()
+                                    for cls in cls_coupled])
+                    ckpt.add(cells)
+                    if (ckpt.n-ckpt.n_saved>=self.config['gaucov_checkpoint_every']) or (ckpt.n==nsims) :
+                        print(" %d-th sim"%ckpt.n)
+                        ckpt.save()
+        if save_sims :
+            #Save simulations for further 
+            np.savez(self.get_output_fname('gaucov_sims_'+tag),cl_sims=np.array(ckpt.samples))
 
-        #Iterate
-        cells_sims=[]
-        for isim in range(nsims) :
-            if isim%100==0 :
-                print(" %d-th sim"%isim)
-            #Generate random maps
-            mps=nmt.synfast_flat(self.fsk.nx,self.fsk.ny,
-                                 np.radians(self.fsk.lx),np.radians(self.fsk.ly),
-                                 clth,np.zeros(self.nbins),seed=1000+isim)
-            #Nmt fields
-            flds=[nmt.NmtFieldFlat(np.radians(self.fsk.lx),np.radians(self.fsk.ly),weights,
-                                   [m],templates=conts) for m in mps]
-            #Compute power spectra (possibly with deprojection)
-            i_x=0
-            cells_this=[]
-            for i in range(self.nbins) :
-                for j in range(i,self.nbins) :
-                    cl=nmt.compute_coupled_cell_flat(flds[i],flds[j],bpws)
-                    cells_this.append(wsp.decouple_cell(cl,cl_bias=cl_dpj[i_x])[0])
-                    i_x+=1
-            cells_sims.append(np.array(cells_this).flatten())
-        cells_sims=np.array(cells_sims)
-        #Save simulations for further 
-        np.savez(self.get_output_fname('gaucov_sims'),cl_sims=cells_sims)
-        
         #Compute covariance
-        covar=np.cov(cells_sims.T)
-        return covar
+        return ckpt.get_covariance()
 
-    def get_covar_analytic(self,lth,clth,bpws,tracers,wsp) :
+    def get_covar_analytic(self,lth,clth,bpws,tracers,wsp,tag) :
         """
         Estimate the power spectrum covariance analytically
         :param lth: list of multipoles.
@@ -366,29 +453,45 @@ class PowerSpecter(PipelineStage) :
         :param bpws: NaMaster bandpowers.
         :param tracers: tracers.
         :param wsp: NaMaster workspace.
+        :param tag: suffix of the (dummy) simulation file ('wodpj' or 'wdpj').
         """
         #Create a dummy file for the covariance MCM
-        f=open(self.get_output_fname('gaucov_sims',ext='npz'),"w")
+        f=open(self.get_output_fname('gaucov_sims_'+tag,ext='npz'),"w")
         f.close()
 
         covar=np.zeros([self.ncross*self.nell,self.ncross*self.nell])
-        cwsp=self.get_covar_mcm(tracers,bpws)
-
-        ix_1=0
-        for i1 in range(self.nbins) :
-            for j1 in range(i1,self.nbins) :
-                ix_2=0
-                for i2 in range(self.nbins) :
-                    for j2 in range(i2,self.nbins) :
-                        ca1b1=clth[self.ordering[i1,i2]]
-                        ca1b2=clth[self.ordering[i1,j2]]
-                        ca2b1=clth[self.ordering[j1,i2]]
-                        ca2b2=clth[self.ordering[j1,j2]]
-                        cov_here=nmt.gaussian_covariance_flat(cwsp,0,0,0,0,
-                                                              lth,[ca1b1],[ca1b2],[ca2b1],[ca2b2],wsp)
-                        covar[ix_1*self.nell:(ix_1+1)*self.nell,:][:,ix_2*self.nell:(ix_2+1)*self.nell]=cov_here
-                        ix_2+=1
-                ix_1+=1
+        self.get_covar_mcm(tracers,bpws)
+        key_mask=self.get_cache_key(tracers[0].weight)
+        workspaces=(self.cache.get_fname('mcm',key_mask,'dat'),
+                    self.cache.get_fname('cov_mcm',key_mask,'dat'))
+
+        #Each block only depends on the spectra (a1b1,a2b2) and (a1b2,a2b1), and is
+        #invariant under swapping the spectra within each pair. Since all fields share
+        #the same mask, block (b,a) is the transpose of block (a,b). Only blocks with
+        #ix_2>=ix_1 and distinct input spectra are therefore computed.
+        pairs=[(i,j) for i in range(self.nbins) for j in range(i,self.nbins)]
+        blocks={}
+        for ix_1,(i1,j1) in enumerate(pairs) :
+            for ix_2 in range(ix_1,self.ncross) :
+                i2,j2=pairs[ix_2]
+                blocks[(ix_1,ix_2)]=(tuple(sorted((self.ordering[i1,i2],self.ordering[j1,j2])))+
+                                     tuple(sorted((self.ordering[i1,j2],self.ordering[j1,i2]))))
+        specs=sorted(set(blocks.values()))
+        keys={sp:get_hash(key_mask,lth,*[clth[i] for i in sp]) for sp in specs}
+        missing=[sp for sp in specs if not self.cache.contains('covar_block',keys[sp],'npy')]
+        print(" %d distinct blocks out of %d, %d need to be computed"%(len(specs),self.ncross**2,
+                                                                       len(missing)))
+        if len(missing)>0 :
+            with self.share_arrays({'lth':lth,'clth':clth}) as shared :
+                for sp,cov_here in zip(missing,self.run_pair_tasks(shared,covar_block_task,missing,
+                                                                    workspaces=workspaces)) :
+                    self.cache.put('covar_block',keys[sp],'npy',cov_here,
+                                   lambda c,fname : np.save(fname,c))
+
+        for (ix_1,ix_2),sp in blocks.items() :
+            cov_here=np.load(self.cache.get_fname('covar_block',keys[sp],'npy')).reshape([self.nell,self.nell])
+            covar[ix_1*self.nell:(ix_1+1)*self.nell,ix_2*self.nell:(ix_2+1)*self.nell]=cov_here
+            covar[ix_2*self.nell:(ix_2+1)*self.nell,ix_1*self.nell:(ix_1+1)*self.nell]=cov_here.T
 
         return covar
 
@@ -445,10 +548,10 @@ class PowerSpecter(PipelineStage) :
 
         return msk_bi,mskfrac,mp_depth
 
-    def get_tracers(self,temps) :
+    def get_tracers(self,basis) :
         """
         Produce a Tracer for each redshift bin. Do so with and without contaminant deprojection.
-        :param temps: list of contaminant tracers
+        :param basis: TemplateBasis containing all contaminant templates.
         """
         hdul=fits.open(self.get_input('ngal_maps'))
         if len(hdul)%2!=0 :
@@ -456,7 +559,7 @@ class PowerSpecter(PipelineStage) :
         nbins=len(hdul)//2
         tracers_nocont=[Tracer(hdul,i,self.fsk,self.msk_bi,self.mskfrac,contaminants=None)
                         for i in range(nbins)]
-        tracers_wcont=[Tracer(hdul,i,self.fsk,self.msk_bi,self.mskfrac,contaminants=temps)
+        tracers_wcont=[Tracer(hdul,i,self.fsk,self.msk_bi,self.mskfrac,contaminants=basis)
                        for i in range(nbins)]
         hdul.close()
         return tracers_nocont,tracers_wcont
@@ -501,6 +604,12 @@ class PowerSpecter(PipelineStage) :
         # This is a hack to get the path of the root output directory.
         # It should be easy to get this from ceci, but I don't know how to.
         self.output_dir=self.get_output('dummy',final_name=True)[:-5]
+        #Mask-dependent products are shared by all runs
+        if self.config['nmt_cache_dir'] is not None :
+            cache_dir=self.config['nmt_cache_dir']
+        else :
+            cache_dir=self.output_dir+'nmt_cache/'
+        self.cache=ProductCache(cache_dir)
         if self.config['output_run_dir'] is not None:
             self.output_dir+=self.config['output_run_dir']+'/'
         if not os.path.isdir(self.output_dir):
@@ -512,6 +621,17 @@ class PowerSpecter(PipelineStage) :
         if self.config['guess_spectrum']!='NONE' :
             if not os.path.isfile(self.config['guess_spectrum']) :
                 raise ValueError('Guess spectrum must be either \'NONE\' or an existing ASCII file')
+        if self.config['add_ssc'] :
+            if self.config['ssc_response_prefix']=='NONE' :
+                raise ValueError('ssc_response_prefix must be provided to compute the SSC covariance')
+            #Fail before computing any power spectra if the response files are missing
+            from .theory_covar import get_response_files
+            get_response_files(self.config['ssc_response_prefix'])
+            if len(self.config['z_bias_nodes'])!=len(self.config['b_bias_nodes']) :
+                raise ValueError('z_bias_nodes and b_bias_nodes must have the same size')
+        for k in ['dpj_var_frac','dpj_cond_max'] :
+            if (self.config[k] is not None) and (self.config[k]<=0) :
+                raise ValueError(k+' must be positive or None')
         if self.config['sys_collapse_type']=='average':
             self.sys_map_offset=0
         elif self.config['sys_collapse_type']=='median':
@@ -553,6 +673,7 @@ class PowerSpecter(PipelineStage) :
             sacc_precision=sacc.Precision(covar,"dense",is_covariance=True, binning=sacc_b)
 
         sacc_meta={'Area_rad':self.area_patch}
+        sacc_meta.update(self.dpj_meta)
         s=sacc.SACC(sacc_t,sacc_b,sacc_mean,precision=sacc_precision,meta=sacc_meta)
         if verbose :
             s.printInfo()
@@ -611,8 +732,16 @@ class PowerSpecter(PipelineStage) :
         bpws=nmt.NmtBinFlat(lini,lend)
         ell_eff=bpws.get_effective_ells()
 
+        print("Building template basis")
+        basis=TemplateBasis(self.fsk,self.msk_bi*self.mskfrac,temps,
+                            var_frac=self.config['dpj_var_frac'],
+                            cond_max=self.config['dpj_cond_max'])
+        print(" Deprojecting %d modes out of %d templates"%(basis.ntemp,len(temps)))
+        #Recorded in the SACC metadata
+        self.dpj_meta={'dpj_'+k:v for k,v in basis.compression.items()}
+
         print("Generating tracers")
-        tracers_nc,tracers_wc=self.get_tracers(temps)
+        tracers_nc,tracers_wc=self.get_tracers(basis)
         self.nbins=len(tracers_nc)
 
         print("Translating into SACC tracers")
@@ -631,7 +760,7 @@ class PowerSpecter(PipelineStage) :
         wsp=self.get_mcm(tracers_nc,bpws)
 
         print("Computing window function")
-        windows=self.get_sacc_windows(wsp)
+        windows=self.get_sacc_windows(wsp,tracers_nc[0].weight)
 
         print("Computing SACC binning")
         #No windows
@@ -657,7 +786,22 @@ class PowerSpecter(PipelineStage) :
         if self.config['gaus_covar_type']=='analytic' :
             cov_wdpj=cov_wodpj.copy()
         else :
-            cov_wdpj=self.get_covar(lth,clth,bpws,tracers_wc,wsp,temps,cls_deproj)
+            cov_wdpj=self.get_covar(lth,clth,bpws,tracers_wc,wsp,basis,cls_deproj)
+        #Each covariance component is also stored separately
+        covar_components={'gaussian_wodpj':cov_wodpj,'gaussian_wdpj':cov_wdpj}
+        if self.config['add_ssc'] :
+            print("Computing super-sample covariance")
+            cov_ssc=self.get_covar_ssc(tracers_nc,ell_eff)
+            covar_components['ssc']=cov_ssc
+            cov_wodpj=cov_wodpj+cov_ssc
+            cov_wdpj=cov_wdpj+cov_ssc
+        if self.config['add_ng'] :
+            print("Computing non-Gaussian covariance")
+            cov_ng=self.get_covar_ng(tracers_nc,ell_eff)
+            covar_components['ng']=cov_ng
+            cov_wodpj=cov_wodpj+cov_ng
+            cov_wdpj=cov_wdpj+cov_ng
+        np.savez(self.get_output_fname('covar_components',ext='npz'),**covar_components)
 
         print("Computing noise bias")
         nls=self.get_noise(tracers_nc,wsp,bpws)
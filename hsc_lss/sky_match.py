@@ -0,0 +1,93 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from .tree_utils import get_tree
+
+def radec_to_vec(ra,dec) :
+    """
+    Returns the unit vectors (with shape [n,3]) pointing in the directions given by
+    R.A. and dec. (in degrees).
+    """
+    ra=np.radians(np.asarray(ra,dtype=float))
+    dec=np.radians(np.asarray(dec,dtype=float))
+    cd=np.cos(dec)
+    return np.transpose(np.array([cd*np.cos(ra),cd*np.sin(ra),np.sin(dec)]))
+
+def arcsec_to_chord(sep) :
+    """
+    Converts angular separations in arcsec into distances between unit vectors.
+    """
+    return 2*np.sin(0.5*np.radians(np.asarray(sep,dtype=float)/3600.))
+
+def chord_to_arcsec(d) :
+    """
+    Converts distances between unit vectors into angular separations in arcsec.
+    """
+    return 3600*np.degrees(2*np.arcsin(np.minimum(0.5*np.asarray(d,dtype=float),1.)))
+
+class SkyMatcher(object) :
+    def __init__(self,ra,dec,workers=-1,cache_dir=None) :
+        """
+        Positional cross-matcher against a reference catalog. Positions are converted
+        into unit vectors and stored in a KD-tree, so matches are exact on the sphere.
+        :param ra,dec: coordinates of the reference catalog (in degrees).
+        :param workers: number of threads used in tree queries (-1 for all cores).
+        :param cache_dir: directory where the reference tree is cached (see `tree_utils.get_tree`).
+        """
+        self.vec=radec_to_vec(ra,dec)
+        self.n_ref=len(self.vec)
+        self.workers=workers
+        self.tree=get_tree(self.vec,cache_dir=cache_dir)
+
+    def match_nearest(self,ra,dec,tol_arcsec=None) :
+        """
+        Finds the nearest reference object to each input position.
+        :param ra,dec: input coordinates (in degrees).
+        :param tol_arcsec: maximum separation (in arcsec). If None, all objects are matched.
+        :return: index of the nearest reference object (-1 if there is none within the
+            tolerance) and separation in arcsec (inf if unmatched).
+        """
+        d_max=np.inf if tol_arcsec is None else arcsec_to_chord(tol_arcsec)
+        d,ind=self.tree.query(radec_to_vec(ra,dec),k=1,distance_upper_bound=d_max,
+                              workers=self.workers)
+        unmatched=ind>=self.n_ref
+        ind[unmatched]=-1
+        sep=np.full(len(d),np.inf)
+        sep[~unmatched]=chord_to_arcsec(d[~unmatched])
+        return ind,sep
+
+    def match_within(self,ra,dec,tol_arcsec) :
+        """
+        Finds all pairs of input and reference objects closer than a given separation.
+        :param ra,dec: input coordinates (in degrees).
+        :param tol_arcsec: maximum separation (in arcsec).
+        :return: index of the input object, index of the reference object and separation
+            (in arcsec) of each pair, sorted by input index.
+        """
+        vec=radec_to_vec(ra,dec)
+        lists=self.tree.query_ball_point(vec,arcsec_to_chord(tol_arcsec),workers=self.workers)
+        n_per=np.array([len(l) for l in lists],dtype=int)
+        i_in=np.repeat(np.arange(len(vec)),n_per)
+        i_ref=np.concatenate([np.array(l,dtype=int) for l in lists]+[np.zeros(0,dtype=int)])
+        sep=chord_to_arcsec(np.sqrt(np.sum((vec[i_in]-self.vec[i_ref])**2,axis=1)))
+        return i_in,i_ref,sep
+
+    def match_reciprocal(self,ra,dec,tol_arcsec) :
+        """
+        Finds pairs of input and reference objects that are each other's nearest
+        neighbor and are closer than a given separation.
+        :param ra,dec: input coordinates (in degrees).
+        :param tol_arcsec: maximum separation (in arcsec).
+        :return: index of the input object, index of the reference object and separation
+            (in arcsec) of each pair.
+        """
+        vec=radec_to_vec(ra,dec)
+        d_max=arcsec_to_chord(tol_arcsec)
+        d,ind=self.tree.query(vec,k=1,distance_upper_bound=d_max,workers=self.workers)
+        #Temporary tree, not cached
+        tree_in=cKDTree(vec)
+        _,ind_back=tree_in.query(self.vec,k=1,distance_upper_bound=d_max,workers=self.workers)
+        i_in=np.where(ind<self.n_ref)[0]
+        i_ref=ind[i_in]
+        good=ind_back[i_ref]==i_in
+        i_in=i_in[good]; i_ref=i_ref[good]
+        return i_in,i_ref,chord_to_arcsec(d[i_in])
@@ -0,0 +1,187 @@
+import os
+import numpy as np
+
+def get_groups(labels) :
+    """
+    Sorts a set of objects into groups with the same label.
+    :param labels: integer label of each object.
+    :return: order (indices that sort the objects by group, preserving their relative order),
+             CSR-style group boundaries (group i spans `order[indptr[i]:indptr[i+1]]`),
+             label of each group.
+    """
+    labels=np.asarray(labels)
+    order=np.argsort(labels,kind='stable')
+    keys,counts=np.unique(labels[order],return_counts=True)
+    indptr=np.concatenate([[0],np.cumsum(counts)])
+    return order,indptr,keys
+
+def _segment_percentile_block(values,weights,indptr,qs,sorted_values) :
+    ngroups=len(indptr)-1
+    counts=np.diff(indptr)
+    group=np.repeat(np.arange(ngroups),counts)
+    if not sorted_values :
+        order=np.lexsort((values,group))
+        values=values[order]
+        weights=weights[order]
+    wsum=np.bincount(group,weights=weights,minlength=ngroups)
+    cw=np.cumsum(weights)
+    cw_start=np.concatenate([[0.],cw])[indptr[:-1]]
+    #Position of each value within its group, in units of the group's total weight
+    x=(cw-0.5*weights-cw_start[group])/wsum[group]
+    key=group+x
+
+    out=np.full([len(qs),ngroups],np.nan)
+    good=np.where(counts>0)[0]
+    i_start=indptr[good]; i_end=indptr[good+1]
+    for iq,q in enumerate(qs) :
+        i_hi=np.clip(np.searchsorted(key,good+0.01*q,side='left'),i_start,i_end-1)
+        i_lo=np.maximum(i_hi-1,i_start)
+        #Interpolate in x rather than in key, so the result does not depend on
+        #the position of the group within the block
+        dx=x[i_hi]-x[i_lo]
+        t=np.zeros(len(good))
+        interp=dx>0
+        t[interp]=np.clip((0.01*q-x[i_lo[interp]])/dx[interp],0,1)
+        t[~interp]=(0.01*q>=x[i_hi[~interp]]).astype(float)
+        out[iq,good]=values[i_lo]+t*(values[i_hi]-values[i_lo])
+    return out
+
+def segment_percentile(values,indptr,q,weights=None,sorted_values=False,nthreads=1) :
+    """
+    Computes (weighted) percentiles over variable-length groups of values with a single sort.
+    Percentiles are interpolated linearly between the mid-points of the cumulative
+    weight of each value, so that unweighted medians coincide with `np.median`.
+    :param values: values, ordered by group.
+    :param indptr: CSR-style group boundaries (group i spans `values[indptr[i]:indptr[i+1]]`).
+    :param q: percentile or list of percentiles to compute (between 0 and 100).
+    :param weights: weight of each value (must be positive). If None, all values are
+        weighted equally.
+    :param sorted_values: set to True if values are already sorted within each group.
+    :param nthreads: number of threads used to process independent blocks of groups.
+    :return: array with shape [len(q),ngroups] (or [ngroups] if q is a scalar) containing
+        the percentiles of each group (NaN for empty groups).
+    """
+    values=np.asarray(values,dtype=float)
+    indptr=np.asarray(indptr,dtype=int)
+    if weights is None :
+        weights=np.ones(len(values))
+    else :
+        weights=np.asarray(weights,dtype=float)
+    scalar_input=np.ndim(q)==0
+    qs=np.atleast_1d(q)
+    ngroups=len(indptr)-1
+
+    #Split groups into blocks with similar numbers of values
+    nblocks=max(min(nthreads,ngroups),1)
+    i_blocks=np.searchsorted(indptr,np.linspace(0,indptr[-1],nblocks+1)[1:-1])
+    i_blocks=np.unique(np.concatenate([[0],i_blocks,[ngroups]]))
+
+    def run_block(ib) :
+        g0=i_blocks[ib]; g1=i_blocks[ib+1]
+        v0=indptr[g0]; v1=indptr[g1]
+        return _segment_percentile_block(values[v0:v1],weights[v0:v1],indptr[g0:g1+1]-v0,
+                                         qs,sorted_values)
+
+    if len(i_blocks)>2 :
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=nthreads) as ex :
+            out=np.concatenate(list(ex.map(run_block,range(len(i_blocks)-1))),axis=1)
+    else :
+        out=run_block(0)
+
+    if scalar_input :
+        return out[0]
+    return out
+
+def segment_median(values,indptr,weights=None,sorted_values=False,nthreads=1) :
+    """
+    Computes (weighted) medians over variable-length groups of values.
+    See `segment_percentile` for a description of the arguments.
+    """
+    return segment_percentile(values,indptr,50.,weights=weights,
+                              sorted_values=sorted_values,nthreads=nthreads)
+
+def histogram_index(x,edges) :
+    """
+    Returns the bin of each value for a histogram with the given edges, with the same
+    convention as `np.histogram`: bins are closed on the left, and the last one is also
+    closed on the right. Values outside the histogram range are assigned -1.
+    :param x: values.
+    :param edges: bin edges (increasing).
+    """
+    x=np.asarray(x)
+    nbins=len(edges)-1
+    ix=np.searchsorted(edges,x,side='right')-1
+    ix[x==edges[-1]]=nbins-1
+    ix[(ix<0) | (ix>=nbins)]=-1
+    return ix
+
+def update_moments(n,mean,m2,x) :
+    """
+    Adds a batch of samples to running estimates of the mean and co-moment matrix
+    (sum of outer products of deviations from the mean), using Chan et al.'s
+    pairwise update, so that the covariance of a large number of samples can be
+    computed without storing them.
+    :param n: number of samples accumulated so far.
+    :param mean: mean of those samples (ignored if n==0).
+    :param m2: co-moment matrix of those samples (ignored if n==0).
+    :param x: array with shape [n_batch,n_dim] containing the new samples.
+    :return: updated n, mean and m2. The covariance is m2/(n-1).
+    """
+    x=np.atleast_2d(x)
+    n_b=len(x)
+    mean_b=np.mean(x,axis=0)
+    dx=x-mean_b[None,:]
+    m2_b=np.dot(dx.T,dx)
+    if n==0 :
+        return n_b,mean_b,m2_b
+    n_t=n+n_b
+    delta=mean_b-mean
+    mean_t=mean+delta*n_b/float(n_t)
+    m2_t=m2+m2_b+np.outer(delta,delta)*n*n_b/float(n_t)
+    return n_t,mean_t,m2_t
+
+class MomentsCheckpoint(object) :
+    def __init__(self,fname,key,save_samples=False) :
+        """
+        Running mean and co-moment matrix of a stream of samples (see `update_moments`),
+        periodically saved to a checkpoint file. If the file exists and was written for the
+        same `key`, the accumulation resumes from it.
+        :param fname: path to the checkpoint file (.npz).
+        :param key: string identifying the inputs the samples depend on.
+        :param save_samples: if True, all samples are also stored (and checkpointed).
+        """
+        self.fname=fname
+        self.key=key
+        self.save_samples=save_samples
+        self.n=0; self.mean=None; self.m2=None; self.samples=[]
+        if os.path.isfile(fname) :
+            d=np.load(fname)
+            if (str(d['key'])==key) and ((not save_samples) or ('samples' in d)) :
+                self.n=int(d['n']); self.mean=d['mean']; self.m2=d['m2']
+                if save_samples :
+                    self.samples=list(d['samples'])
+        self.n_saved=self.n
+
+    def add(self,x) :
+        """
+        Adds a batch of samples with shape [n_batch,n_dim].
+        """
+        self.n,self.mean,self.m2=update_moments(self.n,self.mean,self.m2,x)
+        if self.save_samples :
+            self.samples+=list(np.atleast_2d(x))
+
+    def save(self) :
+        """
+        Writes the checkpoint file (atomically, so that interrupted writes leave the previous one).
+        """
+        ckpt={'key':self.key,'n':self.n,'mean':self.mean,'m2':self.m2}
+        if self.save_samples :
+            ckpt['samples']=np.array(self.samples)
+        fname_tmp=self.fname[:-4]+'.tmp.npz'
+        np.savez(fname_tmp,**ckpt)
+        os.replace(fname_tmp,self.fname)
+        self.n_saved=self.n
+
+    def get_covariance(self) :
+        return self.m2/(self.n-1.)
@@ -3,9 +3,9 @@ from .types import FitsFile
 import numpy as np
 from .flatmaps import FlatMapInfo, read_flat_map
 from .obscond import ObsCond
+from .frame_utils import get_frames_index, get_field_bounds, read_frames, corner_names, corner_columns
 #from .map_utils import createCountsMap, createMeanStdMaps, createMask, removeDisconnected
 #from .estDepth import get_depth
-from astropy.io import fits
 from shapely.geometry.polygon import Polygon
 from shapely.prepared import prep
 
@@ -15,37 +15,69 @@ class SystMapper(PipelineStage) :
     outputs=[('ccdtemp_maps',FitsFile),('airmass_maps',FitsFile),('exptime_maps',FitsFile),
              ('skylevel_maps',FitsFile),('sigma_sky_maps',FitsFile),('seeing_maps',FitsFile),
              ('ellipt_maps',FitsFile),('nvisit_maps',FitsFile)]
-    config_options={'ccd_drop':[9]}
+    config_options={'ccd_drop':[9],'frames_index':True,'frames_index_cell':1.,
+                    'frames_chunk_size':100000,'oc_extra_stats':[],'oc_nthreads':1}
+
+    def parse_extra_stats(self) :
+        """
+        Check the list of additional statistics to map. Allowed values are:
+        - 'min', 'max': minimum and maximum value of each OC in each pixel.
+        - 'pXX': weighted XX-th percentile of each OC in each pixel (e.g. 'p16').
+        - 'neff': effective number of visits (stored with the Nvisits maps).
+        - 'ivw': sky noise of the inverse-variance-weighted coadd (stored with the sigma_sky maps).
+        """
+        extra_stats=self.config['oc_extra_stats']
+        for st in extra_stats :
+            if st in ['min','max','neff','ivw'] :
+                continue
+            if st.startswith('p') :
+                try :
+                    q=float(st[1:])
+                except ValueError :
+                    q=-1.
+                if (q>=0) and (q<=100) :
+                    continue
+            raise ValueError("Unknown OC statistic "+st+
+                             ". Choose between min, max, neff, ivw or pXX (0<=XX<=100)")
+        return extra_stats
 
     def run(self) :
         bands=['g','r','i','z','y']
         quants=['ccdtemp','airmass','exptime','skylevel','sigma_sky','seeing','ellipt']
+        extra_stats=self.parse_extra_stats()
 
         print("Reading sample map")
         fsk,mp=read_flat_map(self.get_input('masked_fraction'))
 
         print("Reading metadata")
-        data=fits.open(self.get_input('frames_data'))[1].data
-        #Drop CCDs if needed
-        for ccd_id in self.config['ccd_drop']:
-            msk=data['ccd_id']!=ccd_id
-            print('will drop %d frames from bad CCDs'%(np.sum(~msk)))
-            data=data[msk]
+        ccd_drop=self.config['ccd_drop']
+        def select_frames(chunk) :
+            #Drop bad CCDs and keep only frames that fit inside the field
+            is_in=~np.isin(chunk['ccd_id'],ccd_drop)
+            in_field=np.zeros(len(chunk),dtype=bool)
+            for cra,cdec in corner_names :
+                in_field|=fsk.pos2pix2d(chunk[cra],chunk[cdec])[2]
+            return is_in & in_field
+        rows=None
+        if self.config['frames_index'] :
+            #Only read frames overlapping with this field
+            idx=get_frames_index(self.get_input('frames_data'),
+                                 cell_size=self.config['frames_index_cell'])
+            ra_range,dec_range=get_field_bounds(fsk)
+            rows=idx.query(ra_range,dec_range)
+            print('%d out of %d frames overlap with this field'%(len(rows),idx.nrows))
+        data=read_frames(self.get_input('frames_data'),corner_columns+['filter','ccd_id']+quants,
+                         rows=rows,selection=select_frames,
+                         chunk_size=self.config['frames_chunk_size'])
+        print('%d frames in the field after dropping CCDs %s'%(len(data),str(ccd_drop)))
 
         print("Computing frame coords")
-        ix_ll,iy_ll,in_ll=fsk.pos2pix2d(data['llcra'],data['llcdecl'])
-        ix_ul,iy_ul,in_ul=fsk.pos2pix2d(data['ulcra'],data['ulcdecl'])
-        ix_ur,iy_ur,in_ur=fsk.pos2pix2d(data['urcra'],data['urcdecl'])
-        ix_lr,iy_lr,in_lr=fsk.pos2pix2d(data['lrcra'],data['lrcdecl'])
-        #Keep only frames that fit inside the field
-        is_in=np.logical_or(in_ll,np.logical_or(in_ul,np.logical_or(in_ur,in_lr)))
-        data=data[is_in]
+        ix_ll,iy_ll,_=fsk.pos2pix2d(data['llcra'],data['llcdecl'])
+        ix_ul,iy_ul,_=fsk.pos2pix2d(data['ulcra'],data['ulcdecl'])
+        ix_ur,iy_ur,_=fsk.pos2pix2d(data['urcra'],data['urcdecl'])
+        ix_lr,iy_lr,_=fsk.pos2pix2d(data['lrcra'],data['lrcdecl'])
         coadd_weights=1./data['skylevel']
         nframes=len(data)
-        ix_ll=ix_ll[is_in]; iy_ll=iy_ll[is_in]; 
-        ix_ul=ix_ul[is_in]; iy_ul=iy_ul[is_in]; 
-        ix_ur=ix_ur[is_in]; iy_ur=iy_ur[is_in]; 
-        ix_lr=ix_lr[is_in]; iy_lr=iy_lr[is_in];
         
         print("Building poliygons")
         polyfield=Polygon([(0,0),(0,fsk.ny),(fsk.nx,fsk.ny),(fsk.nx,0)])
@@ -90,41 +122,60 @@ class SystMapper(PipelineStage) :
             pix_areas.append(areas)
 
         print("Computing systematics maps")
-        #Initialize maps
-        nvisits={b:np.zeros_like(mp) for b in bands}
-        oc_maps={}
-        for q in quants :
-            oc_maps[q]={b:ObsCond(q,fsk.nx,fsk.ny) for b in bands}
-        #Fill maps    
-        for ip,pfr in enumerate(polyframe) :
-            band=data['filter'][ip]
-            indices=pix_indices[ip]
-            areas=pix_areas[ip]
-            weight=coadd_weights[ip]
-            nvisits[band][indices]+=areas
-            for quant in quants :
-                oc_maps[quant][band].add_frame(indices,data[quant][ip],areas*weight)
-
-        #Close maps
-        for q in quants:
-            for b in bands:
+        #Sparse frame-pixel overlap structure
+        n_overlaps=np.array([len(ind) for ind in pix_indices],dtype=int)
+        ov_frame=np.repeat(np.arange(nframes),n_overlaps)
+        ov_pix=np.concatenate(pix_indices+[np.zeros(0,dtype=int)]).astype(int)
+        ov_area=np.concatenate(pix_areas+[np.zeros(0)])
+        ov_band=np.array(data['filter'])[ov_frame]
+        ov_weight=ov_area*coadd_weights[ov_frame]
+        #Initialize and fill maps
+        nvisits={}
+        nvisits_eff={}
+        sigma_sky_ivw={}
+        oc_maps={q:{} for q in quants}
+        for b in bands :
+            in_band=ov_band==b
+            pix=ov_pix[in_band]
+            frm=ov_frame[in_band]
+            area=ov_area[in_band]
+            weight=ov_weight[in_band]
+            nvisits[b]=np.bincount(pix,weights=area,minlength=fsk.npix)
+            for q in quants :
+                oc_maps[q][b]=ObsCond(q,fsk.nx,fsk.ny,nthreads=self.config['oc_nthreads'])
+                oc_maps[q][b].add_frames(pix,data[q][frm],weight)
                 oc_maps[q][b].complete_map()
+            if 'neff' in extra_stats :
+                #Effective number of visits: (sum_i a_i w_i)^2 / sum_i a_i w_i^2
+                sw=np.bincount(pix,weights=weight,minlength=fsk.npix)
+                sw2=np.bincount(pix,weights=weight*coadd_weights[frm],minlength=fsk.npix)
+                nvisits_eff[b]=np.zeros(fsk.npix)
+                nvisits_eff[b][sw2>0]=sw[sw2>0]**2/sw2[sw2>0]
+            if 'ivw' in extra_stats :
+                #Sky noise of the inverse-variance-weighted coadd: (sum_i a_i/sigma_i^2)^(-1/2)
+                sig=np.array(data['sigma_sky'][frm])
+                good=sig>0
+                ivar=np.bincount(pix[good],weights=area[good]/sig[good]**2,minlength=fsk.npix)
+                sigma_sky_ivw[b]=-9999.*np.ones(fsk.npix)
+                sigma_sky_ivw[b][ivar>0]=1./np.sqrt(ivar[ivar>0])
 
         print("Saving maps")
         #Nvisits
-        maps_save=np.array([nvisits[b] for b in bands])
-        descripts=np.array(['Nvisits-'+b for b in bands])
-        fsk.write_flat_map(self.get_output('nvisit_maps'),maps_save,descripts)
+        maps_save=[nvisits[b] for b in bands]
+        descripts=['Nvisits-'+b for b in bands]
+        if 'neff' in extra_stats :
+            maps_save+=[nvisits_eff[b] for b in bands]
+            descripts+=['Neff-'+b for b in bands]
+        fsk.write_flat_map(self.get_output('nvisit_maps'),np.array(maps_save),np.array(descripts))
         #Observing conditions
+        oc_stats=['mean','std','median']+[st for st in extra_stats if st not in ['neff','ivw']]
         for q in quants :
-            maps_save=np.array([oc_maps[q][b].collapse_map_mean() for b in bands] +
-                               [oc_maps[q][b].collapse_map_std() for b in bands] +
-                               [oc_maps[q][b].collapse_map_median() for b in bands])
-            descripts=np.array(['mean '+q+'-'+b for b in bands] +
-                               ['std '+q+'-'+b for b in bands] +
-                               ['median '+q+'-'+b for b in bands])
-            fsk.write_flat_map(self.get_output(q+'_maps'),maps_save,descripts)
-
+            maps_save=[oc_maps[q][b].collapse_map(st) for st in oc_stats for b in bands]
+            descripts=[st+' '+q+'-'+b for st in oc_stats for b in bands]
+            if (q=='sigma_sky') and ('ivw' in extra_stats) :
+                maps_save+=[sigma_sky_ivw[b] for b in bands]
+                descripts+=['ivw '+q+'-'+b for b in bands]
+            fsk.write_flat_map(self.get_output(q+'_maps'),np.array(maps_save),np.array(descripts))
 
 if __name__ == '__main__':
     cls = PipelineStage.main()
@@ -0,0 +1,132 @@
+import pymaster as nmt
+import numpy as np
+from .nmt_cache import get_hash
+
+def get_pinv(matrix,tol_pinv=1E-10) :
+    """
+    Moore-Penrose pseudo-inverse of a symmetric matrix, treating all eigenvalues below
+    `tol_pinv` times the largest one as singular (as done by NaMaster).
+    """
+    evals,evecs=np.linalg.eigh(matrix)
+    inv_evals=np.zeros_like(evals)
+    good=evals>=tol_pinv*np.amax(evals)
+    inv_evals[good]=1./evals[good]
+    return np.dot(evecs*inv_evals[None,:],evecs.T)
+
+def compress_templates(templates,mask,var_frac=None,cond_max=None) :
+    """
+    Compresses a set of (mean-subtracted) templates into their leading principal modes
+    over the weighted footprint. Templates are first normalized by their weighted rms,
+    and the eigenvectors of their Gram matrix (with inner product sum(mask^2*t_i*t_j),
+    the same one used for deprojection) are sorted by decreasing eigenvalue.
+    :param templates: array with shape [n_templates,n_pix].
+    :param mask: weights map.
+    :param var_frac: keep the smallest number of modes accounting for at least this
+        fraction of the total variance (None to keep all).
+    :param cond_max: drop modes with eigenvalues smaller than the largest one divided by
+        `cond_max` (None to keep all).
+    :return: array with shape [n_modes,n_pix] containing the (unmasked) modes, and
+        a dictionary describing the compression.
+    """
+    mask2=mask**2
+    rms=np.sqrt(np.dot(templates**2,mask2)/np.sum(mask2))
+    rms[rms<=0]=1.
+    t_norm=templates/rms[:,None]
+    evals,evecs=np.linalg.eigh(np.dot(t_norm*mask2[None,:],t_norm.T))
+    evals=np.maximum(evals[::-1],0); evecs=evecs[:,::-1]
+    n_keep=len(evals)
+    if var_frac is not None :
+        n_keep=min(n_keep,np.searchsorted(np.cumsum(evals)/np.sum(evals),var_frac)+1)
+    if cond_max is not None :
+        n_keep=min(n_keep,np.sum(evals>=evals[0]/cond_max))
+    modes=np.dot(evecs[:,:n_keep].T,t_norm)
+    info={'ntemp_in':len(templates),'ntemp':int(n_keep),
+          'var_frac_kept':float(np.sum(evals[:n_keep])/np.sum(evals))}
+    return modes,info
+
+class TemplateBasis(object) :
+    def __init__(self,fsk,mask,templates,tol_pinv=1E-10,var_frac=None,cond_max=None) :
+        """
+        Set of contaminant templates shared by all fields defined on the same mask.
+        The masked templates and the inverse of their Gram matrix are computed once,
+        so that contaminants can be deprojected from any map with a few dot products,
+        and NaMaster fields can be built from the clean maps with a single Fourier transform.
+        :param fsk: flatmaps.FlatSkyInfo object defining the geometry of the maps.
+        :param mask: mask (weights map).
+        :param templates: list of contaminant maps.
+        :param tol_pinv: tolerance used when pseudo-inverting the Gram matrix (see `get_pinv`).
+        :param var_frac,cond_max: if either is not None, the templates are replaced by
+            their leading principal modes (see `compress_templates`).
+        """
+        self.fsk=fsk
+        self.mask=np.asarray(mask,dtype=float).flatten()
+        temps=np.array([np.asarray(t,dtype=float).flatten() for t in templates])
+        self.compression={'ntemp_in':len(temps),'ntemp':len(temps),'var_frac_kept':1.}
+        if (var_frac is not None) or (cond_max is not None) :
+            temps,self.compression=compress_templates(temps,self.mask,var_frac,cond_max)
+        self.ntemp=len(temps)
+        self.temp_masked=temps*self.mask[None,:]
+        self.matrix_M=get_pinv(np.dot(self.temp_masked,self.temp_masked.T),tol_pinv)
+        self._template_field=None
+        self._hash=None
+
+    @classmethod
+    def from_arrays(cls,fsk,mask,temp_masked,matrix_M) :
+        """
+        Rebuilds a basis from its masked templates and inverse Gram matrix (e.g. in a
+        worker process), without recomputing anything.
+        """
+        basis=cls.__new__(cls)
+        basis.fsk=fsk
+        basis.mask=mask
+        basis.ntemp=len(temp_masked)
+        basis.temp_masked=temp_masked
+        basis.matrix_M=matrix_M
+        basis.compression={'ntemp_in':basis.ntemp,'ntemp':basis.ntemp,'var_frac_kept':1.}
+        basis._template_field=None
+        basis._hash=None
+        return basis
+
+    def get_hash(self) :
+        """
+        Hash of the mask and templates (see `nmt_cache.get_hash`).
+        """
+        if self._hash is None :
+            self._hash=get_hash(self.mask,self.temp_masked)
+        return self._hash
+
+    def reshape(self,mp) :
+        return mp.reshape([self.fsk.ny,self.fsk.nx])
+
+    def deproject(self,mp) :
+        """
+        Returns the masked version of a map with the best-fit contribution from all
+        templates removed.
+        """
+        mp_masked=np.asarray(mp,dtype=float).flatten()*self.mask
+        alpha=np.dot(self.matrix_M,np.dot(self.temp_masked,mp_masked))
+        return mp_masked-np.dot(alpha,self.temp_masked)
+
+    def get_field(self,mp) :
+        """
+        Returns a pymaster `NmtFieldFlat` for a given map with all templates deprojected.
+        Note that this field does not store the templates. Use `template_field` to
+        compute deprojection biases.
+        """
+        return nmt.NmtFieldFlat(np.radians(self.fsk.lx),np.radians(self.fsk.ly),
+                                self.reshape(self.mask),[self.reshape(self.deproject(mp))],
+                                masked_on_input=True)
+
+    @property
+    def template_field(self) :
+        """
+        `NmtFieldFlat` containing the mask and templates (and a null map), which is all
+        `pymaster.deprojection_bias_flat` needs. It is only built once.
+        """
+        if self._template_field is None :
+            self._template_field=nmt.NmtFieldFlat(np.radians(self.fsk.lx),np.radians(self.fsk.ly),
+                                                  self.reshape(self.mask),
+                                                  [self.reshape(np.zeros_like(self.mask))],
+                                                  templates=[[self.reshape(t)] for t in self.temp_masked],
+                                                  masked_on_input=True)
+        return self._template_field
@@ -0,0 +1,190 @@
+import glob
+import numpy as np
+import pyccl as ccl
+from scipy.special import j1
+
+#Fiducial cosmology (Planck 2018 TT,TE,EE+lowE+lensing)
+COSMO_PARAMS={'Omega_c':0.264,'Omega_b':0.0493,'h':0.6736,'n_s':0.9649,'sigma8':0.8111}
+
+def get_cosmology(params=COSMO_PARAMS) :
+    return ccl.Cosmology(**params)
+
+_responses={}
+
+def get_response_files(prefix) :
+    """
+    Returns the redshifts and names of the response files `<prefix>_z<z>.txt`. Files whose
+    suffix is not a redshift (e.g. `<prefix>_z0b.txt`) are ignored.
+    :param prefix: prefix of the response files.
+    """
+    fnames=[f for f in glob.glob(prefix+'_z*.txt')
+            if f[len(prefix)+2:-4].replace('.','',1).isdigit()]
+    if len(fnames)==0 :
+        raise ValueError("No response files found with prefix "+prefix)
+    zarr=np.array([float(f[len(prefix)+2:-4]) for f in fnames])
+    return zarr,fnames
+
+def get_response(cosmo,prefix) :
+    """
+    Returns the response of the matter power spectrum to a super-sample density mode
+    as a `pyccl.Pk2D` object. It is read from the ASCII files `<prefix>_z<z>.txt` (one per
+    redshift, with the wavenumber in h/Mpc in the first column and the response in the
+    fifth one, see `get_response_files`) the first time it is needed, and reused afterwards.
+    The tabulated response is the dimensionless logarithmic one, dlnP/d(delta_b) (equal
+    to 47/21-dlnP/dlnk/3 on linear scales), so only the wavenumbers need converting.
+    Multiply by the non-linear matter power spectrum to obtain dP/d(delta_b) (see
+    `get_covar_ssc`).
+    :param cosmo: pyccl Cosmology (used to convert wavenumbers to 1/Mpc).
+    :param prefix: prefix of the response files.
+    """
+    key=(prefix,cosmo['h'])
+    if key not in _responses :
+        zarr,fnames=get_response_files(prefix)
+        #Pk2D needs increasing scale factors
+        isort=np.argsort(zarr)[::-1]
+        resp2d=[]
+        for i in isort :
+            k_h,_,_,_,resp1d=np.loadtxt(fnames[i],unpack=True)
+            resp2d.append(resp1d)
+        _responses[key]=ccl.Pk2D(a_arr=1./(1+zarr[isort]),lk_arr=np.log(k_h*cosmo['h']),
+                                 pk_arr=np.array(resp2d),is_logp=False)
+    return _responses[key]
+
+def get_z_grid(nzs,nz_grid=256) :
+    """
+    Returns a redshift grid covering all redshift distributions, and the trapezoidal
+    integration weights on it.
+    :param nzs: list of (z,N(z)) pairs.
+    """
+    zmax=np.amax([z[nz>0][-1] for z,nz in nzs])
+    zarr=np.linspace(1E-3,zmax,nz_grid)
+    dz=np.zeros(nz_grid); dz[1:]+=0.5*np.diff(zarr); dz[:-1]+=0.5*np.diff(zarr)
+    return zarr,dz
+
+def get_kernels(cosmo,nzs,z_bias,b_bias,zarr,dz) :
+    """
+    Returns the radial kernels q(chi)=b(z)*H(z)*p(z) of a set of linearly biased number
+    count tracers sampled at `zarr`, and the comoving distance to each redshift.
+    :param nzs: list of (z,N(z)) pairs.
+    :param z_bias,b_bias: redshift nodes and values of the linear galaxy bias (None for b=1).
+    :param zarr,dz: redshift grid and integration weights (see `get_z_grid`).
+    """
+    a=1./(1+zarr)
+    chi=ccl.comoving_radial_distance(cosmo,a)
+    h_z=cosmo['h']*ccl.h_over_h0(cosmo,a)/ccl.physical_constants.CLIGHT_HMPC
+    if z_bias is None :
+        bz=np.ones_like(zarr)
+    else :
+        bz=np.interp(zarr,z_bias,b_bias)
+    kernels=[]
+    for z,nz in nzs :
+        pz=np.interp(zarr,z,nz,left=0,right=0)
+        pz/=np.sum(pz*dz)
+        kernels.append(bz*h_z*pz)
+    return np.array(kernels),chi
+
+def get_sigma2_b(cosmo,zarr,chi,fsky,nk=512) :
+    """
+    Variance of the super-sample density mode at each redshift for a circular footprint
+    with sky fraction `fsky`.
+    """
+    theta_s=np.arccos(1-2*fsky)
+    lk=np.linspace(np.log(1E-5),np.log(10.),nk)
+    k=np.exp(lk)
+    sigma2=np.zeros(len(zarr))
+    for iz,z in enumerate(zarr) :
+        x=k*chi[iz]*theta_s
+        w=2*j1(x)/x
+        pk=ccl.linear_matter_power(cosmo,k,1./(1+z))
+        integ=k**2*pk*w**2
+        sigma2[iz]=np.sum(integ[1:]+integ[:-1])*0.5*(lk[1]-lk[0])/(2*np.pi)
+    return sigma2
+
+def get_dchi(cosmo,zarr,dz) :
+    """
+    Integration weights in comoving distance for a redshift grid.
+    """
+    return dz*ccl.physical_constants.CLIGHT_HMPC/(cosmo['h']*ccl.h_over_h0(cosmo,1./(1+zarr)))
+
+def get_covar_ssc(cosmo,nzs,z_bias,b_bias,ells,fsky,response_prefix) :
+    """
+    Super-sample covariance of all auto- and cross-spectra of a set of galaxy clustering
+    tracers, in the Limber approximation and assuming a linearly biased response of
+    the matter power spectrum, dP/d(delta_b)=P_NL(k)*dlnP/d(delta_b).
+    :param cosmo: pyccl Cosmology.
+    :param nzs: list of (z,N(z)) pairs.
+    :param z_bias,b_bias: redshift nodes and values of the linear galaxy bias.
+    :param ells: multipoles at which the covariance is evaluated.
+    :param fsky: sky fraction.
+    :param response_prefix: prefix of the response files (see `get_response`).
+    :return: covariance matrix with shape [n_cross*n_ell,n_cross*n_ell], with pairs
+        ordered as (0,0),(0,1),...,(1,1),...
+    """
+    resp=get_response(cosmo,response_prefix)
+    zarr,dz=get_z_grid(nzs)
+    q,chi=get_kernels(cosmo,nzs,z_bias,b_bias,zarr,dz)
+    #Integration weights in chi
+    w=get_dchi(cosmo,zarr,dz)
+    w*=get_sigma2_b(cosmo,zarr,chi,fsky)
+
+    #Response dP/d(delta_b) (in Mpc^3) at k=(l+1/2)/chi, with shape [n_ell,n_z]
+    r_lz=np.array([resp((ells+0.5)/chi[iz],1./(1+z),cosmo)*
+                   ccl.nonlin_matter_power(cosmo,(ells+0.5)/chi[iz],1./(1+z))
+                   for iz,z in enumerate(zarr)]).T
+
+    #Kernel of each pair, with shape [n_cross,n_ell,n_z]
+    nbins=len(nzs)
+    k_pairs=np.array([q[i]*q[j]/chi**2 for i in range(nbins) for j in range(i,nbins)])
+    k_pairs=k_pairs[:,None,:]*r_lz[None,:,:]
+    ncross,nell,_=k_pairs.shape
+    cov=np.einsum('ilz,jmz->iljm',k_pairs*w[None,None,:],k_pairs)
+    return cov.reshape([ncross*nell,ncross*nell])
+
+def get_trispectrum(cosmo,hod_params,zmax,nk=64,na=16) :
+    """
+    Connected (1-, 2-, 3- and 4-halo) galaxy trispectrum for a halo occupation distribution
+    model, tabulated on a grid of wavenumbers and scale factors as a `pyccl.Tk3D` object.
+    :param hod_params: parameters of `pyccl.halos.HaloProfileHOD`.
+    :param zmax: maximum redshift of the grid.
+    """
+    mass_def=ccl.halos.MassDef200m
+    hmc=ccl.halos.HMCalculator(mass_function=ccl.halos.MassFuncTinker08(mass_def=mass_def),
+                               halo_bias=ccl.halos.HaloBiasTinker10(mass_def=mass_def),
+                               mass_def=mass_def)
+    cm=ccl.halos.ConcentrationDuffy08(mass_def=mass_def)
+    prof=ccl.halos.HaloProfileHOD(mass_def=mass_def,concentration=cm,**hod_params)
+    return ccl.halos.halomod_Tk3D_cNG(cosmo,hmc,prof,prof12_2pt=ccl.halos.Profile2ptHOD(),
+                                      lk_arr=np.linspace(np.log(1E-3),np.log(30.),nk),
+                                      a_arr=np.linspace(1./(1+zmax),1.,na))
+
+def get_covar_ng(cosmo,nzs,hod_params,ells,tkk=None) :
+    """
+    Connected non-Gaussian covariance of all auto- and cross-spectra of a set of galaxy
+    clustering tracers, in the Limber approximation, for a full-sky survey. Divide by the
+    sky fraction to obtain the covariance of a partial-sky survey.
+    The trispectrum is computed once and evaluated at k=(l+1/2)/chi at each redshift,
+    and all pairs are projected at once.
+    :param cosmo: pyccl Cosmology.
+    :param nzs: list of (z,N(z)) pairs.
+    :param hod_params: parameters of `pyccl.halos.HaloProfileHOD`.
+    :param ells: multipoles at which the covariance is evaluated.
+    :param tkk: trispectrum (see `get_trispectrum`). If None, it is computed from `hod_params`.
+    :return: covariance matrix with shape [n_cross*n_ell,n_cross*n_ell], with pairs
+        ordered as (0,0),(0,1),...,(1,1),...
+    """
+    zarr,dz=get_z_grid(nzs)
+    q,chi=get_kernels(cosmo,nzs,None,None,zarr,dz)
+    if tkk is None :
+        tkk=get_trispectrum(cosmo,hod_params,zarr[-1])
+    w=get_dchi(cosmo,zarr,dz)/(4*np.pi)
+
+    #Trispectrum with shape [n_ell,n_ell,n_z]
+    t_llz=np.array([tkk((ells+0.5)/chi[iz],1./(1+z)) for iz,z in enumerate(zarr)]).transpose([1,2,0])
+
+    #Kernel of each pair, with shape [n_cross,n_z]
+    nbins=len(nzs)
+    k_pairs=np.array([q[i]*q[j]/chi**3 for i in range(nbins) for j in range(i,nbins)])
+    ncross=len(k_pairs)
+    nell=len(ells)
+    cov=np.einsum('iz,jz,lmz->iljm',k_pairs*w[None,:],k_pairs,t_llz)
+    return cov.reshape([ncross*nell,ncross*nell])
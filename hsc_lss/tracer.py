@@ -1,6 +1,7 @@
 import pymaster as nmt
 import numpy as np
 from .flatmaps import compare_infos, read_flat_map
+from .template_basis import TemplateBasis
 
 class Tracer(object) :
     def __init__(self,hdu_list,i_bin,fsk,mask_binary,masked_fraction,contaminants=None) :
@@ -11,7 +12,8 @@ class Tracer(object) :
         :param fsk: flatmaps.FlatSkyInfo object defining the geometry of the maps.
         :param mask_binary: binary mask (which pixels to consider and which not to).
         :param masked_fraction: masked fraction map.
-        :param contaminants: list of possible contaminant maps to deproject.
+        :param contaminants: list of possible contaminant maps to deproject, or a `TemplateBasis`
+            containing them (which should be shared by all tracers defined on the same mask).
         
         This class then stores a number of data objects, the most important one being a pymaster `NmtFieldFlat` ready to use in power spectrum estimation.
         """
@@ -27,7 +29,7 @@ class Tracer(object) :
             raise ValueError("Mask size is incompatible")
         if not self.fsk.is_map_compatible(masked_fraction) :
             raise ValueError("Mask size is incompatible")
-        if contaminants is not None :
+        if (contaminants is not None) and (not isinstance(contaminants,TemplateBasis)) :
             for ic,c in enumerate(contaminants) :
                 if not self.fsk.is_map_compatible(c) :
                     raise ValueError("%d-th contaminant template is incompatible"%ic)
@@ -44,13 +46,16 @@ class Tracer(object) :
         self.delta=np.zeros_like(self.weight)
         self.delta[goodpix]=nmap[goodpix]/(ndens*masked_fraction[goodpix])-1
 
-        #Reshape contaminants
-        conts=None
-        if contaminants is not None :
-            conts=[[c.reshape([self.fsk.ny,self.fsk.nx])] for c in contaminants]
-
         #Form NaMaster field
-        self.field=nmt.NmtFieldFlat(np.radians(self.fsk.lx),np.radians(self.fsk.ly),
-                                    self.weight.reshape([self.fsk.ny,self.fsk.nx]),
-                                    [self.delta.reshape([self.fsk.ny,self.fsk.nx])],
-                                    templates=conts)
+        self.basis=None
+        if contaminants is None :
+            self.field=nmt.NmtFieldFlat(np.radians(self.fsk.lx),np.radians(self.fsk.ly),
+                                        self.weight.reshape([self.fsk.ny,self.fsk.nx]),
+                                        [self.delta.reshape([self.fsk.ny,self.fsk.nx])])
+        else :
+            if isinstance(contaminants,TemplateBasis) :
+                self.basis=contaminants
+            else :
+                self.basis=TemplateBasis(self.fsk,self.weight,contaminants)
+            #Contaminants are deprojected in pixel space by the template basis
+            self.field=self.basis.get_field(self.delta)
@@ -0,0 +1,46 @@
+import numpy as np
+import os
+import hashlib
+import pickle
+from scipy.spatial import cKDTree
+
+#Trees built so far, keyed by a hash of their points
+_tree_cache={}
+
+def get_tree(points,leafsize=40,cache_dir=None,cache=True) :
+    """
+    Returns a cKDTree for a set of points, reusing trees that have already been built
+    for the same points in this process or, if `cache_dir` is not None, stored on disk.
+    :param points: array with shape [n_points,n_dim].
+    :param leafsize: tree leaf size.
+    :param cache_dir: directory where trees are stored (no disk caching if None).
+    :param cache: if False, a new tree is built and not kept in memory (use for
+        temporary trees, since trees cached in memory are never released).
+    """
+    points=np.ascontiguousarray(points,dtype=float)
+    if not cache :
+        return cKDTree(points,leafsize=leafsize)
+    h=hashlib.sha1(points.tobytes())
+    h.update(str((points.shape,leafsize)).encode())
+    key=h.hexdigest()
+    if key in _tree_cache :
+        return _tree_cache[key]
+
+    fname=None
+    if cache_dir is not None :
+        fname=os.path.join(cache_dir,'tree_'+key+'.pkl')
+        if os.path.isfile(fname) :
+            with open(fname,'rb') as f :
+                tree=pickle.load(f)
+            _tree_cache[key]=tree
+            return tree
+
+    tree=cKDTree(points,leafsize=leafsize)
+    _tree_cache[key]=tree
+    if fname is not None :
+        os.makedirs(cache_dir,exist_ok=True)
+        fname_tmp=fname+'.%d'%os.getpid()
+        with open(fname_tmp,'wb') as f :
+            pickle.dump(tree,f)
+        os.replace(fname_tmp,fname)
+    return tree
@@ -0,0 +1,124 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+
+def get_fourier_modes(nx,ny,lx,ly) :
+    """
+    Returns the moduli of all Fourier modes of a flat-sky map and the ring each of
+    them is assigned to when NaMaster bins power spectra (rings of width min(dkx,dky)).
+    Modes outside the last ring are discarded.
+    :param nx,ny: number of pixels in each dimension.
+    :param lx,ly: map size in each dimension (in radians).
+    :return: mode moduli, ring indices and number of rings.
+    """
+    dkx=2*np.pi/lx
+    dky=2*np.pi/ly
+    ix=np.arange(nx); iy=np.arange(ny)
+    kx=np.where(2*ix<=nx,ix*dkx,-(nx-ix)*dkx)
+    ky=np.where(2*iy<=ny,iy*dky,-(ny-iy)*dky)
+    kmod=np.sqrt(kx[None,:]*kx[None,:]+ky[:,None]*ky[:,None]).flatten()
+    dell=min(dkx,dky)
+    kmax=np.sqrt((dkx*(nx//2))**2+(dky*(ny//2))**2)
+    n_ell=0
+    while (n_ell+1)*dell<=kmax :
+        n_ell+=1
+    ir=(kmod*(1./dell)).astype(int)
+    good=ir<n_ell
+    return kmod[good],ir[good],n_ell
+
+def get_ring_projector(kmod,ir,n_ell,lmax) :
+    """
+    Sparse matrix with shape [n_ell,lmax+1] mapping a power spectrum sampled at all
+    integer multipoles up to `lmax` into its average over each ring of Fourier modes,
+    using the same linear interpolation as `NmtWorkspaceFlat.couple_cell`.
+    """
+    n_cells=np.bincount(ir,minlength=n_ell).astype(float)
+    inside=kmod<lmax
+    k=kmod[inside]; r=ir[inside]
+    il=np.floor(k).astype(int)
+    f=k-il
+    rows=np.concatenate([r,r])
+    cols=np.concatenate([il,il+1])
+    vals=np.concatenate([1-f,f])/n_cells[rows]
+    return coo_matrix((vals,(rows,cols)),shape=(n_ell,lmax+1)).tocsr()
+
+def get_ring_coupling(wsp,kmod,ir,n_ell) :
+    """
+    Returns the coupling matrix with shape [n_bands,n_ell] that NaMaster applies to
+    ring-averaged power spectra, extracted with one `couple_cell` call per ring.
+    Each call passes a step function that is 1 for all modes in the ring and 0 for
+    all other modes (whose moduli never lie between the steps).
+    """
+    n_bands=wsp.wsp.bin.n_bands
+    coupling=np.zeros([n_bands,n_ell])
+    k_unique=np.unique(kmod)
+    for r in range(n_ell) :
+        k_ring=kmod[ir==r]
+        if len(k_ring)==0 :
+            continue
+        k_lo=np.amin(k_ring); k_hi=np.amax(k_ring)
+        i_lo=np.searchsorted(k_unique,k_lo)
+        i_hi=np.searchsorted(k_unique,k_hi)
+        ells=[]; cls=[]
+        if i_lo>0 :
+            ells.append(k_unique[i_lo-1]); cls.append(0.)
+        ells.append(k_lo); cls.append(1.)
+        if k_hi>k_lo :
+            ells.append(k_hi); cls.append(1.)
+        if i_hi<len(k_unique)-1 :
+            ells.append(k_unique[i_hi+1])
+        else :
+            ells.append(2*k_hi+1.)
+        cls.append(0.)
+        coupling[:,r]=wsp.couple_cell(np.array(ells),[np.array(cls)])[0]
+    return coupling
+
+def get_decoupling(wsp) :
+    """
+    Returns the inverse of the binned coupling matrix, extracted by decoupling
+    each unit bandpower vector.
+    """
+    n_bands=wsp.wsp.bin.n_bands
+    decoupling=np.zeros([n_bands,n_bands])
+    for b in range(n_bands) :
+        e=np.zeros(n_bands); e[b]=1.
+        decoupling[:,b]=wsp.decouple_cell([e])[0]
+    return decoupling
+
+def get_bandpower_windows(wsp,nx,ny,lx,ly,lmax) :
+    """
+    Computes the bandpower window functions of a spin-0 flat-sky workspace, i.e. the
+    response of each decoupled bandpower to a unit input power at each multipole
+    0<=l<=lmax. This is equivalent to calling `wsp.decouple_cell(wsp.couple_cell(...))`
+    on each one-hot spectrum, but only requires one call per Fourier ring and bandpower.
+    :param wsp: NmtWorkspaceFlat.
+    :param nx,ny: number of pixels of the maps used to compute the workspace.
+    :param lx,ly: map size in each dimension (in radians).
+    :param lmax: maximum multipole.
+    :return: array with shape [n_bands,lmax+1].
+    """
+    kmod,ir,n_ell=get_fourier_modes(nx,ny,lx,ly)
+    projector=get_ring_projector(kmod,ir,n_ell,lmax)
+    coupling=get_ring_coupling(wsp,kmod,ir,n_ell)
+    decoupling=get_decoupling(wsp)
+    #(D^-1 U) P, with P sparse
+    return np.transpose(projector.T.dot(np.transpose(np.dot(decoupling,coupling))))
+
+def check_bandpower_windows(wsp,windows,n_check=20,rtol=1E-5) :
+    """
+    Compares a set of bandpower windows with the brute-force calculation
+    (`wsp.decouple_cell(wsp.couple_cell(...))` on one-hot spectra) at `n_check`
+    multipoles, raising a RuntimeError if they do not match.
+    :param wsp: NmtWorkspaceFlat.
+    :param windows: window functions (see `get_bandpower_windows`).
+    :param n_check: number of multipoles checked (evenly spaced between 0 and lmax).
+    :param rtol: relative tolerance.
+    """
+    lmax=windows.shape[1]-1
+    l_arr=np.arange(lmax+1)
+    t_hat=np.zeros(lmax+1)
+    for il in np.unique(np.linspace(0,lmax,n_check).astype(int)) :
+        t_hat[il]=1.
+        w_l=wsp.decouple_cell(wsp.couple_cell(l_arr,[t_hat]))[0]
+        t_hat[il]=0.
+        if not np.allclose(windows[:,il],w_l,rtol=rtol,atol=1E-8*np.amax(np.fabs(windows))) :
+            raise RuntimeError("Batched window functions do not match at l=%d"%il)
@@ -89,7 +89,7 @@ def mk_config(cov_type='ana',noi_type='ana',w_ssc=True,msk_syst=False,
         stout+="    oc_all_bands: True\n"
     else :
         stout+="    oc_all_bands: False\n"
-    stout+="    ssc_response_prefix: hsc_lss_params/Responses/Response\n"
+    stout+="    ssc_response_prefix: legacy_code/ssc_responses/Response\n"
 
     f=open(config_name,"w")
     f.write(stout)
@@ -110,9 +110,7 @@ def run_pipe_all(conf,suffix) :
 
         '''
         #Clean up previous run
-        cmd='rm -f '+dirname+'/*mcm* '
-        cmd+=dirname+'/gaucov_sims.npz '
-        cmd+=dirname+'/windows_l.npz '
+        cmd='rm -f '+dirname+'/gaucov_sims_*.npz '
         cmd+=dirname+'/*sacc'
         #print(cmd)
         os.system(cmd)
@@ -129,9 +127,8 @@ def run_pipe_all(conf,suffix) :
         #print(cmd)
         os.system(cmd)
 
-        cmd='mv '+dirname+'/*mcm* '
-        cmd+=dirname+'/gaucov_sims.npz '
-        cmd+=dirname+'/windows_l.npz '
+        #(MCMs and window functions are kept in the shared nmt_cache directory)
+        cmd='mv '+dirname+'/gaucov_sims_*.npz '
         cmd+=dirname+'/*sacc '
         cmd+=dirend
         #print(cmd)
@@ -0,0 +1,48 @@
+import os
+import numpy as np
+import pytest
+from astropy.io import fits
+pytest.importorskip('ceci')
+from hsc_lss.pdf_match import PDFMatch
+from hsc_lss.pdf_utils import PDFReader
+
+pz_algs=['demp','ephor','ephor_ab','frankenz','nnpz']
+
+def write_patch(fname,ids,pdfs,bins) :
+    cols=[fits.Column(name='ID',format='K',array=ids),
+          fits.Column(name='PDF',format='%dE'%len(bins),array=pdfs)]
+    hdul=fits.HDUList([fits.PrimaryHDU(),
+                       fits.BinTableHDU.from_columns(cols),
+                       fits.BinTableHDU.from_columns([fits.Column(name='bins',format='E',array=bins)])])
+    hdul.writeto(fname)
+
+def test_repeated_objects(tmp_path) :
+    #Objects found in several patches take the pdf of the last patch, regardless of the
+    #order in which patches are read. The first patch is the largest, so it finishes last.
+    rng=np.random.default_rng(0)
+    ncat=100
+    nz=20
+    bins=np.linspace(0,3,nz).astype(np.float32)
+    ids_cat=np.arange(ncat,dtype=np.int64)[::-1]
+    expected=np.zeros([ncat,nz],dtype=np.float32)
+    for alg in pz_algs :
+        os.makedirs(str(tmp_path/'pdf'/alg))
+    for ip,n in enumerate([20000,60,60,60]) :
+        ids=rng.choice(120,n).astype(np.int64)
+        pdfs=(ip+1+rng.random([n,nz])).astype(np.float32)
+        for i,p in zip(ids,pdfs) :
+            if i<ncat :
+                expected[ncat-1-i]=p
+        for alg in pz_algs :
+            write_patch(str(tmp_path/'pdf'/alg/('patch%d.fits'%ip)),ids,pdfs,bins)
+    fits.BinTableHDU.from_columns([fits.Column(name='object_id',format='K',array=ids_cat)]).writeto(str(tmp_path/'cat.fits'))
+
+    stage=PDFMatch.__new__(PDFMatch)
+    stage.config={'n_workers':4,'pdf_encoding':'float32','pdf_cache':False}
+    stage.get_input=lambda n : {'clean_catalog':str(tmp_path/'cat.fits'),'pdf_dir':str(tmp_path/'pdf')}[n]
+    stage.get_output=lambda n : str(tmp_path/'pdf_matched.txt')
+    stage.run()
+    for alg in pz_algs :
+        reader=PDFReader(str(tmp_path/('pdf_matched_'+alg+'.fits')))
+        assert np.array_equal(reader.read(0,ncat),expected)
+        reader.close()
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from hsc_lss.pdf_utils import (encode_pdfs,decode_pdfs,write_pdfs,PDFReader,
+                               stack_pdfs,pdf_encodings)
+
+#Maximum difference between N(z)s stacked from encoded and float32 pdfs,
+#relative to the peak of the N(z).
+stack_tolerances={'float32':1E-6,'float16':1E-3,'uint16':1E-5,'uint8':5E-3}
+
+def get_pdfs(nobj=1000,nz=100,seed=1234) :
+    rng=np.random.default_rng(seed)
+    bins=np.linspace(0,4,nz)
+    zm=rng.uniform(0.2,3.,nobj); sz=rng.uniform(0.03,0.3,nobj)
+    pdfs=np.exp(-0.5*((bins[None,:]-zm[:,None])/sz[:,None])**2)/sz[:,None]
+    pdfs[::97]=0 #A few objects without a pdf
+    ids=np.arange(nobj,dtype=np.int64)+10**15
+    return ids,pdfs.astype(np.float32),bins
+
+@pytest.mark.parametrize('encoding',list(pdf_encodings.keys()))
+def test_encode_decode(encoding) :
+    _,pdfs,_=get_pdfs()
+    data,scale=encode_pdfs(pdfs,encoding)
+    assert data.dtype==pdf_encodings[encoding][0]
+    dec=decode_pdfs(data,scale,encoding)
+    assert dec.dtype==np.float32
+    err=np.amax(np.fabs(dec-pdfs),axis=1)
+    pmax=np.amax(pdfs,axis=1)
+    if encoding=='float32' :
+        assert np.all(err==0)
+    elif encoding=='float16' :
+        assert np.all(err<=pmax*2.**-11)
+    else :
+        #Half a quantization step (plus float32 rounding)
+        assert np.all(err<=pmax*(0.5/{'uint16':65535,'uint8':255}[encoding]+1E-6))
+    #Null pdfs are preserved
+    assert np.all(dec[::97]==0)
+
+@pytest.mark.parametrize('encoding',list(pdf_encodings.keys()))
+def test_stacked_nz_roundtrip(encoding,tmp_path) :
+    ids,pdfs,bins=get_pdfs()
+    labels=np.random.default_rng(1).integers(-1,4,len(ids))
+    fname_ref=str(tmp_path/'ref.fits')
+    fname=str(tmp_path/('pdfs_'+encoding+'.fits'))
+    write_pdfs(fname_ref,ids,pdfs,bins,encoding='float32')
+    write_pdfs(fname,ids,pdfs,bins,encoding=encoding)
+
+    z_ref,st_ref=stack_pdfs(fname_ref,labels,4,chunk_size=77)
+    z,st=stack_pdfs(fname,labels,4,chunk_size=77)
+    assert np.allclose(z,bins) and np.allclose(z_ref,bins)
+    for s,sr in zip(st,st_ref) :
+        nz=s/np.sum(s); nz_ref=sr/np.sum(sr)
+        assert np.amax(np.fabs(nz-nz_ref))<=stack_tolerances[encoding]*np.amax(nz_ref)
+
+@pytest.mark.parametrize('encoding',list(pdf_encodings.keys()))
+def test_pdf_reader(encoding,tmp_path) :
+    ids,pdfs,bins=get_pdfs(nobj=250)
+    fname=str(tmp_path/'pdfs.fits')
+    write_pdfs(fname,ids,pdfs,bins,encoding=encoding)
+    ref=decode_pdfs(*encode_pdfs(pdfs,encoding),encoding=encoding)
+
+    reader=PDFReader(fname)
+    assert reader.encoding==encoding
+    assert reader.nobj==len(ids)
+    assert np.allclose(reader.bins,bins)
+    #Streaming in chunks returns all objects in order
+    i0s=[]; chunks=[]
+    for i0,p in reader.iterate(chunk_size=60) :
+        assert len(p)<=60
+        i0s.append(i0); chunks.append(p)
+    assert i0s==[0,60,120,180,240]
+    assert np.array_equal(np.concatenate(chunks),ref)
+    #Masked reads
+    mask=np.arange(40)%3==0
+    assert np.array_equal(reader.read(10,50,mask=mask),ref[10:50][mask])
+    reader.close()
+
+def test_pdf_reader_legacy(tmp_path) :
+    #Files written without an encoding header are read as float32
+    ids,pdfs,bins=get_pdfs(nobj=20)
+    cols=[fits.Column(name='object_id',format='K',array=ids),
+          fits.Column(name='pdf',format='%dE'%len(bins),array=pdfs)]
+    hdul=fits.HDUList([fits.PrimaryHDU(),
+                       fits.BinTableHDU.from_columns(cols),
+                       fits.BinTableHDU.from_columns([fits.Column(name='bins',format='E',array=bins)])])
+    fname=str(tmp_path/'legacy.fits')
+    hdul.writeto(fname)
+    reader=PDFReader(fname)
+    assert reader.encoding=='float32'
+    assert np.array_equal(reader.read(0,20),pdfs)
+    reader.close()
+
+def test_stack_pdfs(tmp_path) :
+    ids,pdfs,bins=get_pdfs()
+    labels=np.random.default_rng(2).integers(-1,3,len(ids))
+    labels[:50]=-1
+    fname=str(tmp_path/'pdfs.fits')
+    write_pdfs(fname,ids,pdfs,bins)
+    for chunk_size in [1,33,10000] :
+        z,st=stack_pdfs(fname,labels,4,chunk_size=chunk_size)
+        assert st.shape==(4,len(bins))
+        for i in range(4) :
+            ref=np.sum(pdfs[labels==i],axis=0,dtype=float)
+            assert np.allclose(st[i],ref,rtol=0,atol=1E-5*np.amax(pdfs))
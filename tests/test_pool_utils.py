@@ -0,0 +1,44 @@
+import os
+import numpy as np
+from hsc_lss.pool_utils import get_nworkers,pool_map,get_worker_threads,limit_omp_threads
+
+def test_get_nworkers() :
+    assert get_nworkers(3)==3
+    assert get_nworkers(-1)>=1
+    assert get_nworkers(None)>=1
+
+def test_pool_map_serial() :
+    tasks=list(range(-10,10))
+    assert list(pool_map(abs,tasks,n_workers=1))==[abs(t) for t in tasks]
+
+def test_pool_map_ordered() :
+    tasks=list(range(-50,50))
+    for max_inflight in [None,1,3] :
+        res=list(pool_map(abs,tasks,n_workers=3,max_inflight=max_inflight))
+        assert res==[abs(t) for t in tasks]
+
+def test_pool_map_unordered() :
+    tasks=list(range(-50,50))
+    for max_inflight in [None,1,3] :
+        res=list(pool_map(abs,tasks,n_workers=3,ordered=False,max_inflight=max_inflight))
+        assert sorted(res)==sorted([abs(t) for t in tasks])
+
+def test_pool_map_start_methods() :
+    tasks=[np.arange(i) for i in range(10)]
+    for method in ['spawn','fork'] :
+        res=list(pool_map(np.sum,tasks,n_workers=2,mp_context=method))
+        assert res==[np.sum(t) for t in tasks]
+
+def test_get_worker_threads() :
+    ncores=get_nworkers(-1)
+    assert get_worker_threads(1)==ncores
+    assert get_worker_threads(ncores)==1
+    assert get_worker_threads(10*ncores)==1
+
+def get_omp_threads(n_threads) :
+    limit_omp_threads(n_threads)
+    return os.environ['OMP_NUM_THREADS']
+
+def test_limit_omp_threads() :
+    #Run in a separate process, so as not to limit this one
+    assert list(pool_map(get_omp_threads,[2,3],n_workers=2,mp_context='spawn'))==['2','3']
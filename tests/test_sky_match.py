@@ -0,0 +1,58 @@
+import numpy as np
+from hsc_lss import tree_utils
+from hsc_lss.sky_match import SkyMatcher,radec_to_vec,chord_to_arcsec
+
+def get_catalogs(seed=1234) :
+    rng=np.random.default_rng(seed)
+    n_ref=2000
+    ra_ref=rng.uniform(149.5,150.5,n_ref); dec_ref=rng.uniform(1.5,2.5,n_ref)
+    #Input objects: perturbed reference objects plus random ones
+    i_true=rng.choice(n_ref,500,replace=False)
+    ra=np.concatenate([ra_ref[i_true]+rng.normal(0,0.3/3600,500),rng.uniform(149.5,150.5,300)])
+    dec=np.concatenate([dec_ref[i_true]+rng.normal(0,0.3/3600,500),rng.uniform(1.5,2.5,300)])
+    return ra_ref,dec_ref,ra,dec
+
+def get_separations(ra,dec,ra_ref,dec_ref) :
+    v=radec_to_vec(ra,dec); v_ref=radec_to_vec(ra_ref,dec_ref)
+    return chord_to_arcsec(np.sqrt(np.sum((v[:,None,:]-v_ref[None,:,:])**2,axis=-1)))
+
+def test_match_nearest() :
+    ra_ref,dec_ref,ra,dec=get_catalogs()
+    sep_all=get_separations(ra,dec,ra_ref,dec_ref)
+    sm=SkyMatcher(ra_ref,dec_ref)
+    ind,sep=sm.match_nearest(ra,dec,tol_arcsec=2.)
+    i_best=np.argmin(sep_all,axis=1)
+    good=np.amin(sep_all,axis=1)<2.
+    assert np.all(ind[good]==i_best[good])
+    assert np.all(ind[~good]==-1) and np.all(np.isinf(sep[~good]))
+    assert np.allclose(sep[good],np.amin(sep_all,axis=1)[good],atol=1E-6)
+
+def test_match_within() :
+    ra_ref,dec_ref,ra,dec=get_catalogs()
+    sep_all=get_separations(ra,dec,ra_ref,dec_ref)
+    i_in,i_ref,sep=SkyMatcher(ra_ref,dec_ref).match_within(ra,dec,60.)
+    i_in_b,i_ref_b=np.where(sep_all<60.)
+    assert set(zip(i_in,i_ref))==set(zip(i_in_b,i_ref_b))
+    assert np.allclose(sep,sep_all[i_in,i_ref],atol=1E-6)
+
+def test_match_reciprocal() :
+    ra_ref,dec_ref,ra,dec=get_catalogs()
+    sep_all=get_separations(ra,dec,ra_ref,dec_ref)
+    sm=SkyMatcher(ra_ref,dec_ref)
+    n_cached=len(tree_utils._tree_cache)
+    i_in,i_ref,sep=sm.match_reciprocal(ra,dec,2.)
+    #Input trees are temporary
+    assert len(tree_utils._tree_cache)==n_cached
+    fwd=np.argmin(sep_all,axis=1); bwd=np.argmin(sep_all,axis=0)
+    i_in_b=np.where((bwd[fwd]==np.arange(len(ra)))&(np.amin(sep_all,axis=1)<2.))[0]
+    assert np.all(np.sort(i_in)==i_in_b)
+    assert np.all(i_ref==fwd[i_in])
+
+def test_get_tree_cache() :
+    pts=np.random.default_rng(0).normal(size=[100,3])
+    t1=tree_utils.get_tree(pts)
+    assert tree_utils.get_tree(pts) is t1
+    n_cached=len(tree_utils._tree_cache)
+    t2=tree_utils.get_tree(pts+1,cache=False)
+    assert len(tree_utils._tree_cache)==n_cached
+    assert t2 is not tree_utils.get_tree(pts+1,cache=False)
@@ -0,0 +1,139 @@
+import numpy as np
+import pytest
+from hsc_lss.stats_utils import (get_groups,segment_percentile,segment_median,update_moments,
+                                 MomentsCheckpoint,histogram_index)
+
+def get_test_groups(seed=1234) :
+    #Groups of sizes 0 to 20, including several empty and size-1 groups
+    rng=np.random.default_rng(seed)
+    sizes=np.concatenate([[0,1,0,1,2],rng.integers(0,20,size=50)])
+    indptr=np.concatenate([[0],np.cumsum(sizes)])
+    values=rng.normal(size=indptr[-1])
+    weights=rng.uniform(0.1,2.,size=indptr[-1])
+    return values,weights,indptr
+
+def weighted_percentile_brute(values,weights,q) :
+    #Linear interpolation between the mid-points of the cumulative weight
+    if len(values)==0 :
+        return np.nan
+    order=np.argsort(values)
+    v=values[order]; w=weights[order]
+    x=(np.cumsum(w)-0.5*w)/np.sum(w)
+    return np.interp(0.01*q,x,v)
+
+def test_get_groups() :
+    labels=np.array([3,1,3,2,1,3])
+    order,indptr,keys=get_groups(labels)
+    assert np.all(keys==[1,2,3])
+    assert np.all(indptr==[0,2,3,6])
+    assert np.all(order==[1,4,3,0,2,5])
+
+def test_segment_median() :
+    values,_,indptr=get_test_groups()
+    med=segment_median(values,indptr)
+    for i in range(len(indptr)-1) :
+        v=values[indptr[i]:indptr[i+1]]
+        if len(v)==0 :
+            assert np.isnan(med[i])
+        else :
+            assert med[i]==pytest.approx(np.median(v),abs=1E-12)
+
+def test_segment_percentile() :
+    values,_,indptr=get_test_groups()
+    qs=[0.,10.,25.,50.,90.,100.]
+    pcs=segment_percentile(values,indptr,qs)
+    assert pcs.shape==(len(qs),len(indptr)-1)
+    for i in range(len(indptr)-1) :
+        v=values[indptr[i]:indptr[i+1]]
+        if len(v)==0 :
+            assert np.all(np.isnan(pcs[:,i]))
+        else :
+            #Unweighted percentiles use the mid-points of each value's rank
+            assert np.allclose(pcs[:,i],np.percentile(v,qs,method='hazen'),atol=1E-12)
+
+def test_segment_percentile_weighted() :
+    values,weights,indptr=get_test_groups()
+    qs=[5.,33.,50.,80.]
+    pcs=segment_percentile(values,indptr,qs,weights=weights)
+    for i in range(len(indptr)-1) :
+        v=values[indptr[i]:indptr[i+1]]
+        w=weights[indptr[i]:indptr[i+1]]
+        for iq,q in enumerate(qs) :
+            ref=weighted_percentile_brute(v,w,q)
+            if np.isnan(ref) :
+                assert np.isnan(pcs[iq,i])
+            else :
+                assert pcs[iq,i]==pytest.approx(ref,abs=1E-12)
+
+def test_segment_percentile_sorted_and_scalar() :
+    values,weights,indptr=get_test_groups()
+    vsorted=values.copy()
+    for i in range(len(indptr)-1) :
+        vsorted[indptr[i]:indptr[i+1]]=np.sort(values[indptr[i]:indptr[i+1]])
+    p=segment_percentile(values,indptr,30.)
+    assert p.shape==(len(indptr)-1,)
+    assert np.allclose(p,segment_percentile(vsorted,indptr,30.,sorted_values=True),equal_nan=True)
+
+@pytest.mark.parametrize('nthreads',[2,3,8,1000])
+def test_segment_percentile_threads(nthreads) :
+    values,weights,indptr=get_test_groups()
+    qs=[10.,50.,90.]
+    p1=segment_percentile(values,indptr,qs,nthreads=1)
+    pn=segment_percentile(values,indptr,qs,nthreads=nthreads)
+    assert np.array_equal(p1,pn,equal_nan=True)
+    #Cumulative weights are summed over each block, so only rounding errors differ
+    p1=segment_percentile(values,indptr,qs,weights=weights,nthreads=1)
+    pn=segment_percentile(values,indptr,qs,weights=weights,nthreads=nthreads)
+    assert np.allclose(p1,pn,rtol=0,atol=1E-12,equal_nan=True)
+
+def test_histogram_index() :
+    #Same bins as np.histogram, including values on the edges and the right end
+    _,edges=np.histogram([],bins=7,range=[0.,4.])
+    x=np.concatenate([edges,np.random.default_rng(3).uniform(-1,5,1000),[np.nan]])
+    ix=histogram_index(x,edges)
+    assert np.array_equal(ix[:len(edges)],[0,1,2,3,4,5,6,6]) #The last edge falls in the last bin
+    h,_=np.histogram(x[np.isfinite(x)],bins=7,range=[0.,4.])
+    assert np.array_equal(np.bincount(ix[ix>=0],minlength=7),h)
+    assert np.all(ix[(x<0) | (x>4) | np.isnan(x)]==-1)
+
+def test_update_moments() :
+    rng=np.random.default_rng(1)
+    x=rng.normal(size=[103,5])
+    n,mean,m2=0,None,None
+    for i0 in range(0,len(x),10) :
+        n,mean,m2=update_moments(n,mean,m2,x[i0:i0+10])
+    assert n==len(x)
+    assert np.allclose(mean,np.mean(x,axis=0))
+    assert np.allclose(m2/(n-1),np.cov(x.T))
+
+def test_moments_checkpoint_resume(tmp_path) :
+    rng=np.random.default_rng(2)
+    batches=[rng.normal(size=[7,4]) for i in range(10)]
+    x=np.concatenate(batches)
+    fname=str(tmp_path/'ckpt.npz')
+
+    #Run interrupted after 6 batches, with checkpoints every 2 batches
+    ckpt=MomentsCheckpoint(fname,'key_a',save_samples=True)
+    for i,b in enumerate(batches[:6]) :
+        ckpt.add(b)
+        if i%2==1 :
+            ckpt.save()
+    ckpt.add(batches[6]) #Lost when the run stops
+    del ckpt
+
+    #Resume from the last checkpoint
+    ckpt=MomentsCheckpoint(fname,'key_a',save_samples=True)
+    assert ckpt.n==42
+    for b in batches[ckpt.n//7:] :
+        ckpt.add(b)
+    ckpt.save()
+    assert ckpt.n==len(x)
+    assert np.allclose(ckpt.get_covariance(),np.cov(x.T))
+    assert np.array_equal(np.array(ckpt.samples),x)
+
+    #Checkpoints for other inputs are not reused
+    assert MomentsCheckpoint(fname,'key_b').n==0
+    assert MomentsCheckpoint(fname,'key_a').n==len(x)
+    #Nor are checkpoints without samples if samples are requested
+    MomentsCheckpoint(fname,'key_a').save()
+    assert MomentsCheckpoint(fname,'key_a',save_samples=True).n==0
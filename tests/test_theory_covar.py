@@ -0,0 +1,89 @@
+import os
+import numpy as np
+import pytest
+ccl=pytest.importorskip('pyccl')
+from hsc_lss import theory_covar as tc
+
+response_prefix=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..',
+                             'legacy_code','ssc_responses','Response')
+z_bias=np.array([0.0,0.5,1.0,2.0,4.0])
+b_bias=np.array([0.82,1.10,1.44,1.66,2.61])
+ells=np.array([150.,400.,1000.,2500.])
+fsky=0.005
+
+def get_nzs() :
+    z=np.linspace(0,2,201)
+    nzs=[(z,np.exp(-0.5*((z-zm)/0.15)**2)) for zm in [0.7,0.9]]
+    return nzs
+
+def get_ccl_tracers(cosmo,nzs,bias=True) :
+    return [ccl.NumberCountsTracer(cosmo,has_rsd=False,dndz=(z,nz),
+                                   bias=(z,np.interp(z,z_bias,b_bias) if bias else np.ones_like(z)))
+            for z,nz in nzs]
+
+def get_block(cov,i,j) :
+    nell=len(ells)
+    return cov[i*nell:(i+1)*nell,j*nell:(j+1)*nell]
+
+def test_response_files(tmp_path) :
+    zarr,fnames=tc.get_response_files(response_prefix)
+    assert sorted(zarr)==[0.,1.,2.,3.,4.]
+    assert not any(f.endswith('_z0b.txt') for f in fnames)
+    with pytest.raises(ValueError) :
+        tc.get_response_files(str(tmp_path/'Response'))
+
+def test_response_tables() :
+    #The tables store the dimensionless response dlnP/d(delta_b) against k in h/Mpc
+    cosmo=tc.get_cosmology()
+    resp=tc.get_response(cosmo,response_prefix)
+    k_h,_,_,_,r=np.loadtxt(response_prefix+'_z1.txt',unpack=True)
+    for kh in [0.01,0.1,1.] :
+        assert resp(kh*cosmo['h'],0.5,cosmo)==pytest.approx(np.interp(kh,k_h,r),rel=1E-3)
+    #Close to the linear limit, 47/21-(1/3)dlnP/dlnk, on the largest scales (the tables
+    #were computed with a halo model, so they only agree approximately)
+    k=0.007*cosmo['h']*np.array([0.99,1.,1.01])
+    dlpk=np.diff(np.log(ccl.linear_matter_power(cosmo,k[::2],1.)))[0]/np.log(1.01/0.99)
+    assert resp(k[1],1.,cosmo)==pytest.approx(47./21-dlpk/3,abs=0.1)
+
+def test_covar_ssc_vs_ccl() :
+    cosmo=tc.get_cosmology()
+    nzs=get_nzs()
+    cov=tc.get_covar_ssc(cosmo,nzs,z_bias,b_bias,ells,fsky,response_prefix)
+    assert cov.shape==(3*len(ells),3*len(ells))
+    assert np.allclose(cov,cov.T)
+
+    #Same calculation with CCL, using dP/d(delta_b)=P_NL*dlnP/d(delta_b)
+    resp=tc.get_response(cosmo,response_prefix)
+    a_arr=np.linspace(1./3.,1.,32)
+    lk_arr=np.linspace(np.log(1E-2),np.log(30.),256)
+    dpk=np.array([resp(np.exp(lk_arr),a,cosmo)*ccl.nonlin_matter_power(cosmo,np.exp(lk_arr),a)
+                  for a in a_arr])
+    tk=ccl.Tk3D(a_arr=a_arr,lk_arr=lk_arr,pk1_arr=dpk,pk2_arr=dpk,is_logt=False)
+    trs=get_ccl_tracers(cosmo,nzs)
+    pairs=[(0,0),(0,1),(1,1)]
+    for ix,(i1,i2) in enumerate(pairs) :
+        for jx,(j1,j2) in enumerate(pairs) :
+            c_ccl=ccl.angular_cl_cov_SSC(cosmo,trs[i1],trs[i2],ell=ells,t_of_kk_a=tk,
+                                         tracer3=trs[j1],tracer4=trs[j2],fsky=fsky)
+            assert np.allclose(get_block(cov,ix,jx),c_ccl,rtol=2E-2,atol=0)
+
+def test_covar_ng_vs_ccl() :
+    cosmo=tc.get_cosmology()
+    nzs=get_nzs()
+    hod_params={'log10Mmin_0':11.88,'log10Mmin_p':-0.5,'siglnM_0':0.4,
+                'log10M0_0':11.88,'log10M0_p':-0.5,
+                'log10M1_0':13.08,'log10M1_p':0.9,'alpha_0':1.0}
+    #A coarse trispectrum is enough to compare both projections
+    zarr,_=tc.get_z_grid(nzs)
+    tkk=tc.get_trispectrum(cosmo,hod_params,zarr[-1],nk=16,na=4)
+    cov=tc.get_covar_ng(cosmo,nzs,hod_params,ells,tkk=tkk)
+    assert cov.shape==(3*len(ells),3*len(ells))
+    assert np.allclose(cov,cov.T)
+
+    #Covariance between the (0,0) and (0,1) spectra for a partial-sky survey, computed
+    #by CCL with the same trispectrum (the HOD already describes galaxies, so b=1).
+    #get_covar_ng returns the full-sky covariance, so it must be divided by fsky.
+    trs=get_ccl_tracers(cosmo,nzs,bias=False)
+    c_ccl=ccl.angular_cl_cov_cNG(cosmo,trs[0],trs[0],ell=ells,t_of_kk_a=tkk,
+                                 tracer3=trs[0],tracer4=trs[1],fsky=fsky)
+    assert np.allclose(get_block(cov,0,1)/fsky,c_ccl,rtol=1E-2,atol=0)
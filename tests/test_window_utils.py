@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+from hsc_lss.window_utils import (get_fourier_modes,get_ring_projector,
+                                  get_bandpower_windows,check_bandpower_windows)
+
+def test_fourier_modes() :
+    nx,ny=24,20
+    lx,ly=np.radians(4.),np.radians(3.)
+    kmod,ir,n_ell=get_fourier_modes(nx,ny,lx,ly)
+    kx=2*np.pi*np.fft.fftfreq(nx,lx/nx)
+    ky=2*np.pi*np.fft.fftfreq(ny,ly/ny)
+    kmod_all=np.sqrt(kx[None,:]**2+ky[:,None]**2).flatten()
+    dell=min(2*np.pi/lx,2*np.pi/ly)
+    #Rings of width dell (assigned as in NaMaster), discarding modes beyond the last one
+    assert np.all(ir<n_ell)
+    assert np.all(ir==(kmod*(1./dell)).astype(int))
+    assert np.allclose(np.sort(kmod),np.sort(kmod_all[(kmod_all*(1./dell)).astype(int)<n_ell]))
+
+def test_ring_projector() :
+    nx,ny=24,20
+    lx,ly=np.radians(4.),np.radians(3.)
+    kmod,ir,n_ell=get_fourier_modes(nx,ny,lx,ly)
+    lmax=int(np.amax(kmod))+2
+    proj=get_ring_projector(kmod,ir,n_ell,lmax)
+    #A constant spectrum is mapped into a constant
+    assert np.allclose(proj.dot(np.ones(lmax+1)),1.)
+    #A linear spectrum is mapped into the mean mode modulus of each ring
+    mean_k=np.bincount(ir,weights=kmod,minlength=n_ell)/np.bincount(ir,minlength=n_ell)
+    assert np.allclose(proj.dot(np.arange(lmax+1.)),mean_k)
+
+def get_workspace() :
+    nmt=pytest.importorskip('pymaster')
+    pytest.importorskip('matplotlib')
+    from astropy.wcs import WCS
+    from hsc_lss.flatmaps import FlatMapInfo
+    nx,ny=24,20
+    w=WCS(naxis=2)
+    w.wcs.ctype=['RA---TAN','DEC--TAN']
+    w.wcs.crval=[150.,2.]
+    w.wcs.crpix=[nx/2.,ny/2.]
+    w.wcs.cdelt=[-4./nx,3./ny]
+    fsk=FlatMapInfo(w,nx=nx,ny=ny)
+    #Smooth mask with a few holes
+    x,y=np.meshgrid(np.linspace(-1,1,fsk.nx),np.linspace(-1,1,fsk.ny))
+    mask=np.exp(-0.5*(x**2+y**2)/0.5**2)
+    mask[3,5]=0; mask[10,12]=0; mask[15,2]=0
+    f=nmt.NmtFieldFlat(np.radians(fsk.lx),np.radians(fsk.ly),mask,[np.zeros_like(mask)])
+    lmax=int(180.*np.sqrt(1./fsk.dx**2+1./fsk.dy**2))
+    edges=np.linspace(2,lmax,7)
+    b=nmt.NmtBinFlat(edges[:-1],edges[1:])
+    wsp=nmt.NmtWorkspaceFlat()
+    wsp.compute_coupling_matrix(f,f,b)
+    return wsp,fsk,lmax
+
+def test_bandpower_windows() :
+    wsp,fsk,lmax=get_workspace()
+    windows=get_bandpower_windows(wsp,fsk.nx,fsk.ny,np.radians(fsk.lx),np.radians(fsk.ly),lmax)
+    assert windows.shape==(wsp.wsp.bin.n_bands,lmax+1)
+    #Brute-force calculation at every multipole
+    l_arr=np.arange(lmax+1)
+    windows_bf=np.zeros_like(windows)
+    for il in range(lmax+1) :
+        t_hat=np.zeros(lmax+1); t_hat[il]=1.
+        windows_bf[:,il]=wsp.decouple_cell(wsp.couple_cell(l_arr,[t_hat]))[0]
+    assert np.allclose(windows,windows_bf,rtol=1E-5,atol=1E-8*np.amax(np.fabs(windows_bf)))
+
+    check_bandpower_windows(wsp,windows)
+    windows_bad=windows.copy()
+    windows_bad[:,np.argmax(np.sum(np.fabs(windows),axis=0))]*=1.1
+    with pytest.raises(RuntimeError) :
+        check_bandpower_windows(wsp,windows_bad,n_check=lmax+1)